@@ -0,0 +1,5 @@
+"""Offline benchmarks for the BuildForMe bot
+
+Run from the bot directory, e.g. `python -m benchmarks --build`. Everything runs
+against in-process fakes; no Discord, OpenAI or Supabase connection is made.
+"""
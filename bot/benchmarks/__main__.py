@@ -0,0 +1,63 @@
+"""python -m benchmarks [--logging] [--streaming] [--build] [--reconcile] [--commands [--sizes 10,100]]"""
+import argparse
+import logging
+import sys
+
+from benchmarks import suite
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Offline BuildForMe bot benchmarks")
+    parser.add_argument("--logging", action="store_true",
+                        help="Measure event-loop time spent in logging")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Compare buffered and streaming AI setup against a fake model")
+    parser.add_argument("--build", action="store_true",
+                        help="Compare sequential and concurrent blueprint builds against a fake Discord API")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="Time the blueprint diff against a synthetic 500-channel guild")
+    parser.add_argument("--commands", action="store_true",
+                        help="Run the structure commands against synthetic guilds of 10 to 5000 channels")
+    parser.add_argument("--sizes", default="10,100,1000,5000",
+                        help="Comma-separated channel counts for --commands")
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    if not any((args.logging, args.streaming, args.build, args.reconcile, args.commands)):
+        print("Nothing to run; pass one or more of --logging, --streaming, --build, --reconcile, --commands")
+        return 2
+    
+    if args.logging:
+        for mode, micros in suite.benchmark_logging().items():
+            print(f"{mode:>16}: {micros:8.2f} µs per log call on the event loop")
+    
+    if args.streaming:
+        for mode, timings in suite.benchmark_streaming_setup().items():
+            print(f"{mode:>10}: first channel after {timings['first_channel']:.3f}s, finished after {timings['total']:.3f}s")
+    
+    if args.build:
+        for mode, stats in suite.benchmark_blueprint_executor().items():
+            print(f"{mode:>10}: {stats['wall']:.3f}s, {stats['created']} created, {stats['failed']} failed, "
+                  f"{stats['retried']} retried, {stats['api_calls']} API calls, {stats['rate_limited']} rate limited")
+            print(f"{'':>12}{stats['calls']}")
+    
+    if args.reconcile:
+        stats = suite.benchmark_reconcile()
+        print(f"{stats['channels']} channels: diff median {stats['median_ms']:.2f} ms, max {stats['max_ms']:.2f} ms")
+        print(f"plan: {stats['plan']}")
+    
+    if args.commands:
+        sizes = tuple(int(size) for size in args.sizes.split(",") if size.strip())
+        logging.getLogger().setLevel(logging.WARNING)  # per-item fix/build logs would drown the table
+        print("fake Discord API: 50 ms latency, global 50/s, latency and windows scaled x0.1")
+        for size, commands_run in suite.benchmark_structure_commands(sizes).items():
+            for name, stats in commands_run.items():
+                print(f"{size:>5} channels {name:>26}: {stats['wall']:7.3f}s, {stats['api_calls']:>6} API calls, "
+                      f"{stats['rate_limited']:>5} rate limited")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
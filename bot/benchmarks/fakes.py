@@ -0,0 +1,391 @@
+"""In-process stand-ins for Discord used by the benchmarks"""
+import asyncio
+import random
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import aiohttp
+import discord
+import discord.http
+import yarl
+
+
+# Requests per window for routes missing from a FakeDiscordREST's limits
+DEFAULT_REST_LIMIT = (50, 1.0)
+
+class FakeDiscordREST:
+    """Stand-in for discord.py's HTTPClient with latency, Discord-style rate limits and 5xx faults
+    
+    `request(route, **kwargs)` has HTTPClient.request's signature, so RestScheduler.install
+    wraps it exactly as it wraps the real client. Buckets are per route and major
+    parameters as on Discord; `limits` maps "METHOD /path/{template}" to (requests, window)
+    and an optional "global" entry applies to every request on top. Every response,
+    429s included, is reported with rate-limit headers to the on_request_end hooks of
+    `trace_configs`; a 429'd request then waits for the reset and is resent, as discord.py
+    does. `error_rate` of the requests fail with DiscordServerError so retry paths get
+    exercised. `time_scale` shrinks latency and windows alike so large runs finish quickly.
+    """
+    
+    def __init__(self, latency: float = 0.05, limits: Optional[Dict[str, Tuple[int, float]]] = None,
+                 error_rate: float = 0.0, seed: int = 0, time_scale: float = 1.0,
+                 trace_configs: Optional[List[aiohttp.TraceConfig]] = None):
+        self.latency = latency * time_scale
+        self.limits = {key: (limit, window * time_scale) for key, (limit, window) in (limits or {}).items()}
+        self.default_limit = (DEFAULT_REST_LIMIT[0], DEFAULT_REST_LIMIT[1] * time_scale)
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.trace_configs = list(trace_configs or [])
+        self.calls: Counter = Counter()
+        self.rate_limited = 0
+        self.positions_honoured = True
+        self.errors = 0
+        self._windows: Dict[str, Tuple[float, int]] = {}
+        self._next_id = 1
+
+    def _window(self, bucket: str, limit: int, window: float, now: float) -> Tuple[int, float]:
+        """Requests left in `bucket`'s current window and seconds until it resets"""
+        start, used = self._windows.get(bucket, (now, 0))
+        if now - start >= window:
+            start, used = now, 0
+        self._windows[bucket] = (start, used)
+        return limit - used, start + window - now
+
+    def _spend(self, bucket: str):
+        start, used = self._windows[bucket]
+        self._windows[bucket] = (start, used + 1)
+
+    async def _trace(self, route: discord.http.Route, trace_request_ctx: Any, status: int, headers: Dict[str, str]):
+        context = SimpleNamespace(trace_request_ctx=trace_request_ctx)
+        params = SimpleNamespace(method=route.method, url=yarl.URL(route.url), headers={},
+                                 response=SimpleNamespace(status=status, headers=headers))
+        for trace in self.trace_configs:
+            for hook in trace.on_request_end:
+                await hook(None, context, params)
+
+    async def request(self, route: discord.http.Route, *, trace_request_ctx: Any = None, **kwargs) -> Dict[str, Any]:
+        key = f"{route.method} {route.path}"
+        bucket = f"{key}:{route.major_parameters}"
+        limit, window = self.limits.get(key, self.default_limit)
+        while True:
+            await asyncio.sleep(self.latency)
+            now = time.perf_counter()
+            scope = "user"
+            remaining, reset_after = self._window(bucket, limit, window, now)
+            if remaining > 0 and "global" in self.limits:
+                global_remaining, global_reset = self._window("global", *self.limits["global"], now)
+                if global_remaining <= 0:
+                    scope, remaining, reset_after = "global", 0, global_reset
+            if remaining <= 0:
+                self.rate_limited += 1
+                await self._trace(route, trace_request_ctx, 429, {
+                    "X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset-After": f"{reset_after:.3f}", "X-RateLimit-Scope": scope
+                })
+                await asyncio.sleep(reset_after)
+                continue
+            
+            self._spend(bucket)
+            if "global" in self.limits:
+                self._spend("global")
+            self.calls[key] += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                await self._trace(route, trace_request_ctx, 503, {})
+                raise discord.DiscordServerError(SimpleNamespace(status=503, reason="Service Unavailable"), "injected fault")
+            await self._trace(route, trace_request_ctx, 200, {
+                "X-RateLimit-Limit": str(limit), "X-RateLimit-Remaining": str(remaining - 1),
+                "X-RateLimit-Reset-After": f"{reset_after:.3f}", "X-RateLimit-Bucket": bucket
+            })
+            return {"id": str(self.new_id())}
+
+    def new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+class FakeRole:
+    """Role of a SyntheticGuild; ordered by position like discord.Role"""
+    
+    def __init__(self, guild: "SyntheticGuild", role_id: int, name: str, position: int,
+                 permissions: Optional[discord.Permissions] = None, color: int = 0, managed: bool = False):
+        self.guild = guild
+        self.id = role_id
+        self.name = name
+        self.position = position
+        self.permissions = permissions or discord.Permissions.none()
+        self.color = discord.Color(color)
+        self.managed = managed
+        self.mentionable = False
+        self.hoist = False
+        self.members: List["FakeMember"] = []
+
+    @property
+    def mention(self) -> str:
+        return f"<@&{self.id}>"
+
+    def is_default(self) -> bool:
+        return self.id == self.guild.id
+
+    def is_bot_managed(self) -> bool:
+        return self.managed
+
+    def __lt__(self, other: "FakeRole") -> bool:
+        return (self.position, self.id) < (other.position, other.id)
+
+    async def edit(self, reason: Optional[str] = None, **changes):
+        await self.guild.request("PATCH", "/guilds/{guild_id}/roles/{role_id}", role_id=self.id)
+        for field, value in changes.items():
+            setattr(self, "color" if field == "colour" else field, value)
+
+    async def delete(self, reason: Optional[str] = None):
+        await self.guild.request("DELETE", "/guilds/{guild_id}/roles/{role_id}", role_id=self.id)
+        self.guild.roles.remove(self)
+
+class FakeMember:
+    def __init__(self, member_id: int, name: str, roles: List[FakeRole], bot: bool = False,
+                 permissions: Optional[discord.Permissions] = None):
+        self.id = member_id
+        self.name = name
+        self.bot = bot
+        self.roles = roles
+        self.guild_permissions = permissions or discord.Permissions.none()
+
+    @property
+    def top_role(self) -> FakeRole:
+        return max(self.roles)
+
+class FakeMessage:
+    def __init__(self, author: FakeMember):
+        self.author = author
+        self.webhook_id = None
+
+class FakeChannel:
+    """Text, voice or category channel of a SyntheticGuild"""
+    
+    def __init__(self, guild: "SyntheticGuild", channel_id: int, name: str, channel_type: discord.ChannelType,
+                 position: int, category_id: Optional[int] = None, topic: Optional[str] = None,
+                 overwrites: Optional[Dict[Any, discord.PermissionOverwrite]] = None):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.type = channel_type
+        self.position = position
+        self.category_id = category_id
+        self.topic = topic
+        self.nsfw = False
+        self.overwrites = overwrites or {}
+        self.messages: List[FakeMessage] = []
+
+    @property
+    def category(self) -> Optional["FakeChannel"]:
+        return self.guild.get_channel(self.category_id) if self.category_id else None
+
+    @property
+    def channels(self) -> List["FakeChannel"]:
+        return [channel for channel in self.guild.channels if channel.category_id == self.id]
+
+    def permissions_for(self, member: FakeMember) -> discord.Permissions:
+        return member.guild_permissions
+
+    async def edit(self, reason: Optional[str] = None, **changes):
+        await self.guild.request("PATCH", "/channels/{channel_id}", channel_id=self.id)
+        category = changes.pop("category", None)
+        if category is not None:
+            self.category_id = category.id
+        for field, value in changes.items():
+            setattr(self, field, value)
+
+    async def set_permissions(self, target: Any, overwrite: Optional[discord.PermissionOverwrite] = None,
+                              reason: Optional[str] = None, **permissions):
+        await self.guild.request("PUT", "/channels/{channel_id}/permissions/{overwrite_id}",
+                                 channel_id=self.id, overwrite_id=target.id)
+        self.overwrites[target] = overwrite if overwrite is not None else discord.PermissionOverwrite(**permissions)
+
+    async def delete(self, reason: Optional[str] = None):
+        await self.guild.request("DELETE", "/channels/{channel_id}", channel_id=self.id)
+        del self.guild._channels[self.id]
+
+    async def send(self, content: Optional[str] = None, **kwargs) -> FakeMessage:
+        await self.guild.request("POST", "/channels/{channel_id}/messages", channel_id=self.id)
+        message = FakeMessage(self.guild.me)
+        self.messages.append(message)
+        return message
+
+    async def history(self, limit: Optional[int] = 100) -> AsyncIterator[FakeMessage]:
+        # One request per page of up to 100 messages, like discord.py
+        messages = self.messages[-limit:] if limit else self.messages
+        for page in range(0, max(len(messages), 1), 100):
+            await self.guild.request("GET", "/channels/{channel_id}/messages", channel_id=self.id)
+            for message in reversed(messages[page:page + 100]):
+                yield message
+
+class SyntheticGuild:
+    """In-memory guild for offline benchmarks of the bot's structure and build paths
+    
+    Shaped like the parts of discord.Guild the commands touch. Reads are free, and every
+    mutation (and message history page) sends one request through its FakeDiscordREST,
+    so whatever is installed on that client (the RestScheduler) sees the real traffic.
+    `first_channel_at` is when the first non-category channel was created.
+    """
+    
+    def __init__(self, rest: FakeDiscordREST, name: str = "Synthetic Guild"):
+        self.rest = rest
+        self.id = rest.new_id()
+        self.name = name
+        self.roles: List[FakeRole] = [FakeRole(self, self.id, "@everyone", 0, discord.Permissions.general())]
+        self._channels: Dict[int, FakeChannel] = {}
+        self.members: List[FakeMember] = []
+        bot_role = FakeRole(self, rest.new_id(), "BuildForMe", 1, discord.Permissions.all(), managed=True)
+        self.roles.append(bot_role)
+        self.me = FakeMember(rest.new_id(), "BuildForMe", [self.roles[0], bot_role], bot=True, permissions=discord.Permissions.all())
+        self.owner = FakeMember(rest.new_id(), "owner", [self.roles[0]], permissions=discord.Permissions.all())
+        self.members.extend([self.me, self.owner])
+        self.first_channel_at: Optional[float] = None
+        self._state = SimpleNamespace(http=SimpleNamespace(bulk_channel_update=self._bulk_channel_update))
+
+    async def request(self, method: str, path: str, **params) -> Dict[str, Any]:
+        """Send one request for this guild through the REST client, as the discord.py models do"""
+        if "{guild_id}" in path:
+            params["guild_id"] = self.id
+        return await self.rest.request(discord.http.Route(method, path, **params))
+
+    @classmethod
+    def generate(cls, rest: FakeDiscordREST, roles: int = 10, categories: int = 5, channels: int = 50,
+                 members: int = 100, seed: int = 0) -> "SyntheticGuild":
+        """A guild of `roles` roles and `channels` channels spread over `categories` categories
+        
+        Categories hide from @everyone and open to one role; about a third of the channels
+        carry a redundant @everyone overwrite and a tenth have spaces in their names, so
+        permission and naming fixes always have work to do.
+        """
+        rng = random.Random(seed)
+        guild = cls(rest)
+        everyone = guild.default_role
+        for r in range(roles):
+            role = FakeRole(guild, rest.new_id(), f"Role {r}", 0, color=rng.randrange(0xFFFFFF),
+                            permissions=discord.Permissions(manage_messages=r < 2, administrator=r == 0))
+            guild.roles.insert(1, role)
+        for position, role in enumerate(guild.roles):
+            role.position = position
+        
+        for m in range(members):
+            member_roles = [everyone] + rng.sample(guild.roles[1:-1], min(roles, rng.randint(0, 3)))
+            member = FakeMember(rest.new_id(), f"member-{m}", member_roles, bot=rng.random() < 0.05)
+            guild.members.append(member)
+            for role in member_roles[1:]:
+                role.members.append(member)
+        
+        category_count = max(1, categories)
+        category_channels = []
+        for c in range(category_count):
+            overwrites = {everyone: discord.PermissionOverwrite(read_messages=False)}
+            if roles:
+                overwrites[guild.roles[1 + c % roles]] = discord.PermissionOverwrite(read_messages=True)
+            category = FakeChannel(guild, rest.new_id(), f"Category {c}", discord.ChannelType.category, c,
+                                   overwrites=overwrites)
+            guild._channels[category.id] = category
+            category_channels.append(category)
+        for n in range(channels):
+            category = category_channels[n % category_count]
+            voice = n % 7 == 6
+            name = f"Lounge {n}" if voice else (f"chat {n}" if n % 10 == 3 else f"chat-{n}")
+            overwrites = {}
+            if n % 3 == 0:
+                overwrites[everyone] = discord.PermissionOverwrite(read_messages=everyone.permissions.read_messages)
+            channel = FakeChannel(guild, rest.new_id(), name, discord.ChannelType.voice if voice else discord.ChannelType.text,
+                                  n // category_count, category.id, topic=None if voice else f"Topic {n}", overwrites=overwrites)
+            if not voice:
+                authors = [rng.choice(guild.members) for _ in range(rng.randint(0, 10))]
+                channel.messages = [FakeMessage(author) for author in authors]
+            guild._channels[channel.id] = channel
+        return guild
+
+    @property
+    def channels(self) -> List[FakeChannel]:
+        return list(self._channels.values())
+
+    @property
+    def default_role(self) -> FakeRole:
+        return self.roles[0]
+
+    @property
+    def member_count(self) -> int:
+        return len(self.members)
+
+    @property
+    def categories(self) -> List[FakeChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.category]
+
+    @property
+    def text_channels(self) -> List[FakeChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.text]
+
+    @property
+    def voice_channels(self) -> List[FakeChannel]:
+        return [channel for channel in self.channels if channel.type == discord.ChannelType.voice]
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self._channels.get(channel_id)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        return next((role for role in self.roles if role.id == role_id), None)
+
+    async def create_role(self, name: str = "new role", reason: Optional[str] = None, color: Any = None,
+                          permissions: Optional[discord.Permissions] = None, **kwargs) -> FakeRole:
+        await self.request("POST", "/guilds/{guild_id}/roles")
+        role = FakeRole(self, self.rest.new_id(), name, 1, permissions, color=getattr(color, "value", color or 0))
+        for existing in self.roles[1:]:
+            existing.position += 1
+        self.roles.insert(1, role)
+        return role
+
+    async def edit_role_positions(self, positions: Dict[Any, int], reason: Optional[str] = None):
+        await self.request("PATCH", "/guilds/{guild_id}/roles")
+        wanted = {target.id: position for target, position in positions.items()}
+        for role in self.roles:
+            role.position = wanted.get(role.id, role.position)
+        self.roles.sort()
+
+    async def _create_channel(self, name: str, channel_type: discord.ChannelType, category: Optional[FakeChannel],
+                              position: Optional[int], topic: Optional[str], overwrites: Optional[Dict[Any, Any]]) -> FakeChannel:
+        await self.request("POST", "/guilds/{guild_id}/channels")
+        if position is None or not self.rest.positions_honoured:
+            position = len(self.channels)
+        channel = FakeChannel(self, self.rest.new_id(), name, channel_type, position,
+                              category.id if category else None, topic, dict(overwrites or {}))
+        self._channels[channel.id] = channel
+        if self.first_channel_at is None and channel_type != discord.ChannelType.category:
+            self.first_channel_at = time.perf_counter()
+        return channel
+
+    async def create_category(self, name: str, position: Optional[int] = None, overwrites: Optional[Dict[Any, Any]] = None,
+                              reason: Optional[str] = None, **kwargs) -> FakeChannel:
+        return await self._create_channel(name, discord.ChannelType.category, None, position, None, overwrites)
+
+    async def create_text_channel(self, name: str, category: Optional[FakeChannel] = None, position: Optional[int] = None,
+                                  topic: Optional[str] = None, overwrites: Optional[Dict[Any, Any]] = None,
+                                  reason: Optional[str] = None, **kwargs) -> FakeChannel:
+        return await self._create_channel(name, discord.ChannelType.text, category, position, topic, overwrites)
+
+    async def create_voice_channel(self, name: str, category: Optional[FakeChannel] = None, position: Optional[int] = None,
+                                   overwrites: Optional[Dict[Any, Any]] = None, reason: Optional[str] = None,
+                                   **kwargs) -> FakeChannel:
+        return await self._create_channel(name, discord.ChannelType.voice, category, position, None, overwrites)
+
+    async def _bulk_channel_update(self, guild_id: int, data: List[Dict[str, Any]], reason: Optional[str] = None):
+        await self.request("PATCH", "/guilds/{guild_id}/channels")
+        wanted = {int(entry["id"]): entry["position"] for entry in data}
+        for channel in self._channels.values():
+            channel.position = wanted.get(channel.id, channel.position)
+
+# Discord's documented global limit plus per-channel limits in the range it reports for these calls;
+# guild-level routes get DEFAULT_REST_LIMIT
+SYNTHETIC_REST_LIMITS = {
+    "global": (50, 1.0),
+    "PATCH /channels/{channel_id}": (5, 5.0),
+    "DELETE /channels/{channel_id}": (5, 5.0),
+    "PUT /channels/{channel_id}/permissions/{overwrite_id}": (5, 5.0),
+    "POST /channels/{channel_id}/messages": (5, 5.0),
+    "GET /channels/{channel_id}/messages": (5, 5.0)
+}
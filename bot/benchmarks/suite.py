@@ -0,0 +1,265 @@
+"""Benchmarks of the bot's logging, build, reconcile and structure command paths"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Tuple, cast
+
+import discord
+
+import professional_builder_bot as bot
+from benchmarks.fakes import FakeDiscordREST, SyntheticGuild, SYNTHETIC_REST_LIMITS
+
+
+def benchmark_logging(records: int = 20000) -> Dict[str, float]:
+    """Event-loop time spent in hot-path logging calls, direct handlers vs the queue pipeline
+    
+    Returns microseconds per call for each mode.
+    """
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, "w") as devnull:
+        for mode in ("direct", "queued", "queued_sampled"):
+            logger = logging.getLogger(f"benchmark.{mode}")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handlers = bot.build_log_handlers(os.path.join(tmp, f"{mode}.log"), stream=devnull)
+            listener = None
+            if mode == "direct":
+                for handler in handlers:
+                    logger.addHandler(handler)
+            else:
+                queue_handler, listener = bot.build_queue_handler(handlers)
+                # Measure the pipeline itself, not the per-logger rate limit
+                queue_handler.filters = [f for f in queue_handler.filters if not isinstance(f, bot.RateLimitFilter)]
+                logger.addHandler(queue_handler)
+                listener.start()
+            extra = bot.HOT_PATH_LOG if mode == "queued_sampled" else None
+            
+            async def emit() -> float:
+                spent = 0.0
+                for i in range(records):
+                    started = time.perf_counter()
+                    logger.info("📋 Subscription status: '%s' for server %s (active: %s)", "active", i, True, extra=extra)
+                    spent += time.perf_counter() - started
+                    if i % 100 == 0:
+                        await asyncio.sleep(0)
+                return spent
+            
+            spent = asyncio.run(emit())
+            if listener:
+                listener.stop()
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            for handler in handlers:
+                handler.close()
+            results[mode] = spent / records * 1_000_000
+    return results
+
+
+def scheduled_guild(rest: FakeDiscordREST, **generate) -> SyntheticGuild:
+    """A guild whose requests go through a fresh RestScheduler installed on `rest`
+    
+    The scheduler wraps `rest.request` and reads its rate-limit headers from the trace
+    hooks, exactly as it does for discord.py's HTTPClient. With `generate` options the
+    guild is populated by SyntheticGuild.generate, otherwise it starts empty.
+    """
+    scheduler = bot.RestScheduler()
+    scheduler.install(rest)
+    rest.trace_configs.append(scheduler.trace_config())
+    return SyntheticGuild.generate(rest, **generate) if generate else SyntheticGuild(rest)
+
+def drifted_blueprint(guild: SyntheticGuild, every: int = 10) -> Dict[str, Any]:
+    """The guild's own layout as a blueprint, with every `every`th category changed
+    
+    A changed category loses its last channel (pruned), gains a new one and has its first
+    text channel's topic changed, so a reconcile creates, updates and deletes across the
+    whole guild while leaving most of it alone.
+    """
+    roles = [{"name": role.name, "color": str(role.color)} for role in guild.roles[1:] if not role.managed]
+    categories = []
+    for c, category in enumerate(sorted(guild.categories, key=lambda channel: channel.position)):
+        channels = []
+        for channel in sorted(category.channels, key=lambda channel: channel.position):
+            entry = {"name": channel.name, "type": "voice" if channel.type == discord.ChannelType.voice else "text"}
+            if channel.topic:
+                entry["topic"] = channel.topic
+            channels.append(entry)
+        if c % every == 0 and channels:
+            channels.pop()
+            channels.append({"name": f"new-{c}", "type": "text"})
+            text = next((entry for entry in channels if entry["type"] == "text"), None)
+            if text:
+                text["topic"] = "updated"
+        categories.append({"name": category.name, "channels": channels})
+    return {"roles": roles, "categories": categories}
+
+def benchmark_streaming_setup(categories: int = 8, channels_per_category: int = 5, roles: int = 6,
+                              token_delay: float = 0.002, api_latency: float = 0.02) -> Dict[str, Dict[str, float]]:
+    """Compare buffered and streaming /setup builds against a fake model and a synthetic guild"""
+    blueprint = {
+        "categories": [
+            {"name": f"Category {c}", "channels": [{"name": f"channel-{c}-{n}", "type": "text"} for n in range(channels_per_category)]}
+            for c in range(categories)
+        ],
+        "roles": [{"name": f"Role {r}", "color": "#99aab5"} for r in range(roles)],
+        "welcome_message": "Welcome!",
+        "rules": ["Be kind"]
+    }
+    document = json.dumps(blueprint, indent=2)
+    chunks = [document[i:i + 4] for i in range(0, len(document), 4)]
+    
+    class FakeModel:
+        async def stream_response(self, *args, **kwargs):
+            for chunk in chunks:
+                await asyncio.sleep(token_delay)
+                yield chunk
+        
+        async def generate_response(self, *args, **kwargs):
+            return "".join([chunk async for chunk in self.stream_response()])
+    
+    async def run() -> Dict[str, Dict[str, float]]:
+        model = FakeModel()
+        cog = bot.MainCog(cast(Any, SimpleNamespace(ai_service=model)))
+        results = {}
+        
+        guild = scheduled_guild(FakeDiscordREST(latency=api_latency))
+        interaction = cast(Any, SimpleNamespace(guild=guild))
+        started = time.perf_counter()
+        response = await model.generate_response()
+        await cog._build_server_ai(interaction, json.loads(response), "gamer", False, False, False)
+        results["buffered"] = {"first_channel": (guild.first_channel_at or started) - started,
+                               "total": time.perf_counter() - started}
+        
+        guild = scheduled_guild(FakeDiscordREST(latency=api_latency))
+        interaction = cast(Any, SimpleNamespace(guild=guild))
+        started = time.perf_counter()
+        await cog._build_server_ai_streaming(interaction, model.stream_response(), "gamer", False, False, False)
+        results["streaming"] = {"first_channel": (guild.first_channel_at or started) - started,
+                                "total": time.perf_counter() - started}
+        return results
+    
+    return asyncio.run(run())
+
+def benchmark_structure_commands(sizes: Tuple[int, ...] = (10, 100, 1000, 5000), api_latency: float = 0.05,
+                                 time_scale: float = 0.1) -> Dict[int, Dict[str, Dict[str, Any]]]:
+    """Run the structure commands against synthetic guilds of `sizes` channels
+    
+    Every command gets a freshly generated guild, FakeDiscordREST and RestScheduler, so API
+    calls and 429s are per command and the 429s are the ones the scheduler let through.
+    `_build_server_ai` builds into an empty guild; `reconcile` runs the same build with
+    pruning against a populated guild and a drifted copy of its own layout. Wall times are
+    real seconds at `time_scale`.
+    """
+    cog = bot.MainCog(cast(Any, SimpleNamespace(ai_service=None)))
+    
+    def fresh(channels: int, empty: bool = False) -> SyntheticGuild:
+        rest = FakeDiscordREST(latency=api_latency, limits=SYNTHETIC_REST_LIMITS, time_scale=time_scale)
+        if empty:
+            return scheduled_guild(rest)
+        return scheduled_guild(rest, roles=max(5, channels // 20), categories=max(1, channels // 10),
+                               channels=channels, members=min(10000, channels * 2))
+    
+    async def build(guild: SyntheticGuild, channels: int):
+        per_category = 10
+        blueprint = {
+            "roles": [{"name": f"Role {r}", "color": "#99aab5"} for r in range(max(5, channels // 20))],
+            "categories": [
+                {"name": f"Category {c}", "channels": [{"name": f"chat-{c}-{n}", "type": "voice" if n == 0 else "text"}
+                                                       for n in range(min(per_category, channels - c * per_category))]}
+                for c in range(max(1, -(-channels // per_category)))
+            ]
+        }
+        await cog._build_server_ai(cast(Any, SimpleNamespace(guild=guild)), blueprint, "gamer", False, False, False)
+    
+    async def reconcile(guild: SyntheticGuild, channels: int):
+        await cog._build_server_ai(cast(Any, SimpleNamespace(guild=guild)), drifted_blueprint(guild), "theme-based",
+                                   False, False, False, prune=True)
+    
+    async def nuke(guild: SyntheticGuild, channels: int):
+        admin_channel = await bot.CoreHelper.ensure_admin_channel(cast(Any, guild))
+        job = bot.Job(None, 0, "nuke", guild.id, None, {})
+        await job.add_steps(cog._plan_nuke(cast(Any, guild), admin_channel))
+        await cog._run_nuke(cast(Any, guild), job)
+    
+    async def apply_fixes(guild: SyntheticGuild, channels: int):
+        everyone = guild.default_role
+        redundant = [channel.name for channel in guild.channels if everyone in channel.overwrites
+                     and channel.overwrites[everyone].read_messages == everyone.permissions.read_messages]
+        spaced = [channel.name for channel in guild.channels if " " in channel.name]
+        await cog._apply_fix_safely(cast(Any, guild), {"type": "permission_redundancy", "affected_items": redundant})
+        await cog._apply_fix_safely(cast(Any, guild), {"type": "naming_inconsistency", "affected_items": spaced})
+    
+    async def analyze(guild: SyntheticGuild, channels: int):
+        await cog._analyze_server_structure(cast(Any, guild), "comprehensive", "all")
+    
+    commands_to_run: Dict[str, Tuple[Callable[[SyntheticGuild, int], Any], bool]] = {
+        "_build_server_ai": (build, True),
+        "reconcile": (reconcile, False),
+        "nuke": (nuke, False),
+        "_apply_fix_safely": (apply_fixes, False),
+        "_analyze_server_structure": (analyze, False)
+    }
+    
+    async def run() -> Dict[int, Dict[str, Dict[str, Any]]]:
+        results: Dict[int, Dict[str, Dict[str, Any]]] = {}
+        for size in sizes:
+            results[size] = {}
+            for name, (command, empty) in commands_to_run.items():
+                guild = fresh(size, empty)
+                started = time.perf_counter()
+                await command(guild, size)
+                results[size][name] = {"wall": time.perf_counter() - started, "api_calls": sum(guild.rest.calls.values()),
+                                       "rate_limited": guild.rest.rate_limited, "calls": dict(guild.rest.calls)}
+        return results
+    
+    return asyncio.run(run())
+
+def benchmark_blueprint_executor(categories: int = 8, channels_per_category: int = 5, roles: int = 6,
+                                 api_latency: float = 0.05, error_rate: float = 0.05) -> Dict[str, Dict[str, Any]]:
+    """Build the same blueprint sequentially and with BlueprintExecutor's default limits into a synthetic guild"""
+    blueprint = {
+        "categories": [
+            {"name": f"Category {c}", "channels": [{"name": f"channel-{c}-{n}", "type": "voice" if n == 0 else "text"}
+                                                   for n in range(channels_per_category)]}
+            for c in range(categories)
+        ],
+        "roles": [{"name": f"Role {r}", "color": "#99aab5"} for r in range(roles)]
+    }
+    
+    async def run() -> Dict[str, Dict[str, Any]]:
+        results = {}
+        configs = {
+            "sequential": {"concurrency": 1, "bucket_limits": {"roles": 1, "channels": 1}},
+            "concurrent": {}
+        }
+        for mode, options in configs.items():
+            rest = FakeDiscordREST(latency=api_latency, error_rate=error_rate)
+            executor = bot.BlueprintExecutor(cast(Any, scheduled_guild(rest)), retry_backoff=api_latency, **options)
+            with bot.rest_lane("bulk"):
+                result = await executor.run(blueprint)
+            results[mode] = {
+                "wall": result.duration, "created": len(result.created), "failed": len(result.failed),
+                "retried": len(result.retried), "api_calls": sum(rest.calls.values()), "rate_limited": rest.rate_limited,
+                "calls": dict(result.api_calls)
+            }
+        return results
+    
+    return asyncio.run(run())
+
+def benchmark_reconcile(channels: int = 500, categories: int = 50, roles: int = 50, runs: int = 20) -> Dict[str, Any]:
+    """Time the in-memory diff of a drifted blueprint against a synthetic guild of `channels` channels"""
+    guild = SyntheticGuild.generate(FakeDiscordREST(), roles=roles, categories=categories, channels=channels, members=0)
+    blueprint = drifted_blueprint(guild)
+    
+    timings = []
+    plan = bot.ReconcilePlan()
+    for _ in range(runs):
+        started = time.perf_counter()
+        plan = bot.BlueprintReconciler(cast(Any, guild), prune=True).diff(blueprint)
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    return {"channels": len(guild.channels), "median_ms": timings[len(timings) // 2] * 1000,
+            "max_ms": timings[-1] * 1000, "plan": plan.summary()}
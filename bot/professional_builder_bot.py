@@ -7,6 +7,10 @@ Requirements:
 - discord.py>=2.3.2
 - openai>=1.3.0
 - supabase>=2.0.0
+- httpx>=0.23.0
+
+Optional:
+- tiktoken (exact prompt token counts; falls back to an estimate)
 """
 
 import os
@@ -18,34 +22,164 @@ import datetime
 import sys
 import time
 import signal
-from typing import Optional, List, Dict, Any, Union, cast
+import atexit
+import bisect
+import math
+import hashlib
+import queue
+import random
+import re
+import sqlite3
+import threading
+import tempfile
+import contextlib
+import contextvars
+import functools
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, Counter, deque
+from typing import Optional, List, Dict, Any, Union, Tuple, AsyncIterator, AsyncGenerator, Callable, cast
 from typing_extensions import Literal
 
 import discord
 from discord.ext import commands
 from discord import app_commands, Interaction
+import aiohttp
+from aiohttp import web
 
 try:
     from dotenv import load_dotenv
-    from openai import OpenAI
+    import httpx
+    from openai import AsyncOpenAI
     from supabase import create_client, Client
 except ImportError as e:
     print(f"❌ Missing required dependency: {e}")
     print("Please install dependencies with: pip install -r requirements.txt")
     sys.exit(1)
 
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 # Load environment variables
 load_dotenv()
 
-# Configure logging with better format and level
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('bot.log', encoding='utf-8')
-    ]
-)
+# Logging configuration
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # stdout format: text or json (the log file is always JSON)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_RATE_LIMIT = float(os.getenv("LOG_RATE_LIMIT", "50"))  # records/second per logger, below WARNING
+HOT_PATH_SAMPLE_RATE = float(os.getenv("HOT_PATH_SAMPLE_RATE", "0.01"))
+TEXT_LOG_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+# Pass as `extra=HOT_PATH_LOG` on per-request INFO lines so only a sample of them is kept
+HOT_PATH_LOG = {"sample_rate": HOT_PATH_SAMPLE_RATE}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a random sample of records that carry a `sample_rate` attribute"""
+    
+    def __init__(self):
+        super().__init__()
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = getattr(record, "sample_rate", None)
+        if rate is None or record.levelno >= logging.WARNING or random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+class RateLimitFilter(logging.Filter):
+    """Per-logger token bucket for records below WARNING"""
+    
+    def __init__(self, rate: float = LOG_RATE_LIMIT, burst: Optional[float] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * 2
+        self.dropped = 0
+        self._buckets: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.dropped += 1
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+    
+    def __init__(self, log_queue: "queue.Queue"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def build_log_handlers(log_file: str, stream=None) -> List[logging.Handler]:
+    """File (rotating, JSON) and stdout handlers that do the actual I/O"""
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonLogFormatter())
+    stream_handler = logging.StreamHandler(stream or sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_LOG_FORMAT))
+    return [stream_handler, file_handler]
+
+def build_queue_handler(handlers: List[logging.Handler]) -> Tuple[NonBlockingQueueHandler, logging.handlers.QueueListener]:
+    """Queue front-end: callers only filter and enqueue, a listener thread does the I/O"""
+    log_queue: "queue.Queue" = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+    queue_handler.addFilter(RateLimitFilter())
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    return queue_handler, listener
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Route all logging through a queue so the event loop never waits on disk or stdout"""
+    queue_handler, listener = build_queue_handler(build_log_handlers(LOG_FILE))
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    return listener
+
+log_listener = setup_logging()
+atexit.register(log_listener.stop)
 
 # Reduce noise from external libraries
 logging.getLogger('discord.http').setLevel(logging.WARNING)
@@ -58,25 +192,27 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 
-# Validate critical environment variables
-if not DISCORD_TOKEN:
-    print("❌ DISCORD_TOKEN is required to run the bot")
-    print("Please set your Discord bot token in the .env file")
-    print("Get your token from: https://discord.com/developers/applications")
-    sys.exit(1)
-
-# Warn about missing optional variables
-optional_vars = {
-    "OPENAI_API_KEY": OPENAI_API_KEY,
-    "SUPABASE_URL": SUPABASE_URL,
-    "SUPABASE_SERVICE_ROLE_KEY": SUPABASE_SERVICE_ROLE_KEY
-}
-
-missing_optional = [var for var, value in optional_vars.items() if not value]
-if missing_optional:
-    print(f"⚠️  Missing optional environment variables: {', '.join(missing_optional)}")
-    print("Some features may be limited without these variables")
-    print("Set them in your .env file for full functionality")
+def validate_environment():
+    """Exit if the bot cannot start; warn about optional variables"""
+    # Validate critical environment variables
+    if not DISCORD_TOKEN:
+        print("❌ DISCORD_TOKEN is required to run the bot")
+        print("Please set your Discord bot token in the .env file")
+        print("Get your token from: https://discord.com/developers/applications")
+        sys.exit(1)
+    
+    # Warn about missing optional variables
+    optional_vars = {
+        "OPENAI_API_KEY": OPENAI_API_KEY,
+        "SUPABASE_URL": SUPABASE_URL,
+        "SUPABASE_SERVICE_ROLE_KEY": SUPABASE_SERVICE_ROLE_KEY
+    }
+    
+    missing_optional = [var for var, value in optional_vars.items() if not value]
+    if missing_optional:
+        print(f"⚠️  Missing optional environment variables: {', '.join(missing_optional)}")
+        print("Some features may be limited without these variables")
+        print("Set them in your .env file for full functionality")
 
 # Global variables for graceful shutdown
 bot_instance = None
@@ -101,46 +237,635 @@ def create_supabase_client() -> Optional[Client]:
         logging.warning("⚠️ Supabase credentials not provided")
         return None
         
-    max_retries = 3
-    for attempt in range(max_retries):
+    try:
+        client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+    except Exception as e:
+        logging.error(f"❌ Failed to create Supabase client: {e}")
+        return None
+    
+    # Test connection once; if Supabase is down, the repository's circuit breaker
+    # fails calls fast until it recovers instead of blocking startup on retries
+    try:
+        client.table("profiles").select("id").limit(1).execute()
+        logging.info("✅ Supabase connection established")
+    except Exception as e:
+        logging.warning(f"⚠️ Supabase connection test failed: {e}")
+    return client
+
+supabase: Optional[Client] = create_supabase_client()
+
+# Subscription cache tuning (seconds / entries)
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", "60"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+SUBSCRIPTION_WARMUP_CHUNK = int(os.getenv("SUBSCRIPTION_WARMUP_CHUNK", "500"))
+
+# Supabase data-access layer
+SUPABASE_MAX_CONCURRENCY = int(os.getenv("SUPABASE_MAX_CONCURRENCY", "8"))
+SUPABASE_CALL_TIMEOUT = float(os.getenv("SUPABASE_CALL_TIMEOUT", "10"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_LAG_WARN_THRESHOLD = float(os.getenv("LOOP_LAG_WARN_THRESHOLD", "0.25"))
+
+# Circuit breakers for OpenAI and Supabase
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_WINDOW = float(os.getenv("CIRCUIT_WINDOW", "60"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))
+
+# Activity log batching
+ACTIVITY_LOG_QUEUE_SIZE = int(os.getenv("ACTIVITY_LOG_QUEUE_SIZE", "10000"))
+ACTIVITY_LOG_BATCH_SIZE = int(os.getenv("ACTIVITY_LOG_BATCH_SIZE", "200"))
+ACTIVITY_LOG_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_LOG_FLUSH_INTERVAL", "5"))
+
+# Local state (write spool etc.) and spool replay tuning
+BOT_STATE_DB = os.getenv("BOT_STATE_DB", "bot_state.db")
+WRITE_SPOOL_BATCH_SIZE = int(os.getenv("WRITE_SPOOL_BATCH_SIZE", "500"))
+WRITE_SPOOL_REPLAY_INTERVAL = float(os.getenv("WRITE_SPOOL_REPLAY_INTERVAL", "2"))
+WRITE_SPOOL_MAX_BACKOFF = float(os.getenv("WRITE_SPOOL_MAX_BACKOFF", "60"))
+
+# Startup guild sync
+GUILD_SYNC_CHUNK = int(os.getenv("GUILD_SYNC_CHUNK", "500"))
+GUILD_SYNC_MAX_AGE = float(os.getenv("GUILD_SYNC_MAX_AGE", str(24 * 3600)))
+GUILD_SYNC_DEBOUNCE = float(os.getenv("GUILD_SYNC_DEBOUNCE", "60"))
+
+# Checkpointed structure jobs (/setup, /admin-setup, /nuke): finished jobs are kept this long
+JOB_RETENTION_DAYS = float(os.getenv("JOB_RETENTION_DAYS", "7"))
+
+# Blueprint builds: concurrent Discord calls overall and per rate-limit bucket, and retries
+BUILD_CONCURRENCY = int(os.getenv("BUILD_CONCURRENCY", "6"))
+BUILD_ROLE_CONCURRENCY = int(os.getenv("BUILD_ROLE_CONCURRENCY", "3"))
+BUILD_CHANNEL_CONCURRENCY = int(os.getenv("BUILD_CHANNEL_CONCURRENCY", "4"))
+BUILD_MAX_RETRIES = int(os.getenv("BUILD_MAX_RETRIES", "3"))
+BUILD_RETRY_BACKOFF = float(os.getenv("BUILD_RETRY_BACKOFF", "1"))
+
+# Discord REST scheduler: mutation requests in flight overall and for bulk commands, and how many
+# requests of a rate-limit bucket bulk work leaves for interactive replies
+REST_MAX_CONCURRENCY = int(os.getenv("REST_MAX_CONCURRENCY", "8"))
+REST_BULK_CONCURRENCY = int(os.getenv("REST_BULK_CONCURRENCY", "4"))
+REST_BUCKET_RESERVE = int(os.getenv("REST_BUCKET_RESERVE", "1"))
+
+# OpenAI client and rate limits (requests / tokens per minute)
+AI_MODEL = os.getenv("AI_MODEL", "gpt-4o-mini")
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "2000"))
+AI_REQUEST_TIMEOUT = float(os.getenv("AI_REQUEST_TIMEOUT", "30"))
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "8"))
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "20"))
+AI_GLOBAL_RPM = float(os.getenv("AI_GLOBAL_RPM", "500"))
+AI_GLOBAL_TPM = float(os.getenv("AI_GLOBAL_TPM", "200000"))
+AI_GUILD_RPM = float(os.getenv("AI_GUILD_RPM", "10"))
+AI_GUILD_TPM = float(os.getenv("AI_GUILD_TPM", "40000"))
+AI_TEMPERATURE = float(os.getenv("AI_TEMPERATURE", "0.7"))
+AI_STREAMING_SETUP = os.getenv("AI_STREAMING_SETUP", "true").lower() == "true"
+
+# AI response cache
+AI_CACHE_TTL = float(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+AI_CACHE_MEMORY_ENTRIES = int(os.getenv("AI_CACHE_MEMORY_ENTRIES", "500"))
+AI_CACHE_DISK_ENTRIES = int(os.getenv("AI_CACHE_DISK_ENTRIES", "5000"))
+# Commands whose AI responses are never cached (comma-separated command names)
+AI_CACHE_EXCLUDED_COMMANDS = {c.strip() for c in os.getenv("AI_CACHE_EXCLUDED_COMMANDS", "ai-cleanup").split(",") if c.strip()}
+AI_MAX_CONTINUATIONS = int(os.getenv("AI_MAX_CONTINUATIONS", "2"))
+AI_PROMPT_TOKEN_BUDGET = int(os.getenv("AI_PROMPT_TOKEN_BUDGET", "6000"))
+AI_CLEANUP_MAX_CHUNKS = int(os.getenv("AI_CLEANUP_MAX_CHUNKS", "6"))
+
+# Hedged AI requests: fire a second request once the first runs past a latency percentile
+AI_HEDGE_ENABLED = os.getenv("AI_HEDGE_ENABLED", "false").lower() == "true"
+AI_HEDGE_PERCENTILE = float(os.getenv("AI_HEDGE_PERCENTILE", "0.95"))
+AI_HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", "2"))
+AI_HEDGE_MAX_RATE = float(os.getenv("AI_HEDGE_MAX_RATE", "0.1"))  # fraction of recent requests
+AI_HEDGE_MIN_SAMPLES = int(os.getenv("AI_HEDGE_MIN_SAMPLES", "20"))
+AI_HEDGE_WINDOW = int(os.getenv("AI_HEDGE_WINDOW", "200"))
+
+# AI backend: live, record (live calls saved as fixtures) or replay (fixtures only, no network)
+AI_BACKEND_MODE = os.getenv("AI_BACKEND_MODE", "live").lower()
+AI_FIXTURES_DIR = os.getenv("AI_FIXTURES_DIR", "ai_fixtures")
+AI_REPLAY_LATENCY = os.getenv("AI_REPLAY_LATENCY", "recorded")
+AI_REPLAY_SEED = os.getenv("AI_REPLAY_SEED")
+
+# Model routing: JSON list of rules, checked in order (see ModelRouter); empty uses DEFAULT_AI_ROUTES
+AI_ROUTES = os.getenv("AI_ROUTES", "")
+
+# AI usage accounting and the metrics endpoint (METRICS_PORT=0 disables it)
+AI_USAGE_FLUSH_INTERVAL = float(os.getenv("AI_USAGE_FLUSH_INTERVAL", "60"))
+AI_USAGE_TOP_PROMPTS = int(os.getenv("AI_USAGE_TOP_PROMPTS", "20"))
+AI_TOKEN_PRICES: Dict[str, List[float]] = json.loads(os.getenv("AI_TOKEN_PRICES", "{}"))  # model -> [USD per 1k prompt, per 1k completion]
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+class Histogram:
+    """Cumulative latency histogram over fixed, roughly logarithmic bucket bounds"""
+    
+    BOUNDS_MS = (50, 100, 250, 500, 1000, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 60000)
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, seconds * 1000)] += 1
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound in ms of the bucket holding the q-th quantile"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return float(self.BOUNDS_MS[min(i, len(self.BOUNDS_MS) - 1)])
+        return float(self.BOUNDS_MS[-1])
+
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.BOUNDS_MS, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "buckets": buckets,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99)
+        }
+
+class MetricsRegistry:
+    """In-process counters, gauges, latency timings and histograms for bot subsystems"""
+    
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+        self.timings: Dict[str, Dict[str, float]] = {}
+        self.histograms: Dict[str, Histogram] = {}
+
+    def increment(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        """Record a latency sample in seconds"""
+        stats = self.timings.get(name)
+        if stats is None:
+            stats = self.timings[name] = {"count": 0, "total": 0.0, "max": 0.0}
+        stats["count"] += 1
+        stats["total"] += seconds
+        stats["max"] = max(stats["max"], seconds)
+
+    def observe_histogram(self, name: str, seconds: float):
+        """Record a latency sample in seconds into a bucketed histogram"""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return a JSON-serializable copy of all metrics"""
+        timings = {}
+        for name, stats in self.timings.items():
+            avg = stats["total"] / stats["count"] if stats["count"] else 0.0
+            timings[name] = {
+                "count": stats["count"],
+                "avg_ms": round(avg * 1000, 3),
+                "max_ms": round(stats["max"] * 1000, 3)
+            }
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": timings,
+            "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+        }
+
+metrics = MetricsRegistry()
+
+class CircuitOpenError(Exception):
+    """A dependency's circuit breaker is open, so the call was not attempted"""
+    
+    def __init__(self, label: str, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"⚠️ {label} is temporarily unavailable. Please try again in {max(1, round(retry_after))}s.")
+
+class CircuitBreaker:
+    """Closed/open/half-open circuit breaker over a rolling window of call outcomes
+    
+    Opens once at least `min_calls` outcomes in the last `window` seconds have an error
+    rate of `error_rate` or more. While open, `allow` raises CircuitOpenError for
+    `cooldown` seconds; then up to `half_open_probes` trial calls are let through. A
+    successful probe closes the breaker and a failed one re-opens it. Callers must report
+    every allowed call with `record_success` or `record_failure`.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_GAUGE = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    
+    def __init__(self, name: str, label: str, error_rate: float = CIRCUIT_ERROR_RATE,
+                 min_calls: int = CIRCUIT_MIN_CALLS, window: float = CIRCUIT_WINDOW,
+                 cooldown: float = CIRCUIT_COOLDOWN, half_open_probes: int = CIRCUIT_HALF_OPEN_PROBES):
+        self.name = name
+        self.label = label
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.half_open_probes = half_open_probes
+        self.state = self.CLOSED
+        self.logger = logging.getLogger("CircuitBreaker")
+        # (monotonic time, succeeded) for calls in the rolling window
+        self._outcomes: "deque[Tuple[float, bool]]" = deque()
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probes_started = 0.0
+        metrics.set_gauge(f"circuit.{name}.state", self.STATE_GAUGE[self.state])
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        previous, self.state = self.state, state
+        metrics.set_gauge(f"circuit.{self.name}.state", self.STATE_GAUGE[state])
+        metrics.increment(f"circuit.{self.name}.{state}")
+        log = self.logger.warning if state == self.OPEN else self.logger.info
+        log(f"🔌 {self.name} circuit {previous} -> {state}")
+
+    def _reject(self, retry_after: float):
+        metrics.increment(f"circuit.{self.name}.rejected")
+        raise CircuitOpenError(self.label, retry_after)
+
+    def check(self):
+        """Fail fast if the breaker is open, without taking a half-open probe slot"""
+        if self.state == self.OPEN:
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0:
+                self._reject(remaining)
+
+    def allow(self):
+        """Raise CircuitOpenError unless a call may go through now"""
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.cooldown:
+                self._reject(self._opened_at + self.cooldown - now)
+            self._set_state(self.HALF_OPEN)
+            self._probes = 0
+            self._probes_started = now
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_probes:
+                # Probe slots free up again if the probes never reported back
+                if now - self._probes_started < self.cooldown:
+                    self._reject(self._probes_started + self.cooldown - now)
+                self._probes = 0
+                self._probes_started = now
+            self._probes += 1
+
+    def _record(self, succeeded: bool):
+        now = time.monotonic()
+        self._outcomes.append((now, succeeded))
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._outcomes.popleft()
+
+    def record_success(self):
+        if self.state == self.HALF_OPEN:
+            self._outcomes.clear()
+            self._set_state(self.CLOSED)
+        elif self.state == self.CLOSED:
+            self._record(True)
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self._trip()
+        elif self.state == self.CLOSED:
+            self._record(False)
+            failures = sum(1 for _, succeeded in self._outcomes if not succeeded)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+                self._trip()
+
+    def _trip(self):
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._set_state(self.OPEN)
+
+openai_breaker = CircuitBreaker("openai", "The AI service")
+supabase_breaker = CircuitBreaker("supabase", "The subscription database")
+
+class LoopLagMonitor:
+    """Measures event-loop lag: how late a periodic timer fires compared to schedule
+    
+    Any blocking call on the event loop shows up directly as lag, so this doubles as
+    the check that bot code does no blocking I/O on the loop thread.
+    """
+    
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, warn_threshold: float = LOOP_LAG_WARN_THRESHOLD):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.max_lag = 0.0
+        self.logger = logging.getLogger("LoopLagMonitor")
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.observe("event_loop.lag", lag)
+            metrics.set_gauge("event_loop.max_lag_ms", round(self.max_lag * 1000, 3))
+            if lag > self.warn_threshold:
+                self.logger.warning(f"⚠️ Event loop blocked for {lag * 1000:.0f}ms")
+
+loop_lag_monitor = LoopLagMonitor()
+
+class SupabaseRepository:
+    """Async data-access layer for every Supabase call the bot makes
+    
+    supabase-py is synchronous, so each query runs on a dedicated, bounded thread pool
+    and is awaited with a per-call timeout; nothing blocks the event loop. All calls share
+    the one client and therefore its keep-alive HTTP connection pool. Latency, errors and
+    timeouts are recorded per operation. Calls go through a circuit breaker; PostgREST
+    errors count as successes there since the service itself answered.
+    """
+    
+    def __init__(self, client: Optional[Client], max_concurrency: int = SUPABASE_MAX_CONCURRENCY,
+                 timeout: float = SUPABASE_CALL_TIMEOUT, breaker: CircuitBreaker = supabase_breaker):
+        self.client = client
+        self.timeout = timeout
+        self.breaker = breaker
+        self.logger = logging.getLogger("SupabaseRepository")
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="supabase")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @property
+    def available(self) -> bool:
+        return self.client is not None
+
+    async def _execute(self, name: str, build, timeout: Optional[float] = None):
+        """Run `build(client).execute()` on the pool and return the response"""
+        if not self.client:
+            raise ConnectionError("No Supabase connection available")
+        
+        client = self.client
+        loop = asyncio.get_running_loop()
+        self.breaker.allow()
+        async with self._semaphore:
+            started = time.perf_counter()
+            try:
+                response = await asyncio.wait_for(
+                    loop.run_in_executor(self._executor, lambda: build(client).execute()),
+                    timeout=timeout or self.timeout
+                )
+                self.breaker.record_success()
+                return response
+            except asyncio.TimeoutError:
+                metrics.increment(f"supabase.{name}.timeout")
+                self.breaker.record_failure()
+                raise
+            except Exception as e:
+                metrics.increment(f"supabase.{name}.error")
+                if type(e).__name__ == "APIError":
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                raise
+            finally:
+                metrics.observe(f"supabase.{name}", time.perf_counter() - started)
+
+    async def get_guild_owner(self, guild_id: str) -> Optional[str]:
+        result = await self._execute(
+            "get_guild_owner",
+            lambda c: c.table("guilds").select("owner_id").eq("id", guild_id)
+        )
+        return result.data[0].get("owner_id") if result.data else None
+
+    async def get_guild_owners(self, guild_ids: List[str]) -> Dict[str, str]:
+        result = await self._execute(
+            "get_guild_owners",
+            lambda c: c.table("guilds").select("id, owner_id").in_("id", guild_ids)
+        )
+        return {row["id"]: row["owner_id"] for row in result.data or [] if row.get("owner_id")}
+
+    async def get_subscription_status(self, discord_user_id: str) -> Optional[str]:
+        result = await self._execute(
+            "get_subscription_status",
+            lambda c: c.table("subscribers").select("subscription_status").eq("discord_user_id", discord_user_id)
+        )
+        return result.data[0].get("subscription_status", "pending") if result.data else None
+
+    async def get_guild_subscription_statuses(self, guild_ids: List[str]) -> Dict[str, Optional[str]]:
+        """guild_id -> subscription_status via the bulk `get_guild_subscription_statuses` RPC"""
+        result = await self._execute(
+            "get_guild_subscription_statuses",
+            lambda c: c.rpc("get_guild_subscription_statuses", {"guild_ids": guild_ids})
+        )
+        return {row["guild_id"]: row.get("subscription_status") for row in (result.data or [])}
+
+    async def get_subscription_statuses_by_owner(self, discord_user_ids: List[str]) -> Dict[str, Optional[str]]:
+        result = await self._execute(
+            "get_subscription_statuses_by_owner",
+            lambda c: c.table("subscribers").select("discord_user_id, subscription_status").in_("discord_user_id", discord_user_ids)
+        )
+        statuses: Dict[str, Optional[str]] = {}
+        for row in result.data or []:
+            statuses.setdefault(row["discord_user_id"], row.get("subscription_status", "pending"))
+        return statuses
+
+    async def subscriber_exists(self, discord_user_id: str) -> bool:
+        result = await self._execute(
+            "subscriber_exists",
+            lambda c: c.table("subscribers").select("id").eq("discord_user_id", discord_user_id).limit(1)
+        )
+        return bool(result.data)
+
+    async def write(self, table: str, op: str, rows: List[Dict[str, Any]], on_conflict: Optional[str] = None,
+                    filters: Optional[Dict[str, Any]] = None):
+        """Insert/upsert a batch of rows, or apply an update (first row) matching `filters`"""
+        if op == "insert":
+            build = lambda c: c.table(table).insert(rows)
+        elif op == "upsert":
+            build = lambda c: c.table(table).upsert(rows, on_conflict=on_conflict or "id")
+        elif op == "update":
+            def build(c):
+                query = c.table(table).update(rows[0])
+                for column, value in (filters or {}).items():
+                    query = query.eq(column, value)
+                return query
+        else:
+            raise ValueError(f"Unsupported write op: {op}")
+        await self._execute(f"{op}.{table}", build)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+repository = SupabaseRepository(supabase)
+
+class SubscriptionResolver:
+    """Async subscription lookups with a bounded TTL cache and per-guild single-flight
+    
+    Positive results are cached for `ttl` seconds, negative results (no guild, no owner,
+    inactive subscription) for `negative_ttl` seconds. Database errors are never cached.
+    Concurrent checks for the same guild share one in-flight lookup.
+    """
+    
+    def __init__(self, ttl: float = SUBSCRIPTION_CACHE_TTL, negative_ttl: float = SUBSCRIPTION_NEGATIVE_TTL,
+                 max_entries: int = SUBSCRIPTION_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.logger = logging.getLogger("SubscriptionResolver")
+        # guild_id -> (is_active, expires_at); ordered oldest-used first for LRU eviction
+        self._cache: "OrderedDict[str, Tuple[bool, float]]" = OrderedDict()
+        self._inflight: Dict[str, "asyncio.Future[bool]"] = {}
+
+    def _get_cached(self, key: str) -> Optional[bool]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        is_active, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._cache[key]
+            metrics.increment("subscription.cache_expired")
+            return None
+        self._cache.move_to_end(key)
+        return is_active
+
+    def _store(self, key: str, is_active: bool):
+        ttl = self.ttl if is_active else self.negative_ttl
+        self._cache[key] = (is_active, time.monotonic() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            metrics.increment("subscription.cache_evicted")
+        metrics.set_gauge("subscription.cache_size", len(self._cache))
+
+    @property
+    def refresh_interval(self) -> float:
+        """How often warm_up must run so neither positive nor negative entries expire in between"""
+        return max(5.0, min(self.ttl, self.negative_ttl) * 0.8)
+
+    def invalidate(self, server_id: Union[int, str]):
+        """Drop a cached result, e.g. after the guild leaves or its owner changes"""
+        self._cache.pop(str(server_id), None)
+
+    async def is_paying_user(self, server_id: Union[int, str]) -> bool:
+        """Return True if the server owner has an active subscription"""
+        key = str(server_id)
+        
+        cached = self._get_cached(key)
+        if cached is not None:
+            metrics.increment("subscription.cache_hit")
+            return cached
+        
+        metrics.increment("subscription.cache_miss")
+        
+        pending = self._inflight.get(key)
+        if pending is not None:
+            metrics.increment("subscription.coalesced")
+            return await asyncio.shield(pending)
+        
+        task = asyncio.ensure_future(self._lookup(key))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shield so a cancelled check does not abort the lookup other waiters share
+        return await asyncio.shield(task)
+
+    async def _lookup(self, key: str) -> bool:
+        started = time.perf_counter()
+        try:
+            status = await self._fetch_status(key)
+        except CircuitOpenError:
+            metrics.increment("subscription.lookup_error")
+            raise
+        except Exception as e:
+            metrics.increment("subscription.lookup_error")
+            self.logger.error(f"❌ Database error checking subscription for server {key}: {e}")
+            # Fail safely - assume no subscription if we can't check, but don't cache it
+            return False
+        finally:
+            metrics.observe("subscription.lookup", time.perf_counter() - started)
+        
+        is_active = status == 'active'
+        self._store(key, is_active)
+        self.logger.info(f"📋 Subscription status: '{status}' for server {key} (active: {is_active})", extra=HOT_PATH_LOG)
+        return is_active
+
+    async def warm_up(self, guilds: List[discord.Guild]) -> int:
+        """Preload the subscription status of every connected guild in chunked bulk queries
+        
+        Uses the `get_guild_subscription_statuses` RPC (one joined query per chunk) and
+        falls back to a chunked `guilds` owner query followed by a `subscribers` lookup.
+        Returns the number of guilds loaded into the cache.
+        """
+        if not repository.available or not guilds:
+            return 0
+        
+        if len(guilds) > self.max_entries:
+            self.logger.warning(f"⚠️ {len(guilds)} guilds exceed subscription cache size {self.max_entries}; some checks will miss")
+        
+        started = time.perf_counter()
+        loaded = 0
+        for i in range(0, len(guilds), SUBSCRIPTION_WARMUP_CHUNK):
+            chunk = guilds[i:i + SUBSCRIPTION_WARMUP_CHUNK]
+            try:
+                statuses = await self._fetch_statuses_bulk(chunk)
+            except Exception as e:
+                metrics.increment("subscription.warmup_error")
+                self.logger.error(f"❌ Subscription warm-up failed for chunk {i // SUBSCRIPTION_WARMUP_CHUNK + 1}: {e}")
+                continue
+            
+            for guild in chunk:
+                self._store(str(guild.id), statuses.get(str(guild.id)) == 'active')
+            loaded += len(chunk)
+        
+        elapsed = time.perf_counter() - started
+        metrics.observe("subscription.warmup", elapsed)
+        self.logger.info(f"✅ Subscription cache warmed for {loaded}/{len(guilds)} guilds in {elapsed:.2f}s")
+        return loaded
+
+    async def _fetch_statuses_bulk(self, guilds: List[discord.Guild]) -> Dict[str, Optional[str]]:
+        """Bulk lookup of guild_id -> subscription_status"""
         try:
-            client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-            # Test connection
-            client.table("profiles").select("id").limit(1).execute()
-            logging.info("✅ Supabase connection established")
-            return client
+            return await repository.get_guild_subscription_statuses([str(guild.id) for guild in guilds])
         except Exception as e:
-            logging.warning(f"Supabase connection attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
-            else:
-                logging.error("❌ Failed to connect to Supabase after all retries")
-                return None
+            metrics.increment("subscription.warmup_rpc_fallback")
+            self.logger.warning(f"⚠️ Bulk subscription RPC unavailable, falling back to owner lookup: {e}")
+        
+        # Owners as stored in the guilds table, the same source as the single-guild lookup
+        owners = await repository.get_guild_owners([str(guild.id) for guild in guilds])
+        owner_status = await repository.get_subscription_statuses_by_owner(list(set(owners.values())))
+        return {guild_id: owner_status.get(owner_id) for guild_id, owner_id in owners.items()}
 
-supabase: Optional[Client] = create_supabase_client()
+    async def _fetch_status(self, server_id_str: str) -> Optional[str]:
+        """Guild -> owner -> subscriber lookup
+        
+        IMPORTANT: This ONLY READS from the database - no writes/updates
+        Uses service role key to bypass RLS safely for billing checks
+        """
+        owner_discord_id = await repository.get_guild_owner(server_id_str)
+        if not owner_discord_id:
+            return None
+        return await repository.get_subscription_status(owner_discord_id)
+
+subscription_resolver = SubscriptionResolver()
 
 # Database sync functions
 async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
     """Sync guild information to the database"""
-    if not supabase:
+    if not repository.available:
         logging.error("❌ No Supabase connection available for guild sync")
         return
     
     try:
-        guild_data = {
-            "id": str(guild.id),
-            "name": guild.name,
-            "icon": guild.icon.url if guild.icon else None,
-            "owner_id": str(guild.owner_id),
-            "member_count": guild.member_count,
-            "features": guild.features,
-            "permissions": "0",  # Default permissions
-        }
-        
         if action == "join":
-            # Upsert guild to database
-            result = supabase.table("guilds").upsert(guild_data, on_conflict="id").execute()
-            logging.info(f"✅ Guild {guild.name} synced to database")
+            # Upsert guild to database (always written on a real join, fingerprint refreshed)
+            await guild_syncer.sync_guilds([guild], force=True)
+            logging.info(f"✅ Guild {guild.name} queued for database sync")
             
             # Try to get the actual user who invited the bot from the guild owner
             # In most cases, this will be the guild owner, but we should handle edge cases
@@ -156,7 +881,7 @@ async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
             }
             
             try:
-                invite_result = supabase.table("invite_logs").insert(invite_data).execute()
+                await write_spool.submit("invite_logs", "insert", invite_data)
                 logging.info(f"✅ Bot invite logged successfully for guild {guild.name}")
             except Exception as invite_error:
                 logging.error(f"❌ Failed to log bot invite for guild {guild.name}: {invite_error}")
@@ -164,9 +889,7 @@ async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
             # Update the guild owner's subscriber record if it exists
             try:
                 # Check if the guild owner has a subscriber record
-                subscriber_check = supabase.table("subscribers").select("id, discord_user_id").eq("discord_user_id", str(guild.owner_id)).execute()
-                
-                if subscriber_check.data:
+                if await repository.subscriber_exists(str(guild.owner_id)):
                     logging.info(f"📋 Found subscriber record for guild owner {guild.owner_id}")
                 else:
                     logging.info(f"📋 No subscriber record found for guild owner {guild.owner_id}")
@@ -177,6 +900,7 @@ async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
         elif action == "leave":
             # Log the removal but don't delete guild data for analytics
             logging.info(f"📤 Bot left guild: {guild.name}")
+            await guild_syncer.forget(guild.id)
             
             # Log the bot removal
             leave_data = {
@@ -188,14 +912,18 @@ async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
             }
             
             try:
-                supabase.table("invite_logs").insert(leave_data).execute()
+                await write_spool.submit("invite_logs", "insert", leave_data)
                 logging.info(f"✅ Bot removal logged for guild {guild.name}")
             except Exception as leave_error:
                 logging.error(f"❌ Failed to log bot removal for guild {guild.name}: {leave_error}")
             
             # Update any premium servers to inactive
             try:
-                supabase.table("premium_servers").update({"status": "inactive"}).eq("guild_id", str(guild.id)).execute()
+                await write_spool.submit(
+                    "premium_servers", "update", {"status": "inactive"},
+                    filters={"guild_id": str(guild.id)},
+                    dedupe_key=f"premium_servers:status:{guild.id}"
+                )
                 logging.info(f"✅ Premium server status updated to inactive for guild {guild.name}")
             except Exception as premium_error:
                 logging.error(f"❌ Failed to update premium server status: {premium_error}")
@@ -204,119 +932,792 @@ async def sync_guild_to_database(guild: discord.Guild, action: str = "join"):
         logging.error(f"❌ Error syncing guild {guild.name} to database: {e}")
         logging.error(f"❌ Full error details: {type(e).__name__}: {str(e)}")
 
-async def track_command_usage(user_id: str, guild_id: str, command_name: str, success: bool = True):
-    """Track command usage for analytics"""
-    if not supabase:
-        logging.warning("⚠️ No Supabase connection available for analytics tracking")
-        return
+class LocalStateStore:
+    """SQLite database for bot state that must survive restarts
     
-    try:
-        activity_data = {
-            "user_id": user_id,
-            "guild_id": guild_id,
-            "command_name": command_name,
-            "success": success,
-            "timestamp": datetime.datetime.utcnow().isoformat(),
-            "metadata": {}  # Add any additional metadata here
-        }
-        
-        # Insert activity log
-        result = supabase.table("activity_logs").insert(activity_data).execute()
-        logging.info(f"📊 Command usage tracked: {command_name} in {guild_id} by {user_id} (success: {success})")
-        
-    except Exception as e:
-        logging.error(f"❌ Error tracking command usage: {e}")
-        logging.error(f"❌ Full error details: {type(e).__name__}: {str(e)}")
+    All access runs on a single worker thread, which serializes statements and keeps
+    disk I/O off the event loop. Subsystems register their own tables with `ensure_schema`.
+    """
+    
+    def __init__(self, path: str = BOT_STATE_DB):
+        self.path = path
+        self.logger = logging.getLogger("LocalStateStore")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-state")
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn = conn
+        return self._conn
 
-def is_paying_user(server_id: int) -> bool:
-    """Check if a server has an active subscription by checking the subscribers table
+    async def run(self, fn, *args):
+        """Run `fn(connection, *args)` on the store thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: fn(self._connect(), *args))
+
+    async def ensure_schema(self, ddl: str):
+        def apply(conn: sqlite3.Connection):
+            with conn:
+                conn.executescript(ddl)
+        await self.run(apply)
+
+    async def close(self):
+        def shutdown(conn: sqlite3.Connection):
+            conn.close()
+        if self._conn is not None:
+            await self.run(shutdown)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+local_store = LocalStateStore()
+
+class WriteSpool:
+    """Durable write-ahead spool for Supabase writes
+    
+    Writes are appended to the local store and return immediately; a background task
+    replays them to the backend in batches (one multi-row request per table/op group)
+    while it is healthy, and backs off exponentially while it is not. Writes submitted
+    with a `dedupe_key` replace any pending write with the same key, so repeated
+    idempotent upserts of the same row are sent once.
     
-    IMPORTANT: This function ONLY READS from the database - no writes/updates
-    Uses service role key to bypass RLS safely for billing checks
+    The backend is a pluggable async `sink(table, op, rows, on_conflict, filters)`; it
+    defaults to the Supabase repository, so pointing SUPABASE_URL at a local PostgREST
+    exercises the same replay path.
     """
-    if not supabase:
-        logging.error("❌ No Supabase connection available")
-        return False
     
-    try:
-        # Convert Discord ID to string for database lookup
-        server_id_str = str(server_id)
-        
-        logging.info(f"🔍 Checking subscription for server {server_id_str}")
-        
-        # First, try to find the server owner in the guilds table
-        guild_result = supabase.table("guilds").select("owner_id, user_id").eq("id", server_id_str).execute()
-        
-        if not guild_result.data:
-            logging.info(f"📋 Server {server_id} not found in guilds table")
-            return False
-        
-        guild_data = guild_result.data[0]
-        owner_discord_id = guild_data.get("owner_id")
-        
-        if not owner_discord_id:
-            logging.info(f"📋 No owner found for server {server_id}")
-            return False
-        
-        # Check if the server owner has an active subscription
-        subscriber_result = supabase.table("subscribers").select("subscription_status, discord_user_id").eq("discord_user_id", owner_discord_id).execute()
-        
-        if not subscriber_result.data:
-            logging.info(f"📋 No subscription found for server owner {owner_discord_id}")
-            return False
-        
-        subscriber_data = subscriber_result.data[0]
-        subscription_status = subscriber_data.get("subscription_status", "pending")
-        
-        logging.info(f"📋 Subscription status: '{subscription_status}' for server {server_id} (owner: {owner_discord_id})")
-        
-        is_active = subscription_status == 'active'
-        
-        if is_active:
-            logging.info(f"✅ Server {server_id} has active subscription")
-        else:
-            logging.info(f"❌ Server {server_id} does not have active subscription (status: {subscription_status})")
-        
-        return is_active
-        
-    except Exception as e:
-        logging.error(f"❌ Database error checking subscription for server {server_id}: {e}")
-        # Fail safely - assume no subscription if we can't check
-        return False
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS write_spool (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        on_conflict TEXT,
+        filters TEXT,
+        dedupe_key TEXT UNIQUE,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS write_spool_dead (
+        id INTEGER PRIMARY KEY,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        on_conflict TEXT,
+        filters TEXT,
+        error TEXT,
+        failed_at REAL NOT NULL
+    );
+    """
+    
+    def __init__(self, store: LocalStateStore, sink=None, batch_size: int = WRITE_SPOOL_BATCH_SIZE,
+                 replay_interval: float = WRITE_SPOOL_REPLAY_INTERVAL, max_backoff: float = WRITE_SPOOL_MAX_BACKOFF):
+        self.store = store
+        self.sink = sink or repository.write
+        self.batch_size = batch_size
+        self.replay_interval = replay_interval
+        self.max_backoff = max_backoff
+        self.logger = logging.getLogger("WriteSpool")
+        self.healthy = True
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._ready = False
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
 
-def track_command(func):
-    """Decorator to automatically track command usage"""
-    async def wrapper(self, interaction: discord.Interaction, *args, **kwargs):
-        command_name = func.__name__
-        user_id = str(interaction.user.id)
-        guild_id = str(interaction.guild.id) if interaction.guild else "DM"
+    async def start(self):
+        if self._task and not self._task.done():
+            return
+        await self._ensure_ready()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        pending = await self.pending_count()
+        if pending:
+            self.logger.info(f"📦 Replaying {pending} spooled writes from previous run")
+            self._wakeup.set()
+
+    async def _ensure_ready(self):
+        if not self._ready:
+            await self.store.ensure_schema(self.SCHEMA)
+            self._ready = True
+
+    async def submit(self, table: str, op: str, payload: Dict[str, Any], on_conflict: Optional[str] = None,
+                     filters: Optional[Dict[str, Any]] = None, dedupe_key: Optional[str] = None):
+        """Durably queue one write (op is insert, upsert or update)"""
+        await self.submit_many(table, op, [payload], on_conflict=on_conflict, filters=filters,
+                               dedupe_keys=[dedupe_key] if dedupe_key else None)
+
+    async def submit_many(self, table: str, op: str, rows: List[Dict[str, Any]], on_conflict: Optional[str] = None,
+                          filters: Optional[Dict[str, Any]] = None, dedupe_keys: Optional[List[Optional[str]]] = None):
+        """Durably queue several rows for the same table/op in one local transaction"""
+        if not rows:
+            return
+        await self._ensure_ready()
+        now = time.time()
+        filters_json = json.dumps(filters) if filters else None
+        keys = dedupe_keys or [None] * len(rows)
+        records = [(table, op, json.dumps(row, default=str), on_conflict, filters_json, key, now)
+                   for row, key in zip(rows, keys)]
+        
+        def write(conn: sqlite3.Connection):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO write_spool (table_name, op, payload, on_conflict, filters, dedupe_key, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(dedupe_key) DO UPDATE SET payload = excluded.payload, attempts = 0",
+                    records
+                )
         
-        try:
-            # Execute the command
-            result = await func(self, interaction, *args, **kwargs)
-            
-            # Track successful command usage (only for guild commands)
-            if interaction.guild:
-                await track_command_usage(user_id, guild_id, command_name, success=True)
-            
-            return result
-        except Exception as e:
-            # Track failed command usage (only for guild commands)
-            if interaction.guild:
-                await track_command_usage(user_id, guild_id, command_name, success=False)
-            raise e
-    
-    return wrapper
+        await self.store.run(write)
+        metrics.increment("spool.submitted", len(rows))
+        if self._wakeup and self.healthy:
+            self._wakeup.set()
 
-def ai_subscription_required():
-    """Decorator for AI features - requires active subscription (with limited admin bypass)"""
-    def predicate(interaction: discord.Interaction) -> bool:
-        if not interaction.guild:
+    async def pending_count(self) -> int:
+        def count(conn: sqlite3.Connection) -> int:
+            return conn.execute("SELECT COUNT(*) FROM write_spool").fetchone()[0]
+        return await self.store.run(count)
+
+    async def _run(self):
+        assert self._wakeup is not None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.replay_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if time.monotonic() < self._retry_at:
+                continue
+            try:
+                await self.replay()
+            except Exception as e:
+                self.logger.error(f"❌ Spool replay error: {e}")
+
+    async def replay(self) -> int:
+        """Send pending writes until the spool is empty or the backend fails; returns rows sent"""
+        sent = 0
+        while True:
+            entries = await self.store.run(self._load_batch, self.batch_size)
+            if not entries:
+                break
+            for group in self._group(entries):
+                ok = await self._send_group(group)
+                if not ok:
+                    metrics.set_gauge("spool.pending", await self.pending_count())
+                    return sent
+                sent += len(group)
+        metrics.set_gauge("spool.pending", 0)
+        return sent
+
+    @staticmethod
+    def _load_batch(conn: sqlite3.Connection, limit: int) -> List[sqlite3.Row]:
+        return conn.execute("SELECT * FROM write_spool ORDER BY id LIMIT ?", (limit,)).fetchall()
+
+    @staticmethod
+    def _group(entries: List[sqlite3.Row]) -> List[List[sqlite3.Row]]:
+        """Split entries into consecutive runs that can be sent as one request"""
+        groups: List[List[sqlite3.Row]] = []
+        for entry in entries:
+            key = (entry["table_name"], entry["op"], entry["on_conflict"], entry["filters"])
+            batchable = entry["op"] in ("insert", "upsert")
+            if groups and batchable:
+                last = groups[-1][0]
+                if (last["table_name"], last["op"], last["on_conflict"], last["filters"]) == key:
+                    groups[-1].append(entry)
+                    continue
+            groups.append([entry])
+        return groups
+
+    async def _send_group(self, group: List[sqlite3.Row]) -> bool:
+        first = group[0]
+        rows = [json.loads(entry["payload"]) for entry in group]
+        filters = json.loads(first["filters"]) if first["filters"] else None
+        ids = [entry["id"] for entry in group]
+        started = time.perf_counter()
+        try:
+            await self.sink(first["table_name"], first["op"], rows, first["on_conflict"], filters)
+        except Exception as e:
+            metrics.increment("spool.replay_error")
+            if self._is_rejection(e):
+                # The backend answered but refused the data; isolate bad rows instead of blocking the spool
+                return await self._handle_rejection(group, e)
+            self._mark_unhealthy(e)
+            await self.store.run(self._bump_attempts, ids)
+            return False
+        finally:
+            metrics.observe("spool.replay", time.perf_counter() - started)
+        
+        # Only the payloads that were sent: a row re-submitted meanwhile keeps its id but must stay queued
+        await self.store.run(self._delete, [(entry["id"], entry["payload"]) for entry in group])
+        metrics.increment("spool.replayed", len(ids))
+        if not self.healthy:
+            self.logger.info("✅ Supabase writes recovered, spool draining")
+        self.healthy = True
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        return True
+
+    @staticmethod
+    def _is_rejection(error: Exception) -> bool:
+        """True for errors returned by PostgREST itself (bad payload), False for transport errors"""
+        return type(error).__name__ == "APIError"
+
+    async def _handle_rejection(self, group: List[sqlite3.Row], error: Exception) -> bool:
+        """Dead-letter a rejected row; a rejected batch is re-sent row by row right away so only
+        the bad rows are dead-lettered. False if the backend became unreachable meanwhile."""
+        if len(group) > 1:
+            for entry in group:
+                if not await self._send_group([entry]):
+                    return False
+            return True
+        entry = group[0]
+        self.logger.error(f"❌ Supabase rejected spooled {entry['op']} on {entry['table_name']}, moving to dead letters: {error}")
+        metrics.increment("spool.dead_lettered")
+        await self.store.run(self._dead_letter, entry, str(error))
+        return True
+
+    def _mark_unhealthy(self, error: Exception):
+        self._backoff = min(self.max_backoff, max(self.replay_interval, self._backoff * 2))
+        self._retry_at = time.monotonic() + self._backoff
+        if self.healthy:
+            self.logger.warning(f"⚠️ Supabase writes failing, spooling locally: {error}")
+        self.healthy = False
+        metrics.set_gauge("spool.backoff_seconds", self._backoff)
+
+    @staticmethod
+    def _delete(conn: sqlite3.Connection, sent: List[Tuple[int, str]]):
+        with conn:
+            conn.executemany("DELETE FROM write_spool WHERE id = ? AND payload = ?", sent)
+
+    @staticmethod
+    def _bump_attempts(conn: sqlite3.Connection, ids: List[int]):
+        with conn:
+            conn.executemany("UPDATE write_spool SET attempts = attempts + 1 WHERE id = ?", [(i,) for i in ids])
+
+    @staticmethod
+    def _dead_letter(conn: sqlite3.Connection, entry: sqlite3.Row, error: str):
+        with conn:
+            conn.execute(
+                "INSERT INTO write_spool_dead (id, table_name, op, payload, on_conflict, filters, error, failed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry["id"], entry["table_name"], entry["op"], entry["payload"], entry["on_conflict"],
+                 entry["filters"], error, time.time())
+            )
+            conn.execute("DELETE FROM write_spool WHERE id = ? AND payload = ?", (entry["id"], entry["payload"]))
+
+    async def close(self, timeout: float = 10.0):
+        """Stop replaying, making one last bounded attempt to drain the spool"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._ready and self.healthy:
+            try:
+                await asyncio.wait_for(self.replay(), timeout=timeout)
+            except Exception as e:
+                self.logger.warning(f"⚠️ Spool not fully drained at shutdown, will replay on next start: {e}")
+
+write_spool = WriteSpool(local_store)
+
+class GuildSyncer:
+    """Change-detecting bulk sync of guild metadata to the `guilds` table
+    
+    Each guild's synced fields are fingerprinted and the fingerprint is stored locally
+    once the upsert is spooled. Unchanged guilds are skipped, changed ones are upserted
+    in chunked multi-row requests. Fingerprints older than GUILD_SYNC_MAX_AGE are
+    ignored so rows that never made it to the database are eventually rewritten.
+    
+    Between full syncs, gateway events mark guilds dirty and a debounced flusher syncs
+    the dirty set every `debounce` seconds, so a busy guild costs at most one write per
+    interval no matter how many member joins/leaves it sees.
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS guild_fingerprints (
+        guild_id TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        synced_at REAL NOT NULL
+    );
+    """
+    
+    def __init__(self, store: LocalStateStore, chunk_size: int = GUILD_SYNC_CHUNK, max_age: float = GUILD_SYNC_MAX_AGE,
+                 debounce: float = GUILD_SYNC_DEBOUNCE):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.max_age = max_age
+        self.debounce = debounce
+        self.logger = logging.getLogger("GuildSyncer")
+        self._ready = False
+        self._dirty: Dict[int, discord.Guild] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the debounced flusher for incremental updates"""
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def mark_dirty(self, guild: discord.Guild):
+        """Schedule a guild for the next incremental flush (repeated marks coalesce)"""
+        if guild.id not in self._dirty:
+            metrics.increment("guild_sync.marked_dirty")
+        else:
+            metrics.increment("guild_sync.coalesced")
+        self._dirty[guild.id] = guild
+        metrics.set_gauge("guild_sync.dirty", len(self._dirty))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.debounce)
+            try:
+                await self.flush_dirty()
+            except Exception as e:
+                self.logger.error(f"❌ Incremental guild sync failed: {e}")
+
+    async def flush_dirty(self) -> int:
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        metrics.set_gauge("guild_sync.dirty", 0)
+        try:
+            return await self.sync_guilds(list(dirty.values()))
+        except Exception:
+            # Put them back so the next interval retries, unless newer marks replaced them
+            for guild_id, guild in dirty.items():
+                self._dirty.setdefault(guild_id, guild)
+            raise
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_dirty()
+
+    async def _ensure_ready(self):
+        if not self._ready:
+            await self.store.ensure_schema(self.SCHEMA)
+            self._ready = True
+
+    @staticmethod
+    def guild_row(guild: discord.Guild) -> Dict[str, Any]:
+        return {
+            "id": str(guild.id),
+            "name": guild.name,
+            "icon": guild.icon.url if guild.icon else None,
+            "owner_id": str(guild.owner_id),
+            "member_count": guild.member_count,
+            "features": guild.features,
+            "permissions": "0",  # Default permissions
+        }
+
+    @staticmethod
+    def fingerprint(row: Dict[str, Any]) -> str:
+        canonical = dict(row, features=sorted(row.get("features") or []))
+        return hashlib.sha1(json.dumps(canonical, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def sync_guilds(self, guilds: List[discord.Guild], force: bool = False) -> int:
+        """Upsert guilds whose synced fields changed; returns the number written"""
+        if not guilds or not repository.available:
+            # Nothing would ever drain the spool, so don't fill it (or the fingerprints)
+            return 0
+        await self._ensure_ready()
+        
+        started = time.perf_counter()
+        rows = [self.guild_row(guild) for guild in guilds]
+        fingerprints = {row["id"]: self.fingerprint(row) for row in rows}
+        known = {} if force else await self.store.run(self._load_fingerprints, list(fingerprints))
+        cutoff = time.time() - self.max_age
+        
+        changed = [
+            row for row in rows
+            if force or known.get(row["id"], (None, 0.0))[0] != fingerprints[row["id"]]
+            or known[row["id"]][1] < cutoff
+        ]
+        
+        for i in range(0, len(changed), self.chunk_size):
+            chunk = changed[i:i + self.chunk_size]
+            await write_spool.submit_many(
+                "guilds", "upsert", chunk, on_conflict="id",
+                dedupe_keys=[f"guilds:{row['id']}" for row in chunk]
+            )
+            await self.store.run(self._save_fingerprints, [(row["id"], fingerprints[row["id"]]) for row in chunk])
+        
+        metrics.increment("guild_sync.written", len(changed))
+        metrics.increment("guild_sync.skipped", len(rows) - len(changed))
+        metrics.observe("guild_sync.batch", time.perf_counter() - started)
+        self.logger.debug(f"Guild sync: {len(changed)} changed, {len(rows) - len(changed)} unchanged")
+        return len(changed)
+
+    async def forget(self, guild_id: Union[int, str]):
+        self._dirty.pop(int(guild_id), None)
+        def delete(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("DELETE FROM guild_fingerprints WHERE guild_id = ?", (str(guild_id),))
+        await self._ensure_ready()
+        await self.store.run(delete)
+
+    @staticmethod
+    def _load_fingerprints(conn: sqlite3.Connection, guild_ids: List[str]) -> Dict[str, Tuple[str, float]]:
+        known: Dict[str, Tuple[str, float]] = {}
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(guild_ids), 500):
+            chunk = guild_ids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            for row in conn.execute(
+                f"SELECT guild_id, fingerprint, synced_at FROM guild_fingerprints WHERE guild_id IN ({placeholders})",
+                chunk
+            ):
+                known[row["guild_id"]] = (row["fingerprint"], row["synced_at"])
+        return known
+
+    @staticmethod
+    def _save_fingerprints(conn: sqlite3.Connection, entries: List[Tuple[str, str]]):
+        now = time.time()
+        with conn:
+            conn.executemany(
+                "INSERT INTO guild_fingerprints (guild_id, fingerprint, synced_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(guild_id) DO UPDATE SET fingerprint = excluded.fingerprint, synced_at = excluded.synced_at",
+                [(guild_id, fingerprint, now) for guild_id, fingerprint in entries]
+            )
+
+guild_syncer = GuildSyncer(local_store)
+
+class Job:
+    """A persisted structure job: what it was asked to do and which steps are complete
+    
+    `steps` maps a step key to (status, Discord ID). Steps are checkpointed one by one as
+    they complete, so a job interrupted by a restart can be resumed without redoing them.
+    Without a store the job is tracked in memory only, and a failing store is logged and
+    otherwise ignored: losing a checkpoint must never fail the command itself.
+    """
+    
+    def __init__(self, store: Optional["JobStore"], job_id: int, kind: str, guild_id: int, channel_id: Optional[int],
+                 params: Dict[str, Any], steps: Optional[Dict[str, Tuple[str, Optional[int]]]] = None):
+        self.store = store
+        self.id = job_id
+        self.kind = kind
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.params = params
+        self.steps: Dict[str, Tuple[str, Optional[int]]] = steps or {}
+
+    def done(self, key: str) -> bool:
+        return self.steps.get(key, ("", None))[0] == "done"
+
+    def discord_ids(self) -> Dict[str, int]:
+        """Step key -> Discord ID of everything this job already created"""
+        return {key: discord_id for key, (status, discord_id) in self.steps.items()
+                if status == "done" and discord_id is not None}
+
+    def pending(self) -> List[Tuple[str, Optional[int]]]:
+        return [(key, discord_id) for key, (status, discord_id) in self.steps.items() if status == "pending"]
+
+    async def _persist(self, action: str, write: Callable[["JobStore"], Any]):
+        if not self.store:
+            return
+        try:
+            await write(self.store)
+        except Exception as e:
+            metrics.increment("jobs.persist_error")
+            logging.getLogger("JobStore").error(f"❌ Could not {action} for {self.kind} job {self.id}, continuing without it: {e}")
+
+    async def checkpoint(self, key: str, discord_id: Optional[int] = None, status: str = "done"):
+        self.steps[key] = (status, discord_id)
+        await self._persist("checkpoint a step", lambda store: store.record_steps(self.id, [(key, discord_id)], status))
+
+    async def add_steps(self, entries: List[Tuple[str, Optional[int]]]):
+        """Register planned steps as pending, in the order they should run"""
+        for key, discord_id in entries:
+            self.steps.setdefault(key, ("pending", discord_id))
+        await self._persist("record planned steps", lambda store: store.record_steps(self.id, entries, "pending"))
+
+    async def update_params(self, **params):
+        self.params.update(params)
+        await self._persist("save parameters", lambda store: store.save_params(self.id, self.params))
+
+    async def finish(self, status: str = "done", error: Optional[str] = None):
+        metrics.increment(f"jobs.{self.kind}.{status}")
+        await self._persist("mark it finished", lambda store: store.finish(self.id, status, error))
+
+class JobStore:
+    """Local-store persistence for long-running structure jobs and their checkpoints
+    
+    Jobs stay `running` until finished, so anything still running at startup was
+    interrupted and is handed back by `unfinished` for resumption.
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        guild_id TEXT NOT NULL,
+        channel_id TEXT,
+        params TEXT NOT NULL,
+        status TEXT NOT NULL,
+        error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status);
+    CREATE TABLE IF NOT EXISTS job_steps (
+        job_id INTEGER NOT NULL,
+        step_key TEXT NOT NULL,
+        discord_id TEXT,
+        status TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (job_id, step_key)
+    );
+    """
+    
+    def __init__(self, store: LocalStateStore, retention_days: float = JOB_RETENTION_DAYS):
+        self.store = store
+        self.retention = retention_days * 86400
+        self.logger = logging.getLogger("JobStore")
+        self._ready = False
+
+    async def _ensure_ready(self):
+        if not self._ready:
+            await self.store.ensure_schema(self.SCHEMA)
+            self._ready = True
+
+    async def create(self, kind: str, guild_id: int, channel_id: Optional[int], params: Dict[str, Any]) -> Job:
+        """Persist a new running job; falls back to an in-memory job if the store is unavailable"""
+        now = time.time()
+        
+        def insert(conn: sqlite3.Connection) -> int:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO jobs (kind, guild_id, channel_id, params, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'running', ?, ?)",
+                    (kind, str(guild_id), str(channel_id) if channel_id else None, json.dumps(params, default=str), now, now)
+                )
+                return int(cursor.lastrowid or 0)
+        
+        try:
+            await self._ensure_ready()
+            job_id = await self.store.run(insert)
+        except Exception as e:
+            self.logger.error(f"❌ Could not persist {kind} job, running without checkpoints: {e}")
+            return Job(None, 0, kind, guild_id, channel_id, params)
+        metrics.increment(f"jobs.{kind}.started")
+        return Job(self, job_id, kind, guild_id, channel_id, params)
+
+    async def record_steps(self, job_id: int, entries: List[Tuple[str, Optional[int]]], status: str):
+        now = time.time()
+        rows = [(job_id, key, str(discord_id) if discord_id is not None else None, status, now) for key, discord_id in entries]
+        
+        def write(conn: sqlite3.Connection):
+            with conn:
+                conn.executemany(
+                    "INSERT INTO job_steps (job_id, step_key, discord_id, status, updated_at) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(job_id, step_key) DO UPDATE SET discord_id = COALESCE(excluded.discord_id, discord_id), "
+                    "status = excluded.status, updated_at = excluded.updated_at",
+                    rows
+                )
+                conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, job_id))
+        
+        await self.store.run(write)
+
+    async def save_params(self, job_id: int, params: Dict[str, Any]):
+        def write(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("UPDATE jobs SET params = ?, updated_at = ? WHERE id = ?",
+                             (json.dumps(params, default=str), time.time(), job_id))
+        await self.store.run(write)
+
+    async def finish(self, job_id: int, status: str, error: Optional[str] = None):
+        def write(conn: sqlite3.Connection):
+            with conn:
+                conn.execute("UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                             (status, error, time.time(), job_id))
+        await self.store.run(write)
+
+    async def unfinished(self) -> List[Job]:
+        """Jobs interrupted by a restart, with their steps; also drops old finished jobs"""
+        await self._ensure_ready()
+        cutoff = time.time() - self.retention
+        
+        def load(conn: sqlite3.Connection) -> List[Tuple[sqlite3.Row, List[sqlite3.Row]]]:
+            with conn:
+                conn.execute("DELETE FROM job_steps WHERE job_id IN (SELECT id FROM jobs WHERE status != 'running' AND updated_at < ?)", (cutoff,))
+                conn.execute("DELETE FROM jobs WHERE status != 'running' AND updated_at < ?", (cutoff,))
+            jobs = conn.execute("SELECT * FROM jobs WHERE status = 'running' ORDER BY id").fetchall()
+            return [
+                (job, conn.execute("SELECT step_key, discord_id, status FROM job_steps WHERE job_id = ? ORDER BY rowid",
+                                   (job["id"],)).fetchall())
+                for job in jobs
+            ]
+        
+        jobs = []
+        for row, steps in await self.store.run(load):
+            jobs.append(Job(
+                self, row["id"], row["kind"], int(row["guild_id"]),
+                int(row["channel_id"]) if row["channel_id"] else None, json.loads(row["params"]),
+                {step["step_key"]: (step["status"], int(step["discord_id"]) if step["discord_id"] else None) for step in steps}
+            ))
+        return jobs
+
+job_store = JobStore(local_store)
+
+class ActivityLogBatcher:
+    """Buffers activity_logs rows in memory and writes them as multi-row inserts
+    
+    Rows are flushed when `batch_size` rows are pending or every `flush_interval`
+    seconds, whichever comes first. The buffer is bounded; when it is full the oldest
+    row is dropped and counted so command handling never waits on analytics. A batch
+    whose flush fails or is cancelled goes back to the front of the buffer.
+    """
+    
+    def __init__(self, max_queue: int = ACTIVITY_LOG_QUEUE_SIZE, batch_size: int = ACTIVITY_LOG_BATCH_SIZE,
+                 flush_interval: float = ACTIVITY_LOG_FLUSH_INTERVAL):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logger = logging.getLogger("ActivityLogBatcher")
+        self._buffer: deque = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the background flusher (must be called from the running event loop)"""
+        if self._task and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, row: Dict[str, Any]):
+        """Queue a row without blocking; drops the oldest row if the buffer is full"""
+        if len(self._buffer) >= self.max_queue:
+            self._buffer.popleft()
+            metrics.increment("activity_logs.dropped")
+        self._buffer.append(row)
+        metrics.increment("activity_logs.enqueued")
+        metrics.set_gauge("activity_logs.queue_depth", len(self._buffer))
+        if len(self._buffer) >= self.batch_size and self._wakeup:
+            self._wakeup.set()
+
+    async def _run(self):
+        assert self._wakeup is not None
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write all buffered rows, one multi-row insert per batch"""
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            metrics.set_gauge("activity_logs.queue_depth", len(self._buffer))
+            started = time.perf_counter()
+            try:
+                # The spool sends each batch as one multi-row insert and keeps it through outages
+                await write_spool.submit_many("activity_logs", "insert", batch)
+                metrics.increment("activity_logs.flushed", len(batch))
+                metrics.increment("activity_logs.batches")
+                self.logger.debug(f"📊 Flushed {len(batch)} activity log rows")
+            except BaseException as e:
+                # Put the batch back in front so the next flush (or close) retries it
+                self._buffer.extendleft(reversed(batch))
+                while len(self._buffer) > self.max_queue:
+                    self._buffer.popleft()
+                    metrics.increment("activity_logs.dropped")
+                metrics.set_gauge("activity_logs.queue_depth", len(self._buffer))
+                if not isinstance(e, Exception):
+                    raise
+                metrics.increment("activity_logs.failed", len(batch))
+                self.logger.error(f"❌ Failed to flush {len(batch)} activity log rows, keeping them for the next flush: {e}")
+                return
+            finally:
+                metrics.observe("activity_logs.flush", time.perf_counter() - started)
+
+    async def close(self):
+        """Stop the flusher and write whatever is still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+activity_log_batcher = ActivityLogBatcher()
+
+async def track_command_usage(user_id: str, guild_id: str, command_name: str, success: bool = True):
+    """Track command usage for analytics (buffered, written in batches)"""
+    if not repository.available:
+        logging.warning("⚠️ No Supabase connection available for analytics tracking")
+        return
+    
+    activity_log_batcher.enqueue({
+        "user_id": user_id,
+        "guild_id": guild_id,
+        "command_name": command_name,
+        "success": success,
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "metadata": {}  # Add any additional metadata here
+    })
+
+async def is_paying_user(server_id: int) -> bool:
+    """Check if a server has an active subscription
+    
+    Served from the SubscriptionResolver cache; only cache misses reach the database.
+    """
+    if not repository.available:
+        logging.error("❌ No Supabase connection available")
+        return False
+    
+    return await subscription_resolver.is_paying_user(server_id)
+
+def track_command(func):
+    """Decorator to automatically track command usage"""
+    async def wrapper(self, interaction: discord.Interaction, *args, **kwargs):
+        command_name = func.__name__
+        user_id = str(interaction.user.id)
+        guild_id = str(interaction.guild.id) if interaction.guild else "DM"
+        
+        try:
+            # Execute the command
+            result = await func(self, interaction, *args, **kwargs)
+            
+            # Track successful command usage (only for guild commands)
+            if interaction.guild:
+                await track_command_usage(user_id, guild_id, command_name, success=True)
+            
+            return result
+        except Exception as e:
+            # Track failed command usage (only for guild commands)
+            if interaction.guild:
+                await track_command_usage(user_id, guild_id, command_name, success=False)
+            raise e
+    
+    return wrapper
+
+def ai_subscription_required():
+    """Decorator for AI features - requires active subscription (with limited admin bypass)"""
+    async def predicate(interaction: discord.Interaction) -> bool:
+        if not interaction.guild:
             raise app_commands.AppCommandError("❌ This command can only be used in servers.")
         
         # Check subscription status - NO BYPASSES for proper security
         server_id = interaction.guild.id
-        if not is_paying_user(server_id):
+        try:
+            is_paying = await is_paying_user(server_id)
+        except CircuitOpenError as e:
+            raise app_commands.AppCommandError(str(e))
+        if not is_paying:
             raise app_commands.AppCommandError(
                 "🤖 **AI Features Require Subscription**\n\n"
                 "This command uses AI features and requires an active subscription.\n\n"
@@ -330,63 +1731,2344 @@ def ai_subscription_required():
         return True
     return app_commands.check(predicate)
 
-class AIService:
-    """AI service with improved error handling and rate limiting"""
+class TokenBucket:
+    """Continuously refilling token bucket for async callers
     
-    def __init__(self, api_key: Optional[str]):
-        self.client = OpenAI(api_key=api_key) if api_key else None
-        self.logger = logging.getLogger("AIService")
-        self.last_request_time = 0
-        self.min_request_interval = 1.0  # Minimum seconds between requests
+    `acquire` reserves tokens immediately (the balance may go negative) and sleeps until
+    the reservation is covered, so waiters are served in arrival order.
+    """
+    
+    def __init__(self, capacity: float, per_minute: float):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        self._refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            try:
+                await asyncio.sleep(-self.tokens / self.rate)
+            except asyncio.CancelledError:
+                self.tokens += amount
+                raise
+
+    def try_acquire(self, amount: float = 1.0) -> bool:
+        """Take tokens only if they are available right now"""
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def refund(self, amount: float):
+        """Return unused tokens, e.g. when actual usage was below the estimate"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class AIResponseCache:
+    """Two-tier cache of complete AI responses keyed by a hash of the request
+    
+    The key covers model, system prompt, user prompt and temperature, so any change to
+    the prompt or generation settings is a different entry. A small in-memory LRU sits
+    in front of a SQLite tier in the local state store that survives restarts. Both tiers
+    expire entries after `ttl` seconds and evict least recently used entries when full.
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS ai_response_cache (
+        key TEXT PRIMARY KEY,
+        content TEXT NOT NULL,
+        tokens INTEGER NOT NULL DEFAULT 0,
+        expires_at REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_ai_response_cache_last_used ON ai_response_cache(last_used);
+    """
+    
+    def __init__(self, store: LocalStateStore, ttl: float = AI_CACHE_TTL, memory_entries: int = AI_CACHE_MEMORY_ENTRIES,
+                 disk_entries: int = AI_CACHE_DISK_ENTRIES):
+        self.store = store
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.logger = logging.getLogger("AIResponseCache")
+        # key -> (content, tokens, expires_at)
+        self._memory: "OrderedDict[str, Tuple[str, int, float]]" = OrderedDict()
+        self._ready = False
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, user_prompt: str, temperature: float) -> str:
+        payload = json.dumps([model, system_prompt, user_prompt, temperature], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def _ensure_ready(self):
+        if not self._ready:
+            await self.store.ensure_schema(self.SCHEMA)
+            self._ready = True
 
-    async def generate_response(self, system_prompt: str, user_prompt: str, max_retries: int = 3) -> Optional[str]:
-        """Generate AI response with rate limiting and retries"""
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            content, tokens, expires_at = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                metrics.increment("ai_cache.hit_memory")
+                metrics.increment("ai_cache.saved_tokens", tokens)
+                return content
+            del self._memory[key]
         
-        if not self.client:
-            self.logger.error("❌ OpenAI client not initialized")
+        try:
+            await self._ensure_ready()
+            row = await self.store.run(self._load, key, now)
+        except Exception as e:
+            self.logger.warning(f"⚠️ AI cache lookup failed: {e}")
+            row = None
+        
+        if row is None:
+            metrics.increment("ai_cache.miss")
             return None
         
-        # Rate limiting
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
-        if time_since_last < self.min_request_interval:
-            await asyncio.sleep(self.min_request_interval - time_since_last)
+        content, tokens, expires_at = row
+        self._remember(key, content, tokens, expires_at)
+        metrics.increment("ai_cache.hit_disk")
+        metrics.increment("ai_cache.saved_tokens", tokens)
+        return content
+
+    async def put(self, key: str, content: str, tokens: int):
+        expires_at = time.time() + self.ttl
+        self._remember(key, content, tokens, expires_at)
+        try:
+            await self._ensure_ready()
+            await self.store.run(self._save, key, content, tokens, expires_at, self.disk_entries)
+        except Exception as e:
+            self.logger.warning(f"⚠️ AI cache write failed: {e}")
+
+    def _remember(self, key: str, content: str, tokens: int, expires_at: float):
+        self._memory[key] = (content, tokens, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+        metrics.set_gauge("ai_cache.memory_entries", len(self._memory))
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection, key: str, now: float) -> Optional[Tuple[str, int, float]]:
+        row = conn.execute(
+            "SELECT content, tokens, expires_at FROM ai_response_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute("UPDATE ai_response_cache SET last_used = ? WHERE key = ?", (now, key))
+        return row["content"], row["tokens"], row["expires_at"]
+
+    @staticmethod
+    def _save(conn: sqlite3.Connection, key: str, content: str, tokens: int, expires_at: float, max_entries: int):
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT INTO ai_response_cache (key, content, tokens, expires_at, last_used) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET content = excluded.content, tokens = excluded.tokens, "
+                "expires_at = excluded.expires_at, last_used = excluded.last_used",
+                (key, content, tokens, expires_at, now)
+            )
+            conn.execute("DELETE FROM ai_response_cache WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "DELETE FROM ai_response_cache WHERE key IN ("
+                "SELECT key FROM ai_response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max_entries,)
+            )
+
+class AIOutputError(Exception):
+    """AI output could not be parsed into the expected schema"""
+
+# Output schemas use a small JSON Schema subset: type, properties, required, items, enum, default
+BLUEPRINT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "required": ["categories"],
+    "properties": {
+        "categories": {"type": "array", "items": {
+            "type": "object",
+            "required": ["name"],
+            "properties": {
+                "name": {"type": "string"},
+                "channels": {"type": "array", "items": {
+                    "type": "object",
+                    "required": ["name"],
+                    "properties": {
+                        "name": {"type": "string"},
+                        "type": {"type": "string", "enum": ["text", "voice"], "default": "text"}
+                    }
+                }}
+            }
+        }},
+        "roles": {"type": "array", "items": {
+            "type": "object",
+            "required": ["name"],
+            "properties": {
+                "name": {"type": "string"},
+                "color": {"type": "string", "default": "#99aab5"}
+            }
+        }},
+        "welcome_message": {"type": "string"},
+        "rules": {"type": "array", "items": {"type": "string"}}
+    }
+}
+
+EMBED_CONTENT_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "welcome_message": {"type": "string"},
+        "rules": {"type": "array", "items": {"type": "string"}}
+    }
+}
+
+CHANNEL_NAMES_SCHEMA: Dict[str, Any] = {"type": "array", "items": {"type": "string"}}
+
+CLEANUP_PLAN_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "issues": {"type": "array", "items": {
+            "type": "object",
+            "required": ["type", "description", "current_state", "proposed_solution"],
+            "properties": {
+                "type": {"type": "string"},
+                "severity": {"type": "string", "enum": ["low", "medium", "high"], "default": "low"},
+                "description": {"type": "string"},
+                "current_state": {"type": "string"},
+                "proposed_solution": {"type": "string"},
+                "affected_items": {"type": "array", "items": {"type": "string"}},
+                "auto_fixable": {"type": "boolean", "default": False}
+            }
+        }},
+        "optimization_suggestions": {"type": "array", "items": {
+            "type": "object",
+            "required": ["suggestion"],
+            "properties": {
+                "category": {"type": "string"},
+                "suggestion": {"type": "string"},
+                "benefits": {"type": "string"},
+                "requires_confirmation": {"type": "boolean", "default": True}
+            }
+        }}
+    }
+}
+
+class AIOutputParser:
+    """Tolerant extraction, repair and schema validation of JSON model output
+    
+    Accepts markdown fences and surrounding prose, trailing commas and Python literals.
+    Truncated output is cut back to the last complete element and closed. Invalid array
+    items are dropped and invalid optional fields fall back to their default, so one bad
+    element does not fail the whole document.
+    """
+    
+    FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.S)
+    PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+    MAX_REPAIR_ATTEMPTS = 50
+
+    @classmethod
+    def extract(cls, text: str) -> Optional[str]:
+        """Strip fences and leading prose, returning text from the first bracket on"""
+        fenced = cls.FENCE.search(text)
+        if fenced:
+            text = fenced.group(1)
+        starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+        return text[min(starts):] if starts else None
+
+    @classmethod
+    def normalize(cls, text: str) -> str:
+        """Drop trailing commas and translate Python literals outside of strings"""
+        out: List[str] = []
+        in_string = escape = False
+        i = 0
+        while i < len(text):
+            char = text[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif char == "\\":
+                    escape = True
+                elif char == '"':
+                    in_string = False
+                out.append(char)
+            elif char == '"':
+                in_string = True
+                out.append(char)
+            elif char == ",":
+                j = i + 1
+                while j < len(text) and text[j].isspace():
+                    j += 1
+                if j >= len(text) or text[j] not in "}]":
+                    out.append(char)
+            elif char.isalpha():
+                j = i
+                while j < len(text) and text[j].isalpha():
+                    j += 1
+                word = text[i:j]
+                out.append(cls.PYTHON_LITERALS.get(word, word))
+                i = j
+                continue
+            else:
+                out.append(char)
+            i += 1
+        return "".join(out)
+
+    @staticmethod
+    def _scan(text: str) -> Tuple[int, List[Tuple[int, str]]]:
+        """Return the end of the first complete value (-1 if truncated) and repair cut points
         
-        self.last_request_time = time.time()
+        Each cut point is a prefix length and the closers that make that prefix valid.
+        """
+        stack: List[str] = []
+        cuts: List[Tuple[int, str]] = []
+        in_string = escape = False
+        for i, char in enumerate(text):
+            if in_string:
+                if escape:
+                    escape = False
+                elif char == "\\":
+                    escape = True
+                elif char == '"':
+                    in_string = False
+                continue
+            if char == '"':
+                in_string = True
+            elif char in "{[":
+                stack.append("}" if char == "{" else "]")
+                cuts.append((i + 1, "".join(reversed(stack))))
+            elif char in "}]":
+                if stack:
+                    stack.pop()
+                if not stack:
+                    return i + 1, cuts
+                cuts.append((i + 1, "".join(reversed(stack))))
+            elif char == "," and stack:
+                cuts.append((i, "".join(reversed(stack))))
+        return -1, cuts
+
+    @classmethod
+    def is_complete(cls, text: str) -> bool:
+        body = cls.extract(text or "")
+        return body is not None and cls._scan(cls.normalize(body))[0] >= 0
+
+    @classmethod
+    def parse(cls, text: str, schema: Dict[str, Any]) -> Tuple[Any, bool]:
+        """Parse `text` against `schema`, returning (value, was_truncated)"""
+        body = cls.extract(text or "")
+        if body is None:
+            raise AIOutputError("no JSON found in AI output")
+        body = cls.normalize(body)
+        end, cuts = cls._scan(body)
+        if end >= 0:
+            try:
+                return cls.validate(json.loads(body[:end]), schema), False
+            except json.JSONDecodeError as e:
+                raise AIOutputError(f"malformed JSON: {e}")
         
-        for attempt in range(max_retries):
+        for position, closers in reversed(cuts[-cls.MAX_REPAIR_ATTEMPTS:]):
             try:
-                self.logger.info(f"AI request attempt {attempt + 1}/{max_retries}")
-                
-                response = await asyncio.to_thread(
-                    self.client.chat.completions.create,
-                    model="gpt-4o-mini",  # Use a reliable model
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=2000,
-                    timeout=30.0  # 30 second timeout
-                )
-                
-                content = response.choices[0].message.content
-                if content:
-                    self.logger.info("✅ AI response received")
-                    return content
-                else:
-                    self.logger.warning("⚠️ Empty AI response")
-                    
-            except asyncio.TimeoutError:
-                self.logger.warning(f"AI request timeout on attempt {attempt + 1}")
-            except Exception as e:
-                self.logger.error(f"AI request failed on attempt {attempt + 1}: {e}")
-                
-            if attempt < max_retries - 1:
-                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+                value = json.loads(body[:position] + closers)
+            except json.JSONDecodeError:
+                continue
+            return cls.validate(value, schema), True
+        raise AIOutputError("truncated AI output could not be repaired")
+
+    @classmethod
+    def validate(cls, value: Any, schema: Dict[str, Any], path: str = "$") -> Any:
+        """Check `value` against `schema`, coercing scalars and filling defaults"""
+        expected = schema.get("type")
+        if expected == "object":
+            if not isinstance(value, dict):
+                raise AIOutputError(f"{path}: expected object")
+            result = dict(value)
+            required = schema.get("required", [])
+            for key, subschema in schema.get("properties", {}).items():
+                if key in value:
+                    try:
+                        result[key] = cls.validate(value[key], subschema, f"{path}.{key}")
+                        continue
+                    except AIOutputError:
+                        if key in required:
+                            raise
+                        del result[key]
+                if "default" in subschema:
+                    result[key] = subschema["default"]
+                elif key in required:
+                    raise AIOutputError(f"{path}: missing {key}")
+            return result
+        
+        if expected == "array":
+            if not isinstance(value, list):
+                raise AIOutputError(f"{path}: expected array")
+            items = schema.get("items")
+            if not items:
+                return value
+            valid = []
+            for i, item in enumerate(value):
+                try:
+                    valid.append(cls.validate(item, items, f"{path}[{i}]"))
+                except AIOutputError:
+                    metrics.increment("ai.parse_dropped_item")
+            return valid
+        
+        if expected == "string":
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = str(value)
+            if not isinstance(value, str):
+                raise AIOutputError(f"{path}: expected string")
+            value = value.strip()
+            if "enum" in schema and value.lower() not in schema["enum"]:
+                raise AIOutputError(f"{path}: {value!r} not one of {schema['enum']}")
+            return value.lower() if "enum" in schema else value
+        
+        if expected == "boolean":
+            if isinstance(value, str) and value.lower() in ("true", "false"):
+                return value.lower() == "true"
+            if not isinstance(value, bool):
+                raise AIOutputError(f"{path}: expected boolean")
+        return value
+
+class PromptEncoder:
+    """Compact encoding of structured prompt data, with token counting
+    
+    Keys are shortened (with a legend for the aliases actually used), indentation is
+    dropped, null/false/empty values are omitted and long string values that repeat are
+    replaced with references into a shared table. Names are never replaced so the model
+    can quote them back exactly.
+    """
+    
+    KEY_ALIASES = {
+        "name": "n", "position": "p", "permissions": "pm", "color": "c", "mentionable": "m",
+        "hoist": "h", "member_count": "mc", "channels": "ch", "categories": "cats", "roles": "r",
+        "overwrites": "o", "type": "t", "topic": "tp", "nsfw": "ns", "category": "cat",
+        "permission_analysis": "pa", "issues": "is", "issue": "i", "details": "d",
+        "server_name": "sn", "structure_issues": "si", "naming_patterns": "np", "usage_patterns": "up"
+    }
+    VERBATIM_KEYS = {"name", "server_name", "channel"}
+    DROP_KEYS = {"full_name"}
+    MIN_REF_LENGTH = 12
+
+    def __init__(self, model: str = AI_MODEL):
+        self.model = model
+        self._encoding: Any = None
+        self._encoding_loaded = False
+
+    def count_tokens(self, text: str) -> int:
+        """Exact count with tiktoken when available, otherwise the ~4 chars/token estimate"""
+        if not self._encoding_loaded:
+            self._encoding_loaded = True
+            if tiktoken is not None:
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model)
+                except Exception:
+                    try:
+                        self._encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception:
+                        self._encoding = None
+        if self._encoding is not None:
+            return len(self._encoding.encode(text))
+        return len(text) // 4 + 1
+
+    def encode(self, data: Any) -> str:
+        counts: "Counter[str]" = Counter()
+        self._count_strings(data, counts)
+        refs = {value: f"@{i}" for i, value in enumerate(
+            v for v, n in counts.items() if n > 1 and len(v) >= self.MIN_REF_LENGTH
+        )}
+        used_keys: set = set()
+        body = json.dumps(self._compact(data, refs, used_keys), separators=(",", ":"), ensure_ascii=False)
+        
+        lines = []
+        if used_keys:
+            lines.append("Keys: " + ",".join(f"{self.KEY_ALIASES[k]}={k}" for k in sorted(used_keys)))
+        if refs:
+            lines.append("Refs: " + json.dumps({ref: value for value, ref in refs.items()}, separators=(",", ":"), ensure_ascii=False))
+        lines.append(body)
+        return "\n".join(lines)
+
+    def _count_strings(self, value: Any, counts: "Counter[str]", key: Optional[str] = None):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                if k not in self.DROP_KEYS:
+                    self._count_strings(v, counts, k)
+        elif isinstance(value, list):
+            for item in value:
+                self._count_strings(item, counts, key)
+        elif isinstance(value, str) and key not in self.VERBATIM_KEYS:
+            counts[value] += 1
+
+    def _compact(self, value: Any, refs: Dict[str, str], used_keys: set, key: Optional[str] = None) -> Any:
+        if isinstance(value, dict):
+            compact = {}
+            for k, v in value.items():
+                if k in self.DROP_KEYS or v is None or v is False or v == "" or v == [] or v == {}:
+                    continue
+                if k in self.KEY_ALIASES:
+                    used_keys.add(k)
+                compact[self.KEY_ALIASES.get(k, k)] = self._compact(v, refs, used_keys, k)
+            return compact
+        if isinstance(value, list):
+            return [self._compact(item, refs, used_keys, key) for item in value]
+        if isinstance(value, str) and key not in self.VERBATIM_KEYS:
+            return refs.get(value, value)
+        return value
+
+prompt_encoder = PromptEncoder()
+
+class AIFixtureMissing(Exception):
+    """Replay mode has no recorded response for a request"""
+
+class RecordReplayBackend:
+    """Captures AI responses to fixture files and replays them without network access
+    
+    In record mode every live completion (streamed or not) is written to
+    `<directory>/<request hash>.json` with its content, usage, latency and stream chunk
+    timings. In replay mode those files are served instead of calling OpenAI, delayed
+    according to `latency`:
+    
+    - recorded: the recorded latency (default)
+    - none: no delay
+    - fixed:SECONDS, scale:FACTOR (times the recorded latency)
+    - uniform:LOW,HIGH, normal:MEAN,STDDEV, lognormal:MEDIAN,SIGMA
+    
+    Replayed streams keep their recorded chunk timing, scaled to the sampled latency.
+    """
+    
+    MODES = ("live", "record", "replay")
+    
+    def __init__(self, mode: str = AI_BACKEND_MODE, directory: str = AI_FIXTURES_DIR,
+                 latency: str = AI_REPLAY_LATENCY, seed: Optional[str] = AI_REPLAY_SEED):
+        if mode not in self.MODES:
+            raise ValueError(f"AI_BACKEND_MODE must be one of {', '.join(self.MODES)}, got {mode!r}")
+        self.mode = mode
+        self.directory = directory
+        self.latency = latency
+        self.logger = logging.getLogger("RecordReplayBackend")
+        self._random = random.Random(seed)
+        self._parse_latency(latency)  # Fail at startup on a bad spec
+
+    @staticmethod
+    def fixture_key(model: str, system_prompt: str, user_prompt: str, temperature: float,
+                    partial: Optional[str] = None) -> str:
+        key = AIResponseCache.make_key(model, system_prompt, user_prompt, temperature)
+        if partial is not None:
+            key = hashlib.sha256(f"{key}\x00{partial}".encode("utf-8")).hexdigest()
+        return key
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def _parse_latency(spec: str) -> Tuple[str, List[float]]:
+        kind, _, args = spec.partition(":")
+        values = [float(v) for v in args.split(",") if v.strip()]
+        expected = {"recorded": 0, "none": 0, "fixed": 1, "scale": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if kind not in expected or len(values) != expected[kind]:
+            raise ValueError(f"Invalid AI_REPLAY_LATENCY {spec!r}")
+        return kind, values
+
+    def sample_latency(self, recorded: float) -> float:
+        kind, values = self._parse_latency(self.latency)
+        if kind == "recorded":
+            return recorded
+        if kind == "none":
+            return 0.0
+        if kind == "fixed":
+            return values[0]
+        if kind == "scale":
+            return recorded * values[0]
+        if kind == "uniform":
+            return self._random.uniform(values[0], values[1])
+        if kind == "normal":
+            return max(0.0, self._random.gauss(values[0], values[1]))
+        return self._random.lognormvariate(math.log(values[0]), values[1])
+
+    async def _load(self, key: str) -> Dict[str, Any]:
+        def read() -> Optional[Dict[str, Any]]:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return None
+        
+        fixture = await asyncio.get_running_loop().run_in_executor(None, read)
+        if fixture is None:
+            metrics.increment("ai_replay.miss")
+            raise AIFixtureMissing(f"No AI fixture {key} in {self.directory}")
+        metrics.increment("ai_replay.hit")
+        return fixture
+
+    async def _save(self, key: str, fixture: Dict[str, Any]):
+        def write():
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(fixture, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, self._path(key))
+        
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+            metrics.increment("ai_record.saved")
+        except OSError as e:
+            self.logger.error(f"❌ Failed to save AI fixture {key}: {e}")
+
+    @staticmethod
+    def _fixture(model: str, system_prompt: str, user_prompt: str, partial: Optional[str],
+                 response: Dict[str, Any], latency: float,
+                 chunks: Optional[List[Tuple[str, Optional[str], float]]] = None) -> Dict[str, Any]:
+        return {
+            "model": model,
+            "system_prompt": system_prompt,
+            "user_prompt": user_prompt,
+            "partial": partial,
+            "response": response,
+            "latency": latency,
+            "chunks": [list(chunk) for chunk in chunks] if chunks is not None else None,
+            "recorded_at": datetime.datetime.utcnow().isoformat() + "Z"
+        }
+
+    async def complete(self, live, model: str, system_prompt: str, user_prompt: str,
+                       temperature: float, partial: Optional[str] = None) -> Dict[str, Any]:
+        """Serve one completion; `live(system_prompt, user_prompt, partial)` makes the real call"""
+        key = self.fixture_key(model, system_prompt, user_prompt, temperature, partial)
+        if self.mode == "replay":
+            fixture = await self._load(key)
+            await asyncio.sleep(self.sample_latency(fixture["latency"]))
+            return dict(fixture["response"])
+        
+        started = time.perf_counter()
+        response = await live(system_prompt, user_prompt, partial)
+        if self.mode == "record":
+            await self._save(key, self._fixture(model, system_prompt, user_prompt, partial, response,
+                                                time.perf_counter() - started))
+        return response
+
+    async def stream(self, live, model: str, system_prompt: str, user_prompt: str,
+                     temperature: float) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Serve one streamed completion as (content delta, finish_reason) pairs"""
+        key = self.fixture_key(model, system_prompt, user_prompt, temperature)
+        if self.mode == "replay":
+            fixture = await self._load(key)
+            recorded = fixture["latency"]
+            chunks = fixture.get("chunks")
+            if not chunks:
+                # Recorded without streaming: spread ~4-character chunks evenly
+                content = fixture["response"]["content"] or ""
+                pieces = [content[i:i + 4] for i in range(0, len(content), 4)] or [""]
+                chunks = [[piece, None, recorded * (i + 1) / len(pieces)] for i, piece in enumerate(pieces)]
+                chunks[-1][1] = fixture["response"]["finish_reason"]
+            scale = self.sample_latency(recorded) / recorded if recorded > 0 else 0.0
+            started = time.perf_counter()
+            for text, finish_reason, offset in chunks:
+                delay = started + offset * scale - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield text, finish_reason
+            return
+        
+        started = time.perf_counter()
+        recorded_chunks: List[Tuple[str, Optional[str], float]] = []
+        async for text, finish_reason in live(system_prompt, user_prompt):
+            recorded_chunks.append((text, finish_reason, time.perf_counter() - started))
+            yield text, finish_reason
+        if self.mode == "record":
+            content = "".join(text for text, _, _ in recorded_chunks)
+            finish_reason = next((reason for _, reason, _ in reversed(recorded_chunks) if reason), None)
+            response = {
+                "content": content,
+                "finish_reason": finish_reason,
+                "prompt_tokens": AIService.estimate_tokens(system_prompt) + AIService.estimate_tokens(user_prompt),
+                "completion_tokens": AIService.estimate_tokens(content),
+                "model": model
+            }
+            await self._save(key, self._fixture(model, system_prompt, user_prompt, None, response,
+                                                time.perf_counter() - started, recorded_chunks))
+
+class AIUsageTracker:
+    """Per-call AI token, latency and cache accounting, aggregated by guild, command and model
+    
+    Totals since startup are served by the metrics endpoint. The current window is
+    flushed through the write spool to the ai_usage table every `flush_interval`
+    seconds, one row per key. The prompts with the highest total token use are tracked
+    by request hash so expensive prompts can be found.
+    """
+    
+    COUNTERS = ("calls", "failures", "retries", "cache_hits", "coalesced", "prompt_tokens", "completion_tokens")
+    
+    def __init__(self, flush_interval: float = AI_USAGE_FLUSH_INTERVAL, top_prompts: int = AI_USAGE_TOP_PROMPTS,
+                 prices: Optional[Dict[str, List[float]]] = None):
+        self.flush_interval = flush_interval
+        self.top_prompts = top_prompts
+        self.prices = AI_TOKEN_PRICES if prices is None else prices
+        self.logger = logging.getLogger("AIUsageTracker")
+        self.totals: Dict[Tuple[Optional[int], str, str], Dict[str, Any]] = {}
+        self._window: Dict[Tuple[Optional[int], str, str], Dict[str, Any]] = {}
+        self._window_start = datetime.datetime.utcnow()
+        self._prompts: Dict[str, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def estimated_cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+    @classmethod
+    def _empty(cls) -> Dict[str, Any]:
+        entry: Dict[str, Any] = {name: 0 for name in cls.COUNTERS}
+        entry.update({"estimated_cost_usd": 0.0, "queue_time_ms_total": 0.0, "upstream_ms_total": 0.0,
+                      "upstream_ms_max": 0.0, "top_prompt_hash": None, "top_prompt_tokens": 0})
+        return entry
+
+    def record(self, guild_id: Optional[int], command: Optional[str], model: str, prompt_hash: str,
+               prompt_tokens: int = 0, completion_tokens: int = 0, queue_time: float = 0.0,
+               upstream: float = 0.0, retries: int = 0, cache: str = "miss", success: bool = True):
+        """Account one call; `cache` is hit, miss, bypass, coalesced, stream, continuation or hedge"""
+        key = (guild_id, command or "unknown", model)
+        tokens = prompt_tokens + completion_tokens
+        cost = self.estimated_cost(model, prompt_tokens, completion_tokens)
+        for aggregates in (self.totals, self._window):
+            entry = aggregates.get(key)
+            if entry is None:
+                entry = aggregates[key] = self._empty()
+            entry["calls"] += 1
+            entry["failures"] += 0 if success else 1
+            entry["retries"] += retries
+            entry["cache_hits"] += 1 if cache == "hit" else 0
+            entry["coalesced"] += 1 if cache == "coalesced" else 0
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+            entry["estimated_cost_usd"] += cost
+            entry["queue_time_ms_total"] += queue_time * 1000
+            entry["upstream_ms_total"] += upstream * 1000
+            entry["upstream_ms_max"] = max(entry["upstream_ms_max"], upstream * 1000)
+            if tokens > entry["top_prompt_tokens"]:
+                entry["top_prompt_hash"] = prompt_hash[:16]
+                entry["top_prompt_tokens"] = tokens
+        
+        metrics.increment("ai_usage.prompt_tokens", prompt_tokens)
+        metrics.increment("ai_usage.completion_tokens", completion_tokens)
+        if tokens:
+            prompt = self._prompts.get(prompt_hash)
+            if prompt is None:
+                prompt = self._prompts[prompt_hash] = {"prompt_hash": prompt_hash[:16], "command": key[1],
+                                                       "guild_id": guild_id, "model": model, "calls": 0, "tokens": 0}
+            prompt["calls"] += 1
+            prompt["tokens"] += tokens
+            if len(self._prompts) > self.top_prompts * 4:
+                keep = sorted(self._prompts.items(), key=lambda item: item[1]["tokens"], reverse=True)[:self.top_prompts * 2]
+                self._prompts = dict(keep)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON-serializable totals per guild/command/model and the most expensive prompts"""
+        totals = []
+        for (guild_id, command, model), entry in self.totals.items():
+            row = dict(entry, guild_id=guild_id, command=command, model=model)
+            row["estimated_cost_usd"] = round(row["estimated_cost_usd"], 6)
+            row["avg_upstream_ms"] = round(entry["upstream_ms_total"] / entry["calls"], 3) if entry["calls"] else 0.0
+            totals.append(row)
+        totals.sort(key=lambda row: row["prompt_tokens"] + row["completion_tokens"], reverse=True)
+        top = sorted(self._prompts.values(), key=lambda prompt: prompt["tokens"], reverse=True)[:self.top_prompts]
+        return {"totals": totals, "top_prompts": top}
+
+    def start(self):
+        """Start the background flusher (must be called from the running event loop)"""
+        if self._task and not self._task.done():
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Write the current window as one ai_usage row per guild/command/model"""
+        if not self._window:
+            return
+        window, self._window = self._window, {}
+        window_start, window_end = self._window_start, datetime.datetime.utcnow()
+        self._window_start = window_end
+        if not repository.available:
+            # Totals stay available on the metrics endpoint; without Supabase the spool would never drain
+            return
+        rows = []
+        for (guild_id, command, model), entry in window.items():
+            row = dict(entry)
+            row.update({
+                "guild_id": str(guild_id) if guild_id is not None else None,
+                "command_name": command,
+                "model": model,
+                "window_start": window_start.isoformat() + "Z",
+                "window_end": window_end.isoformat() + "Z",
+                "estimated_cost_usd": round(entry["estimated_cost_usd"], 6),
+                "queue_time_ms_total": round(entry["queue_time_ms_total"], 3),
+                "upstream_ms_total": round(entry["upstream_ms_total"], 3),
+                "upstream_ms_max": round(entry["upstream_ms_max"], 3)
+            })
+            rows.append(row)
+        try:
+            await write_spool.submit_many("ai_usage", "insert", rows)
+            metrics.increment("ai_usage.rows_flushed", len(rows))
+        except Exception as e:
+            metrics.increment("ai_usage.flush_failed")
+            self.logger.error(f"❌ Failed to flush {len(rows)} AI usage rows: {e}")
+
+    async def close(self):
+        """Stop the flusher and write the current window"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+ai_usage = AIUsageTracker()
+
+class MetricsServer:
+    """Serves `metrics` and AI usage as JSON on GET /metrics (disabled when the port is 0)"""
+    
+    def __init__(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger("MetricsServer")
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        if not self.port or self._runner:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self.logger.info(f"📈 Metrics endpoint listening on http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.json_response({"metrics": metrics.snapshot(), "ai_usage": ai_usage.snapshot(),
+                                  "discord_rest": rest_scheduler.snapshot()})
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics_server = MetricsServer()
+
+class AIRoute:
+    """Model settings for one class of AI request, and the requests it applies to"""
+    
+    def __init__(self, name: str, model: str = AI_MODEL, max_tokens: int = AI_MAX_TOKENS,
+                 temperature: float = AI_TEMPERATURE, commands: Optional[List[str]] = None,
+                 min_prompt_tokens: int = 0, max_prompt_tokens: Optional[int] = None):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.commands = set(commands) if commands else None
+        self.min_prompt_tokens = min_prompt_tokens
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def matches(self, command: Optional[str], prompt_tokens: int) -> bool:
+        if self.commands is not None and command not in self.commands:
+            return False
+        if prompt_tokens < self.min_prompt_tokens:
+            return False
+        return self.max_prompt_tokens is None or prompt_tokens <= self.max_prompt_tokens
+
+# Small, bounded outputs get small budgets; big cleanup analyses get more room and a low temperature
+DEFAULT_AI_ROUTES: List[Dict[str, Any]] = [
+    {"name": "names", "commands": ["add-channels"], "max_tokens": 300, "temperature": 0.8},
+    {"name": "embeds", "commands": ["setup-embeds"], "max_tokens": 600},
+    {"name": "theme", "commands": ["theme"], "max_tokens": 800},
+    {"name": "setup", "commands": ["setup"], "max_tokens": AI_MAX_TOKENS},
+    {"name": "cleanup-large", "commands": ["ai-cleanup"], "min_prompt_tokens": 3000, "max_tokens": 3000, "temperature": 0.2},
+    {"name": "cleanup", "commands": ["ai-cleanup"], "max_tokens": 1500, "temperature": 0.2},
+    {"name": "default"}
+]
+
+class ModelRouter:
+    """Chooses model, max_tokens and temperature per request from its command and prompt size
+    
+    Rules come from AI_ROUTES (a JSON list) or DEFAULT_AI_ROUTES and are checked in order;
+    the first whose `commands` and `min_prompt_tokens`/`max_prompt_tokens` bounds match
+    wins. Unset fields fall back to AI_MODEL, AI_MAX_TOKENS and AI_TEMPERATURE, and a
+    catch-all "default" route is appended if the rules have none.
+    """
+    
+    FIELDS = {"name", "model", "max_tokens", "temperature", "commands", "min_prompt_tokens", "max_prompt_tokens"}
+    
+    def __init__(self, rules: Optional[List[Dict[str, Any]]] = None):
+        if rules is None:
+            rules = json.loads(AI_ROUTES) if AI_ROUTES.strip() else DEFAULT_AI_ROUTES
+        self.routes: List[AIRoute] = []
+        for i, rule in enumerate(rules):
+            unknown = set(rule) - self.FIELDS
+            if unknown:
+                raise ValueError(f"AI route {i} has unknown fields: {', '.join(sorted(unknown))}")
+            self.routes.append(AIRoute(**{"name": f"route-{i}", **rule}))
+        if not any(route.commands is None and route.min_prompt_tokens == 0 and route.max_prompt_tokens is None
+                   for route in self.routes):
+            self.routes.append(AIRoute("default"))
+        self.default = self.routes[-1]
+
+    def select(self, command: Optional[str], prompt_tokens: int) -> AIRoute:
+        """The route a request of `prompt_tokens` would take, without counting it"""
+        return next((route for route in self.routes if route.matches(command, prompt_tokens)), self.default)
+
+    def route(self, command: Optional[str], system_prompt: str, user_prompt: str) -> AIRoute:
+        route = self.select(command, prompt_encoder.count_tokens(system_prompt) + prompt_encoder.count_tokens(user_prompt))
+        metrics.increment(f"ai.route.{route.name}.selected")
+        return route
+
+class AIService:
+    """Async OpenAI client with per-guild and global rate limiting
+    
+    Requests go through a pooled keep-alive HTTP transport. Before a request is sent it
+    must pass the guild's request/token buckets, then the global ones, then the global
+    concurrency semaphore; time spent waiting is recorded as queue time. Token budgets
+    are reserved from an estimate and reconciled with the reported usage. Identical
+    requests that are already in flight share the one upstream call.
+    
+    With AI_HEDGE_ENABLED, an attempt still running past the AI_HEDGE_PERCENTILE of recent
+    attempt latencies gets a second, hedge request and the first to succeed wins. Hedges
+    are capped at AI_HEDGE_MAX_RATE of recent requests and need spare global budget and a
+    free concurrency slot of their own; a hedge is accounted as its own call, and its
+    budget is refunded if it is cancelled.
+    
+    Each attempt goes through the OpenAI circuit breaker; while it is open, requests
+    raise CircuitOpenError immediately instead of waiting out timeouts and retries.
+    
+    Model, max_tokens and temperature come from the ModelRouter route for the command and
+    prompt size; cache keys, hedging thresholds and metrics are kept per route.
+    """
+    
+    CONTINUE_PROMPT = ("Your previous reply was cut off. Continue exactly where it stopped. "
+                       "Output only the remaining text, without repeating anything or adding markdown.")
+    
+    def __init__(self, api_key: Optional[str]):
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,  # Retries are handled here
+            timeout=AI_REQUEST_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=AI_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=AI_HTTP_MAX_CONNECTIONS
+                ),
+                timeout=AI_REQUEST_TIMEOUT
+            )
+        ) if api_key else None
+        self.logger = logging.getLogger("AIService")
+        self.router = ModelRouter()
+        self.cache = AIResponseCache(local_store)
+        self.breaker = openai_breaker
+        self.backend = RecordReplayBackend()
+        self._semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        self._global_requests = TokenBucket(AI_GLOBAL_RPM, AI_GLOBAL_RPM)
+        self._global_tokens = TokenBucket(AI_GLOBAL_TPM, AI_GLOBAL_TPM)
+        # guild_id -> (request bucket, token bucket), least recently used first
+        self._guild_buckets: "OrderedDict[int, Tuple[TokenBucket, TokenBucket]]" = OrderedDict()
+        # request hash -> shared generation task and the number of callers awaiting it
+        self._inflight: Dict[str, "asyncio.Task[Optional[str]]"] = {}
+        self._inflight_waiters: Dict[str, int] = {}
+        # Recent successful attempt latencies per route and whether each recent attempt was hedged
+        self._latencies: Dict[str, "deque[float]"] = {}
+        self._hedged: "deque[int]" = deque(maxlen=AI_HEDGE_WINDOW)
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """Cheap token estimate (~4 characters per token)"""
+        return len(text) // 4 + 1
+
+    def _buckets_for(self, guild_id: Optional[int]) -> List[TokenBucket]:
+        if guild_id is None:
+            return []
+        buckets = self._guild_buckets.get(guild_id)
+        if buckets is None:
+            buckets = (TokenBucket(AI_GUILD_RPM, AI_GUILD_RPM), TokenBucket(AI_GUILD_TPM, AI_GUILD_TPM))
+            self._guild_buckets[guild_id] = buckets
+            if len(self._guild_buckets) > 10000:
+                self._guild_buckets.popitem(last=False)
+        self._guild_buckets.move_to_end(guild_id)
+        return list(buckets)
+
+    @property
+    def model(self) -> str:
+        return self.router.default.model
+
+    @staticmethod
+    def _observe_route(route: AIRoute, prompt_tokens: int, completion_tokens: int, latency: float):
+        metrics.increment(f"ai.route.{route.name}.calls")
+        metrics.increment(f"ai.route.{route.name}.prompt_tokens", prompt_tokens)
+        metrics.increment(f"ai.route.{route.name}.completion_tokens", completion_tokens)
+        metrics.observe_histogram(f"ai.route.{route.name}", latency)
+
+    async def _acquire_budget(self, guild_id: Optional[int], estimated_tokens: int) -> List[TokenBucket]:
+        """Wait for request and token budget; returns the token buckets charged
+        
+        If cancelled or timed out part-way, the budget already taken is given back.
+        """
+        guild_buckets = self._buckets_for(guild_id)
+        token_buckets = [self._global_tokens]
+        steps: List[Tuple[TokenBucket, int]] = []
+        if guild_buckets:
+            guild_requests, guild_tokens = guild_buckets
+            steps += [(guild_requests, 1), (guild_tokens, estimated_tokens)]
+            token_buckets.append(guild_tokens)
+        steps += [(self._global_requests, 1), (self._global_tokens, estimated_tokens)]
+        
+        acquired: List[Tuple[TokenBucket, int]] = []
+        try:
+            for bucket, amount in steps:
+                await bucket.acquire(amount)
+                acquired.append((bucket, amount))
+        except BaseException:
+            for bucket, amount in acquired:
+                bucket.refund(amount)
+            raise
+        return token_buckets
+
+    @property
+    def available(self) -> bool:
+        return self.client is not None or self.backend.mode == "replay"
+
+    async def _request_completion(self, system_prompt: str, user_prompt: str, partial: Optional[str] = None,
+                                  route: Optional[AIRoute] = None) -> Dict[str, Any]:
+        """Single upstream call, normalized to content/finish_reason/usage
+        
+        With `partial`, the truncated previous output is replayed and only its
+        continuation is requested.
+        """
+        route = route or self.router.default
+        if self.backend.mode == "live":
+            return await self._live_completion(system_prompt, user_prompt, partial, route)
+        return await self.backend.complete(
+            lambda system, user, tail: self._live_completion(system, user, tail, route),
+            route.model, system_prompt, user_prompt, route.temperature, partial
+        )
+
+    async def _live_completion(self, system_prompt: str, user_prompt: str,
+                               partial: Optional[str], route: AIRoute) -> Dict[str, Any]:
+        assert self.client is not None
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        if partial is not None:
+            messages.append({"role": "assistant", "content": partial})
+            messages.append({"role": "user", "content": self.CONTINUE_PROMPT})
+        response = await self.client.chat.completions.create(
+            model=route.model,
+            messages=cast(Any, messages),
+            temperature=route.temperature,
+            max_tokens=route.max_tokens
+        )
+        choice = response.choices[0]
+        usage = response.usage
+        return {
+            "content": choice.message.content,
+            "finish_reason": choice.finish_reason,
+            "prompt_tokens": usage.prompt_tokens if usage else 0,
+            "completion_tokens": usage.completion_tokens if usage else 0,
+            "model": response.model
+        }
+
+    async def _timed_completion(self, system_prompt: str, user_prompt: str, kind: str, route: AIRoute) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            result = await self._request_completion(system_prompt, user_prompt, route=route)
+        except asyncio.CancelledError:
+            metrics.increment(f"ai.attempt.{kind}_cancelled")
+            raise
+        except Exception:
+            metrics.observe_histogram(f"ai.attempt.{kind}_error", time.perf_counter() - started)
+            raise
+        elapsed = time.perf_counter() - started
+        metrics.observe_histogram(f"ai.attempt.{kind}", elapsed)
+        latencies = self._latencies.get(route.name)
+        if latencies is None:
+            latencies = self._latencies[route.name] = deque(maxlen=AI_HEDGE_WINDOW)
+        latencies.append(elapsed)
+        return result
+
+    def _hedge_delay(self, route: AIRoute) -> Optional[float]:
+        """Seconds to wait before hedging, or None if hedging is off or not yet calibrated"""
+        latencies = self._latencies.get(route.name)
+        if not AI_HEDGE_ENABLED or latencies is None or len(latencies) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        index = min(len(ordered) - 1, int(AI_HEDGE_PERCENTILE * len(ordered)))
+        delay = max(AI_HEDGE_MIN_DELAY, ordered[index])
+        metrics.set_gauge(f"ai.route.{route.name}.hedge_delay_ms", round(delay * 1000, 3))
+        return delay if delay < AI_REQUEST_TIMEOUT else None
+
+    async def _hedge_allowed(self, estimated_tokens: int) -> bool:
+        """Take global budget and a concurrency slot for a hedge, without waiting for either"""
+        if self._hedged and sum(self._hedged) / len(self._hedged) >= AI_HEDGE_MAX_RATE:
+            metrics.increment("ai.hedge_skipped_rate")
+            return False
+        if self._semaphore.locked():
+            metrics.increment("ai.hedge_skipped_concurrency")
+            return False
+        if not self._global_requests.try_acquire(1):
+            metrics.increment("ai.hedge_skipped_budget")
+            return False
+        if not self._global_tokens.try_acquire(estimated_tokens):
+            self._global_requests.refund(1)
+            metrics.increment("ai.hedge_skipped_budget")
+            return False
+        # Not locked, so this returns without suspending
+        await self._semaphore.acquire()
+        return True
+
+    def _hedge_done(self, hedge: "asyncio.Future[Dict[str, Any]]", estimated_tokens: int, route: AIRoute,
+                    request_key: str, started: float, guild_id: Optional[int], command: Optional[str]):
+        """Release the hedge's slot, refund its unused budget and account it as its own call
+        
+        The tokens of a winning hedge are counted here only, not again on the primary call.
+        """
+        self._semaphore.release()
+        result = hedge.result() if not hedge.cancelled() and hedge.exception() is None else None
+        used = result["prompt_tokens"] + result["completion_tokens"] if result else 0
+        if hedge.cancelled():
+            self._global_tokens.refund(estimated_tokens)
+        elif used:
+            self._global_tokens.refund(max(0, estimated_tokens - used))
+        ai_usage.record(guild_id, command, route.model, request_key,
+                        prompt_tokens=result["prompt_tokens"] if result else 0,
+                        completion_tokens=result["completion_tokens"] if result else 0,
+                        upstream=time.perf_counter() - started, cache="hedge",
+                        success=result is not None or hedge.cancelled())
+
+    async def _attempt_completion(self, system_prompt: str, user_prompt: str, estimated_tokens: int,
+                                  route: AIRoute, guild_id: Optional[int] = None,
+                                  command: Optional[str] = None) -> Dict[str, Any]:
+        """One attempt with an AI_REQUEST_TIMEOUT deadline, hedged if it runs long"""
+        deadline = time.perf_counter() + AI_REQUEST_TIMEOUT
+        primary = asyncio.ensure_future(self._timed_completion(system_prompt, user_prompt, "primary", route))
+        delay = self._hedge_delay(route)
+        if delay is None:
+            return await asyncio.wait_for(primary, timeout=AI_REQUEST_TIMEOUT)
+        
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not await self._hedge_allowed(estimated_tokens):
+                self._hedged.append(0)
+                return await asyncio.wait_for(primary, timeout=max(0.0, deadline - time.perf_counter()))
+            
+            self._hedged.append(1)
+            metrics.increment("ai.hedge_fired")
+            hedge = asyncio.ensure_future(self._timed_completion(system_prompt, user_prompt, "hedge", route))
+            # A done callback runs even if the hedge is cancelled before it starts
+            hedge.add_done_callback(functools.partial(
+                self._hedge_done, estimated_tokens=estimated_tokens, route=route, started=time.perf_counter(),
+                request_key=AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature),
+                guild_id=guild_id, command=command
+            ))
+            tasks.append(hedge)
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.perf_counter()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            metrics.increment("ai.hedge_won")
+                            # Its tokens are already accounted on the hedge's own usage row
+                            return dict(task.result(), hedged=True)
+                        return task.result()
+                    error = task.exception()
+            assert error is not None
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _stream_completion(self, system_prompt: str, user_prompt: str, route: AIRoute) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        """Single upstream streaming call yielding (content delta, finish_reason)"""
+        if self.backend.mode == "live":
+            return self._live_stream(system_prompt, user_prompt, route)
+        return self.backend.stream(lambda system, user: self._live_stream(system, user, route),
+                                   route.model, system_prompt, user_prompt, route.temperature)
+
+    async def _live_stream(self, system_prompt: str, user_prompt: str, route: AIRoute) -> AsyncIterator[Tuple[str, Optional[str]]]:
+        assert self.client is not None
+        stream = await self.client.chat.completions.create(
+            model=route.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ],
+            temperature=route.temperature,
+            max_tokens=route.max_tokens,
+            stream=True
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            yield choice.delta.content or "", choice.finish_reason
+
+    async def stream_response(self, system_prompt: str, user_prompt: str, guild_id: Optional[int] = None,
+                              command: Optional[str] = None, use_cache: bool = True) -> AsyncGenerator[str, None]:
+        """Stream an AI response as text deltas
+        
+        Same caching and rate limiting as `generate_response`. A cached response is yielded
+        as a single chunk. Errors end the stream early; callers detect truncation by parsing.
+        The concurrency slot is held while the stream is open, so a caller that stops
+        reading early must `aclose()` it.
+        """
+        if not self.available:
+            self.logger.error("❌ OpenAI client not initialized")
+            return
+        
+        route = self.router.route(command, system_prompt, user_prompt)
+        cache_key = None
+        if use_cache and command not in AI_CACHE_EXCLUDED_COMMANDS:
+            cache_key = AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                ai_usage.record(guild_id, command, route.model, cache_key, cache="hit")
+                yield cached
+                return
+        
+        self.breaker.check()
+        estimated = self.estimate_tokens(system_prompt) + self.estimate_tokens(user_prompt) + route.max_tokens
+        queued_at = time.perf_counter()
+        token_buckets = await self._acquire_budget(guild_id, estimated)
+        
+        parts: List[str] = []
+        finish_reason = None
+        async with self._semaphore:
+            self.breaker.allow()
+            started = time.perf_counter()
+            metrics.observe("ai.queue_time", started - queued_at)
+            try:
+                async for text, reason in self._stream_completion(system_prompt, user_prompt, route):
+                    if text:
+                        if not parts:
+                            metrics.observe("ai.time_to_first_token", time.perf_counter() - started)
+                        parts.append(text)
+                        yield text
+                    if reason:
+                        finish_reason = reason
+                self.breaker.record_success()
+            except Exception as e:
+                metrics.increment("ai.stream_error")
+                self.breaker.record_failure()
+                self.logger.error(f"AI stream failed: {e}")
+            finally:
+                metrics.observe("ai.upstream", time.perf_counter() - started)
+        
+        content = "".join(parts)
+        prompt_tokens = self.estimate_tokens(system_prompt) + self.estimate_tokens(user_prompt)
+        used = prompt_tokens + self.estimate_tokens(content)
+        for bucket in token_buckets:
+            bucket.refund(max(0, estimated - used))
+        if finish_reason is not None:
+            self._observe_route(route, prompt_tokens, used - prompt_tokens, time.perf_counter() - started)
+        ai_usage.record(guild_id, command, route.model,
+                        AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature),
+                        prompt_tokens=prompt_tokens, completion_tokens=used - prompt_tokens,
+                        queue_time=started - queued_at, upstream=time.perf_counter() - started,
+                        cache="stream", success=finish_reason is not None)
+        if cache_key and content and finish_reason == "stop":
+            await self.cache.put(cache_key, content, used)
+
+    async def generate_response(self, system_prompt: str, user_prompt: str, max_retries: int = 3,
+                                guild_id: Optional[int] = None, command: Optional[str] = None,
+                                use_cache: bool = True, route: Optional[AIRoute] = None) -> Optional[str]:
+        """Generate AI response with caching, per-guild rate limiting and retries
+        
+        Complete responses are cached by request hash unless `use_cache` is False or the
+        command is listed in AI_CACHE_EXCLUDED_COMMANDS. Concurrent identical requests are
+        coalesced onto one upstream call; it is cancelled only once every caller has gone.
+        `route` is the request's already chosen route, if any.
+        """
+        route = route or self.router.route(command, system_prompt, user_prompt)
+        key = AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._generate_response(
+                system_prompt, user_prompt, max_retries, guild_id, command, use_cache, key, route
+            ))
+            self._inflight[key] = task
+            self._inflight_waiters[key] = 0
+            task.add_done_callback(lambda done: self._forget_inflight(key, done))
+        else:
+            metrics.increment("ai.coalesced")
+            ai_usage.record(guild_id, command, route.model, key, cache="coalesced")
+            self.logger.info(f"AI request coalesced with one in flight ({command or 'unknown'})", extra=HOT_PATH_LOG)
+        
+        self._inflight_waiters[key] += 1
+        try:
+            # Shield so one caller timing out does not abort the call the others share
+            return await asyncio.shield(task)
+        finally:
+            if self._inflight.get(key) is task:
+                self._inflight_waiters[key] -= 1
+                if self._inflight_waiters[key] <= 0 and not task.done():
+                    metrics.increment("ai.abandoned")
+                    task.cancel()
+                    self._forget_inflight(key, task)
+
+    def _forget_inflight(self, key: str, task: "asyncio.Task[Optional[str]]"):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            self._inflight_waiters.pop(key, None)
+
+    async def _generate_response(self, system_prompt: str, user_prompt: str, max_retries: int,
+                                 guild_id: Optional[int], command: Optional[str],
+                                 use_cache: bool, request_key: str, route: AIRoute) -> Optional[str]:
+        """Run one (uncoalesced) generation and account for it in `ai_usage`"""
+        call: Dict[str, Any] = {"cache": "bypass", "success": False, "prompt_tokens": 0, "completion_tokens": 0,
+                                "queue_time": 0.0, "upstream": 0.0, "retries": 0}
+        try:
+            content = await self._run_generation(system_prompt, user_prompt, max_retries, guild_id,
+                                                 command, use_cache, call, route)
+            call["success"] = content is not None
+            return content
+        finally:
+            ai_usage.record(guild_id, command, route.model, request_key, **call)
+
+    async def _run_generation(self, system_prompt: str, user_prompt: str, max_retries: int,
+                              guild_id: Optional[int], command: Optional[str],
+                              use_cache: bool, call: Dict[str, Any], route: AIRoute) -> Optional[str]:
+        if not self.available:
+            self.logger.error("❌ OpenAI client not initialized")
+            return None
+        
+        cache_key = None
+        if use_cache and command not in AI_CACHE_EXCLUDED_COMMANDS:
+            cache_key = AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                call["cache"] = "hit"
+                self.logger.info(f"✅ AI response served from cache ({command or 'unknown'})", extra=HOT_PATH_LOG)
+                return cached
+            call["cache"] = "miss"
+        
+        self.breaker.check()
+        estimated = self.estimate_tokens(system_prompt) + self.estimate_tokens(user_prompt) + route.max_tokens
+        queued_at = time.perf_counter()
+        token_buckets = await self._acquire_budget(guild_id, estimated)
+        
+        for attempt in range(max_retries):
+            # The concurrency slot is held per attempt, not across the backoff between attempts
+            async with self._semaphore:
+                if attempt == 0:
+                    queue_time = time.perf_counter() - queued_at
+                    metrics.observe("ai.queue_time", queue_time)
+                    metrics.set_gauge("ai.last_queue_time_ms", round(queue_time * 1000, 3))
+                    call["queue_time"] = queue_time
+                self.breaker.allow()
+                call["retries"] = attempt
+                started = time.perf_counter()
+                try:
+                    self.logger.info(f"AI request attempt {attempt + 1}/{max_retries}", extra=HOT_PATH_LOG)
+                    
+                    result = await self._attempt_completion(system_prompt, user_prompt, estimated, route,
+                                                            guild_id, command)
+                    metrics.observe("ai.upstream", time.perf_counter() - started)
+                    self.breaker.record_success()
+                    self._observe_route(route, result["prompt_tokens"], result["completion_tokens"],
+                                        time.perf_counter() - started)
+                    if not result.get("hedged"):
+                        call["prompt_tokens"] += result["prompt_tokens"]
+                        call["completion_tokens"] += result["completion_tokens"]
+                    
+                    used = result["prompt_tokens"] + result["completion_tokens"]
+                    if used:
+                        for bucket in token_buckets:
+                            bucket.refund(max(0, estimated - used))
+                    
+                    content = result["content"]
+                    if content:
+                        metrics.increment("ai.success")
+                        self.logger.info("✅ AI response received", extra=HOT_PATH_LOG)
+                        # Only complete generations are reusable
+                        if cache_key and result["finish_reason"] == "stop":
+                            await self.cache.put(cache_key, content, used)
+                        return content
+                    else:
+                        self.logger.warning("⚠️ Empty AI response")
+                        
+                except asyncio.TimeoutError:
+                    metrics.increment("ai.timeout")
+                    self.breaker.record_failure()
+                    self.logger.warning(f"AI request timeout on attempt {attempt + 1}")
+                except Exception as e:
+                    metrics.increment("ai.error")
+                    self.breaker.record_failure()
+                    self.logger.error(f"AI request failed on attempt {attempt + 1}: {e}")
+                finally:
+                    call["upstream"] += time.perf_counter() - started
+                    
+            if attempt < max_retries - 1:
+                await asyncio.sleep(2 ** attempt)  # Exponential backoff
+        
+        metrics.increment("ai.failed")
+        self.logger.error("❌ All AI request attempts failed")
+        return None
+
+    async def generate_json(self, system_prompt: str, user_prompt: str, schema: Dict[str, Any],
+                            guild_id: Optional[int] = None, command: Optional[str] = None,
+                            use_cache: bool = True, max_continuations: int = AI_MAX_CONTINUATIONS) -> Any:
+        """Generate a response and parse it against `schema`
+        
+        Returns None if the AI is unavailable and raises AIOutputError if the output cannot
+        be parsed. Truncated output is completed by continuation requests that fetch only the
+        missing tail; if those run out, the repaired prefix is returned.
+        """
+        # One routing decision per request; continuations use the same route
+        route = self.router.route(command, system_prompt, user_prompt)
+        content = await self.generate_response(system_prompt, user_prompt, guild_id=guild_id,
+                                               command=command, use_cache=use_cache, route=route)
+        if content is None:
+            return None
+        
+        value = None
+        error: Optional[AIOutputError] = None
+        truncated = False
+        continued = False
+        for attempt in range(max_continuations + 1):
+            try:
+                value, truncated = AIOutputParser.parse(content, schema)
+                error = None
+            except AIOutputError as e:
+                error = e
+                truncated = not AIOutputParser.is_complete(content)
+            if not truncated or attempt == max_continuations:
+                break
+            tail = await self._continue_response(system_prompt, user_prompt, content, route, guild_id, command)
+            if not tail:
+                break
+            metrics.increment("ai.parse_continued")
+            content += tail
+            continued = True
+        
+        if value is None:
+            metrics.increment("ai.parse_failed")
+            self.logger.warning(f"AI output for {command or 'unknown'} could not be parsed: {error}")
+            raise error or AIOutputError("AI output could not be parsed")
+        
+        if truncated or error:
+            metrics.increment("ai.parse_repaired")
+        else:
+            metrics.increment("ai.parse_ok")
+            if continued and use_cache and command not in AI_CACHE_EXCLUDED_COMMANDS:
+                cache_key = AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature)
+                await self.cache.put(cache_key, content, self.estimate_tokens(content))
+        return value
+
+    async def _continue_response(self, system_prompt: str, user_prompt: str, partial: str, route: AIRoute,
+                                 guild_id: Optional[int], command: Optional[str] = None) -> Optional[str]:
+        """Request only the tail of a truncated response, on the route of the original request"""
+        if not self.available:
+            return None
+        request_key = AIResponseCache.make_key(route.model, system_prompt, user_prompt, route.temperature)
+        estimated = (self.estimate_tokens(system_prompt) + self.estimate_tokens(user_prompt)
+                     + self.estimate_tokens(partial) + route.max_tokens)
+        token_buckets = await self._acquire_budget(guild_id, estimated)
+        async with self._semaphore:
+            try:
+                self.breaker.allow()
+            except CircuitOpenError:
+                for bucket in token_buckets:
+                    bucket.refund(estimated)
+                return None
+            started = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    self._request_completion(system_prompt, user_prompt, partial=partial, route=route),
+                    timeout=AI_REQUEST_TIMEOUT
+                )
+                self.breaker.record_success()
+            except Exception as e:
+                metrics.increment("ai.error")
+                self.breaker.record_failure()
+                self.logger.error(f"AI continuation request failed: {e}")
+                ai_usage.record(guild_id, command, route.model, request_key, upstream=time.perf_counter() - started,
+                                cache="continuation", success=False)
+                return None
+            finally:
+                metrics.observe("ai.upstream", time.perf_counter() - started)
+        
+        self._observe_route(route, result["prompt_tokens"], result["completion_tokens"], time.perf_counter() - started)
+        ai_usage.record(guild_id, command, route.model, request_key, prompt_tokens=result["prompt_tokens"],
+                        completion_tokens=result["completion_tokens"], upstream=time.perf_counter() - started,
+                        cache="continuation")
+        used = result["prompt_tokens"] + result["completion_tokens"]
+        if used:
+            for bucket in token_buckets:
+                bucket.refund(max(0, estimated - used))
+        return result["content"]
+
+    async def close(self):
+        if self.client:
+            await self.client.close()
+
+class IncrementalBlueprintParser:
+    """Extracts blueprint roles and categories from a JSON stream as soon as each is complete
+    
+    `feed` scans only the new text, tracking nesting and string state, and returns every
+    element of the top-level "roles" and "categories" arrays that closed in that chunk as
+    ("role", dict) / ("category", dict) events. Text around the JSON (e.g. markdown
+    fences) is ignored. `result` parses the full document once the stream has ended.
+    """
+    
+    STREAMED_ARRAYS = {"roles": "role", "categories": "category"}
+    
+    def __init__(self):
+        self.buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_key: Optional[str] = None
+        self._array_kind: Optional[str] = None
+        self._element_start = -1
+        self.emitted: Dict[str, List[Dict[str, Any]]] = {"role": [], "category": []}
+
+    def feed(self, text: str) -> List[Tuple[str, Dict[str, Any]]]:
+        self.buffer += text
+        events: List[Tuple[str, Dict[str, Any]]] = []
+        buffer = self.buffer
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = buffer[self._string_start + 1:i]
+                continue
+            
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                if self._depth == 1 and char == "[":
+                    self._array_kind = self.STREAMED_ARRAYS.get(self._last_key or "")
+                elif self._depth == 2 and char == "{" and self._array_kind:
+                    self._element_start = i
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 2 and char == "}" and self._element_start >= 0 and self._array_kind:
+                    try:
+                        element = json.loads(buffer[self._element_start:i + 1])
+                        self.emitted[self._array_kind].append(element)
+                        events.append((self._array_kind, element))
+                    except json.JSONDecodeError:
+                        pass
+                    self._element_start = -1
+                elif self._depth == 1:
+                    self._array_kind = None
+        self._pos = len(buffer)
+        return events
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """The validated (and if necessary repaired) blueprint, or None if unusable"""
+        try:
+            blueprint, _ = AIOutputParser.parse(self.buffer, BLUEPRINT_SCHEMA)
+            return blueprint
+        except AIOutputError:
+            return None
+
+async def bulk_channel_positions(guild: discord.Guild, positions: List[Dict[str, Any]], reason: Optional[str] = None):
+    """Move channels to the given {"id", "position"} entries in one request
+    
+    discord.py only exposes Discord's bulk channel position endpoint on its internal
+    HTTPClient (`guild._state.http`); if that is not there, each channel is edited
+    on its own instead.
+    """
+    http = getattr(getattr(guild, "_state", None), "http", None)
+    if hasattr(http, "bulk_channel_update"):
+        await http.bulk_channel_update(guild.id, positions, reason=reason)
+        return
+    for entry in positions:
+        channel = guild.get_channel(entry["id"])
+        if channel is not None:
+            await channel.edit(position=entry["position"], reason=reason)
+
+class BuildOperation:
+    """One Discord create call in a compiled blueprint, and the category it waits for
+    
+    `options` are passed straight to the create call (overwrites, topic, position, color);
+    `reason` overrides the executor's audit log reason.
+    """
+    
+    BUCKETS = {"role": "roles", "category": "channels", "text": "channels", "voice": "channels"}
+    
+    def __init__(self, key: str, kind: str, name: str, options: Optional[Dict[str, Any]] = None,
+                 parent: Optional["BuildOperation"] = None, reason: Optional[str] = None):
+        self.key = key
+        self.kind = kind
+        self.name = name
+        self.options = options or {}
+        self.parent = parent
+        self.reason = reason
+        self.position: Optional[int] = self.options.get("position")
+        self.attempts = 0
+        self.created: Optional[Any] = None
+        self.error: Optional[str] = None
+        self.status: Optional[int] = None
+        self.finished = asyncio.Event()
+
+    @property
+    def bucket(self) -> str:
+        return self.BUCKETS[self.kind]
+
+class BuildResult:
+    """Outcome of a blueprint build: what was created, what failed and what needed retries
+    
+    `api_calls` counts Discord requests per call type, retries and ordering calls included.
+    """
+    
+    def __init__(self):
+        self.created: List[Dict[str, Any]] = []
+        self.failed: List[Dict[str, Any]] = []
+        self.retried: List[Dict[str, Any]] = []
+        self.updated: List[Dict[str, Any]] = []
+        self.deleted: List[Dict[str, Any]] = []
+        self.unchanged = 0
+        self.api_calls: Counter = Counter()
+        self.duration = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    def record(self, op: BuildOperation):
+        entry: Dict[str, Any] = {"kind": op.kind, "name": op.name, "attempts": op.attempts}
+        if op.error is None:
+            entry["id"] = getattr(op.created, "id", None)
+            self.created.append(entry)
+        else:
+            entry["error"] = op.error
+            if op.status is not None:
+                entry["status"] = op.status
+            self.failed.append(entry)
+        if op.attempts > 1:
+            self.retried.append(entry)
+
+    def summary(self) -> str:
+        text = f"{len(self.created)} created, "
+        if self.updated or self.deleted or self.unchanged:
+            text += f"{len(self.updated)} updated, {len(self.deleted)} deleted, {self.unchanged} unchanged, "
+        text += (f"{len(self.failed)} failed, {len(self.retried)} retried, "
+                 f"{sum(self.api_calls.values())} API calls in {self.duration:.1f}s")
+        if self.failed:
+            names = ", ".join(f"{entry['name']} ({entry['error']})" for entry in self.failed[:5])
+            text += f". Failed: {names}" + (", ..." if len(self.failed) > 5 else "")
+        return text
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"created": self.created, "updated": self.updated, "deleted": self.deleted, "failed": self.failed,
+                "retried": self.retried, "unchanged": self.unchanged, "api_calls": dict(self.api_calls),
+                "duration": round(self.duration, 3)}
+
+class BlueprintExecutor:
+    """Runs a blueprint as a DAG of Discord create calls with bounded concurrency
+    
+    Roles and categories have no dependencies; each channel waits for its category. Every
+    call holds a slot in its rate-limit bucket (roles: BUILD_ROLE_CONCURRENCY, categories
+    and channels: BUILD_CHANNEL_CONCURRENCY) and a global slot (BUILD_CONCURRENCY), so
+    independent work overlaps without piling requests into one bucket. Transient failures
+    (5xx, 429, timeouts) are retried with backoff; anything else fails the operation, and
+    channels under a failed category are reported as failed without being attempted.
+    
+    Overwrites, topics and positions are sent with the create call (channels inherit their
+    category's overwrites), so nothing needs a follow-up edit. Ordering is settled once at
+    the end: one edit_role_positions call when roles were created concurrently, and one
+    bulk channel position update only if Discord did not honour a requested position.
+    
+    Operations can be added while the build is running, which is how the streaming /setup
+    hands over parsed elements; `wait` returns the BuildResult once everything settled.
+    With a `job`, every created item is checkpointed under its structure_key.
+    """
+    
+    RETRYABLE = (discord.DiscordServerError, discord.RateLimited, asyncio.TimeoutError, ConnectionError)
+    
+    def __init__(self, guild: discord.Guild, palette: Optional[List[int]] = None,
+                 concurrency: int = BUILD_CONCURRENCY, bucket_limits: Optional[Dict[str, int]] = None,
+                 max_retries: int = BUILD_MAX_RETRIES, retry_backoff: float = BUILD_RETRY_BACKOFF,
+                 on_channel_created: Optional[Callable[[], None]] = None, reason: Optional[str] = None,
+                 job: Optional[Job] = None):
+        self.guild = guild
+        self.palette = palette
+        self.reason = reason
+        self.job = job
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.on_channel_created = on_channel_created
+        self.logger = logging.getLogger("BlueprintExecutor")
+        self.result = BuildResult()
+        limits = bucket_limits or {"roles": BUILD_ROLE_CONCURRENCY, "channels": BUILD_CHANNEL_CONCURRENCY}
+        self._buckets = {bucket: asyncio.Semaphore(limit) for bucket, limit in limits.items()}
+        self._ordered_roles = limits.get("roles", 1) <= 1
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._ops: List[BuildOperation] = []
+        self._roles = 0
+        self._categories = 0
+        # New categories go below the existing ones
+        self._category_base = max((category.position for category in getattr(guild, "categories", [])), default=-1) + 1
+        self._started = time.perf_counter()
+
+    def add_role(self, role_data: Dict[str, Any]) -> BuildOperation:
+        """Schedule a role; its color comes from the palette if one was given, else from the blueprint"""
+        index = self._roles
+        self._roles += 1
+        try:
+            if self.palette:
+                value = self.palette[index % len(self.palette)]
+            else:
+                value = int(str(role_data.get('color', '#99aab5')).replace('#', ''), 16)
+        except ValueError:
+            value = 0x99aab5
+        name = role_data.get('name', '')
+        op = BuildOperation(structure_key("role", name), "role", name, {"color": discord.Color(value)})
+        self._schedule(op)
+        return op
+
+    def add_category(self, cat_data: Dict[str, Any], existing: Optional[discord.CategoryChannel] = None) -> BuildOperation:
+        """Schedule a category and, behind it, each of its channels
+        
+        Optional `overwrites` (category and channel) and `topic` (text channel) keys are
+        passed through to the create calls. With `existing`, only the channels are created,
+        inside that category.
+        """
+        index = self._categories
+        self._categories += 1
+        options: Dict[str, Any] = {"position": self._category_base + index}
+        if cat_data.get('overwrites'):
+            options["overwrites"] = cat_data['overwrites']
+        category = BuildOperation(structure_key("category", cat_data.get('name', '')), "category", cat_data.get('name', ''),
+                                  options, reason=cat_data.get('reason'))
+        if existing is None:
+            self._schedule(category)
+        else:
+            category.created = existing
+            category.position = None
+            category.finished.set()
+        for position, channel_data in enumerate(cat_data.get('channels', [])):
+            kind = "voice" if channel_data.get('type') == 'voice' else "text"
+            channel_options: Dict[str, Any] = {"position": position}
+            overwrites = channel_data.get('overwrites') or cat_data.get('overwrites')
+            if overwrites:
+                channel_options["overwrites"] = overwrites
+            if kind == "text" and channel_data.get('topic'):
+                channel_options["topic"] = channel_data['topic']
+            self._schedule(BuildOperation(structure_key(kind, channel_data.get('name', ''), category.key), kind,
+                                          channel_data.get('name', ''), channel_options, parent=category,
+                                          reason=cat_data.get('reason')))
+        return category
+
+    def add_blueprint(self, blueprint: Dict[str, Any]):
+        for role_data in blueprint.get('roles', []):
+            self.add_role(role_data)
+        for cat_data in blueprint.get('categories', []):
+            self.add_category(cat_data)
+
+    async def run(self, blueprint: Dict[str, Any]) -> BuildResult:
+        self.add_blueprint(blueprint)
+        return await self.wait()
+
+    async def wait(self) -> BuildResult:
+        while True:
+            pending = [task for task in self._tasks if not task.done()]
+            if not pending:
+                break
+            await asyncio.gather(*pending)
+        await self._apply_order()
+        self.result.duration = time.perf_counter() - self._started
+        metrics.observe("setup.build_operations", self.result.duration)
+        metrics.increment("setup.created", len(self.result.created))
+        metrics.increment("setup.failed", len(self.result.failed))
+        metrics.increment("setup.api_calls", sum(self.result.api_calls.values()))
+        self.logger.info(f"🏗️ Blueprint build: {self.result.summary()} {dict(self.result.api_calls)}")
+        return self.result
+
+    async def _apply_order(self):
+        roles = [op.created for op in self._ops if op.kind == "role" and op.created is not None]
+        if len(roles) > 1 and not self._ordered_roles:
+            # Each new role lands just above @everyone; restore blueprint order top-down
+            positions = {discord.Object(id=role.id): len(roles) - i for i, role in enumerate(roles)}
+            await self._bulk("edit_role_positions", self.guild.edit_role_positions(positions, reason=self.reason))
+        
+        moved = [
+            {"id": op.created.id, "position": op.position} for op in self._ops
+            if op.kind != "role" and op.created is not None and op.position is not None
+            and getattr(op.created, "position", op.position) != op.position
+        ]
+        if moved:
+            await self._bulk("bulk_channel_update", bulk_channel_positions(self.guild, moved, reason=self.reason))
+
+    async def _bulk(self, call: str, request):
+        self.result.api_calls[call] += 1
+        try:
+            await request
+        except Exception as e:
+            self.logger.warning(f"⚠️ {call} failed: {e}")
+            self.result.failed.append({"kind": "order", "name": call, "attempts": 1, "error": str(e) or type(e).__name__})
+
+    def _schedule(self, op: BuildOperation):
+        self._ops.append(op)
+        self._tasks.append(asyncio.create_task(self._run(op)))
+
+    async def _run(self, op: BuildOperation):
+        try:
+            if op.parent is not None:
+                await op.parent.finished.wait()
+                if op.parent.error is not None:
+                    op.error = f"category {op.parent.name!r} was not created"
+                    return
+            while True:
+                op.attempts += 1
+                try:
+                    async with self._buckets[op.bucket], self._slots:
+                        op.created = await self._perform(op)
+                    break
+                except Exception as e:
+                    if op.attempts > self.max_retries or not self._retryable(e):
+                        op.error = str(e) or type(e).__name__
+                        op.status = getattr(e, "status", None)
+                        self.logger.warning(f"⚠️ Failed to create {op.kind} {op.name!r}: {op.error}")
+                        return
+                    metrics.increment("setup.build_retries")
+                    delay = self.retry_backoff * 2 ** (op.attempts - 1) * random.uniform(0.5, 1.0)
+                    await asyncio.sleep(max(delay, getattr(e, "retry_after", 0.0)))
+            if self.job is not None:
+                await self.job.checkpoint(op.key, op.created.id)
+        finally:
+            if op.created is None and op.error is None:
+                op.error = "cancelled"
+            op.finished.set()
+            self.result.record(op)
+            if op.created is not None and op.kind in ("text", "voice") and self.on_channel_created:
+                self.on_channel_created()
+
+    async def _perform(self, op: BuildOperation) -> Any:
+        if not op.name:
+            raise ValueError("missing name")
+        if op.kind == "role":
+            self.result.api_calls["create_role"] += 1
+            return await self.guild.create_role(name=op.name, reason=op.reason or self.reason, **op.options)
+        if op.kind == "category":
+            self.result.api_calls["create_category"] += 1
+            return await self.guild.create_category(op.name, reason=op.reason or self.reason, **op.options)
+        assert op.parent is not None
+        self.result.api_calls["create_channel"] += 1
+        create = self.guild.create_voice_channel if op.kind == "voice" else self.guild.create_text_channel
+        return await create(op.name, category=op.parent.created, reason=op.reason or self.reason, **op.options)
+
+    @classmethod
+    def _retryable(cls, error: Exception) -> bool:
+        return isinstance(error, cls.RETRYABLE) or (isinstance(error, discord.HTTPException) and error.status == 429)
+
+def normalize_structure_name(name: str) -> str:
+    """Name key for matching blueprint items to guild items: case, emoji, spacing and punctuation ignored"""
+    name = re.sub(r"[\s_]+", "-", str(name).strip().lower())
+    name = re.sub(r"[^\w-]", "", name)
+    return re.sub(r"-{2,}", "-", name).strip("-")
+
+def structure_key(kind: str, name: str, parent: Optional[str] = None) -> str:
+    """Stable identity of a blueprint item across runs, e.g. category:games/text:general"""
+    key = f"{kind}:{normalize_structure_name(name)}"
+    return f"{parent}/{key}" if parent else key
+
+class ReconcilePlan:
+    """Creates, updates and deletes that bring a guild in line with a blueprint
+    
+    Deletes are always listed but only applied when `prune` is set.
+    """
+    
+    def __init__(self, prune: bool = False):
+        self.prune = prune
+        self.creates: List[Dict[str, Any]] = []
+        self.updates: List[Dict[str, Any]] = []
+        self.deletes: List[Dict[str, Any]] = []
+        self.unchanged = 0
+        self.duration = 0.0
+
+    @property
+    def empty(self) -> bool:
+        return not self.creates and not self.updates and not (self.prune and self.deletes)
+
+    def summary(self) -> str:
+        deletes = f"{len(self.deletes)} to delete" if self.prune else f"{len(self.deletes)} extra (kept)"
+        return (f"{len(self.creates)} to create, {len(self.updates)} to update, {deletes}, "
+                f"{self.unchanged} unchanged")
+
+    def render(self, limit: int = 30) -> str:
+        """Plan as diff-style lines (+ create, ~ update, - delete), truncated to `limit` lines"""
+        lines = []
+        for item in self.creates:
+            parent = f" in {item['parent']}" if item.get("parent") else ""
+            lines.append(f"+ {item['kind']} {item['name']}{parent}")
+        for item in self.updates:
+            lines.append(f"~ {item['kind']} {item['name']}: {', '.join(item['changes'])}")
+        for item in self.deletes:
+            lines.append(f"{'-' if self.prune else '?'} {item['kind']} {item['name']}")
+        if len(lines) > limit:
+            lines = lines[:limit] + [f"... and {len(lines) - limit} more"]
+        return "\n".join(lines) if lines else "Nothing to change"
+
+class BlueprintReconciler:
+    """Diffs a blueprint against the live guild and applies only the difference
+    
+    Guild roles, categories and channels are indexed once by normalized name (channels
+    also by type), so diffing is a dictionary lookup per blueprint item. Each guild item
+    is matched at most once. A matching channel in another category is moved; explicit
+    role colors, category overwrites and channel topics that differ are updated. Guild
+    items the blueprint does not mention become deletes, applied only with `prune`.
+    
+    `diff_role` / `diff_category` can be called as blueprint elements arrive; they return
+    the part that still has to be created, for BlueprintExecutor. `known` maps
+    structure_keys to Discord IDs a resumed job already created; those items are matched
+    by ID before any name matching.
+    """
+    
+    # Never pruned: the bot's own command channel (CoreHelper.ADMIN_CHANNEL_NAME) and its category,
+    # and the categories (with their channels) made by /admin-setup and /setup moderation_logs
+    PROTECTED_CHANNELS = {"command-hub"}
+    PROTECTED_CATEGORIES = {normalize_structure_name(name) for name in ("🔒 ADMINISTRATION", "⚖️ MODERATION", "🛡️ Moderation")}
+    
+    def __init__(self, guild: discord.Guild, palette: Optional[List[int]] = None, prune: bool = False,
+                 known: Optional[Dict[str, int]] = None):
+        self.guild = guild
+        self.palette = palette
+        self.known = known or {}
+        self.plan = ReconcilePlan(prune)
+        self.logger = logging.getLogger("BlueprintReconciler")
+        self._claimed: set = set()
+        self._by_id: Dict[int, Any] = {}
+        self.roles: Dict[str, List[Any]] = {}
+        self.categories: Dict[str, List[Any]] = {}
+        self.channels: Dict[Tuple[str, str], List[Any]] = {}
+        for role in guild.roles:
+            if not role.is_default() and not role.managed:
+                self.roles.setdefault(normalize_structure_name(role.name), []).append(role)
+                self._by_id[role.id] = role
+        for channel in guild.channels:
+            self._by_id[channel.id] = channel
+            if channel.type == discord.ChannelType.category:
+                self.categories.setdefault(normalize_structure_name(channel.name), []).append(channel)
+            else:
+                key = (self._channel_kind(channel), normalize_structure_name(channel.name))
+                self.channels.setdefault(key, []).append(channel)
+
+    @staticmethod
+    def _channel_kind(channel: Any) -> str:
+        if channel.type in (discord.ChannelType.text, discord.ChannelType.news):
+            return "text"
+        if channel.type == discord.ChannelType.voice:
+            return "voice"
+        return str(channel.type)
+
+    def _claim_known(self, key: str) -> Optional[Any]:
+        item = self._by_id.get(self.known.get(key, 0))
+        if item is None or item.id in self._claimed:
+            return None
+        self._claimed.add(item.id)
+        return item
+
+    def _claim(self, candidates: Optional[List[Any]], prefer_category: Optional[int] = None) -> Optional[Any]:
+        free = [item for item in candidates or [] if item.id not in self._claimed]
+        if not free:
+            return None
+        match = next((item for item in free if getattr(item, "category_id", None) == prefer_category), free[0])
+        self._claimed.add(match.id)
+        return match
+
+    def diff(self, blueprint: Dict[str, Any]) -> ReconcilePlan:
+        """Full plan for a blueprint, deletes included"""
+        started = time.perf_counter()
+        for role_data in blueprint.get('roles', []):
+            self.diff_role(role_data)
+        for cat_data in blueprint.get('categories', []):
+            self.diff_category(cat_data)
+        self.diff_deletes()
+        self.plan.duration = time.perf_counter() - started
+        return self.plan
+
+    def diff_role(self, role_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Plan one blueprint role; returns it if it has to be created"""
+        name = role_data.get('name', '')
+        role = (self._claim_known(structure_key("role", name))
+                or self._claim(self.roles.get(normalize_structure_name(name))))
+        if role is None:
+            self.plan.creates.append({"kind": "role", "name": name})
+            return role_data
+        changes: Dict[str, Any] = {}
+        if self.palette is None and role_data.get('color'):
+            try:
+                color = int(str(role_data['color']).replace('#', ''), 16)
+                if role.color.value != color:
+                    changes["color"] = discord.Color(color)
+            except ValueError:
+                pass
+        self._plan_update("role", role, changes)
+        return None
+
+    def diff_category(self, cat_data: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], Optional[discord.CategoryChannel]]:
+        """Plan one blueprint category; returns (the part still to create, the existing category)"""
+        name = cat_data.get('name', '')
+        category_key = structure_key("category", name)
+        category = self._claim_known(category_key) or self._claim(self.categories.get(normalize_structure_name(name)))
+        if category is None:
+            self.plan.creates.append({"kind": "category", "name": name})
+            for channel_data in cat_data.get('channels', []):
+                kind = "voice" if channel_data.get('type') == 'voice' else "text"
+                self.plan.creates.append({"kind": kind, "name": channel_data.get('name', ''), "parent": name})
+            return cat_data, None
+        
+        changes: Dict[str, Any] = {}
+        if cat_data.get('overwrites') and category.overwrites != cat_data['overwrites']:
+            changes["overwrites"] = cat_data['overwrites']
+        self._plan_update("category", category, changes, cat_data.get('reason'))
+        
+        missing = []
+        for channel_data in cat_data.get('channels', []):
+            kind = "voice" if channel_data.get('type') == 'voice' else "text"
+            key = (kind, normalize_structure_name(channel_data.get('name', '')))
+            channel = (self._claim_known(structure_key(kind, channel_data.get('name', ''), category_key))
+                       or self._claim(self.channels.get(key), prefer_category=category.id))
+            if channel is None:
+                missing.append(channel_data)
+                self.plan.creates.append({"kind": kind, "name": channel_data.get('name', ''), "parent": category.name})
+                continue
+            changes = {}
+            if channel.category_id != category.id:
+                changes["category"] = category
+            if kind == "text" and channel_data.get('topic') and getattr(channel, "topic", None) != channel_data['topic']:
+                changes["topic"] = channel_data['topic']
+            self._plan_update(kind, channel, changes, cat_data.get('reason'))
+        return ({**cat_data, "channels": missing} if missing else None), category
+
+    def diff_deletes(self):
+        """Plan deletes for every unmatched guild item the bot could remove"""
+        top_role = getattr(getattr(self.guild, "me", None), "top_role", None)
+        protected = {category.id for name, categories in self.categories.items() if name in self.PROTECTED_CATEGORIES
+                     for category in categories}
+        protected.update(channel.category_id for channels in self.channels.values() for channel in channels
+                         if channel.name in self.PROTECTED_CHANNELS and channel.category_id)
+        for roles in self.roles.values():
+            for role in roles:
+                if role.id not in self._claimed and (top_role is None or role.position < top_role.position):
+                    self.plan.deletes.append({"kind": "role", "name": role.name, "target": role})
+        for key, channels in self.channels.items():
+            for channel in channels:
+                if (channel.id not in self._claimed and channel.name not in self.PROTECTED_CHANNELS
+                        and channel.category_id not in protected):
+                    self.plan.deletes.append({"kind": key[0], "name": channel.name, "target": channel})
+        for categories in self.categories.values():
+            for category in categories:
+                if category.id not in self._claimed and category.id not in protected:
+                    self.plan.deletes.append({"kind": "category", "name": category.name, "target": category})
+
+    def _plan_update(self, kind: str, target: Any, changes: Dict[str, Any], reason: Optional[str] = None):
+        if changes:
+            self.plan.updates.append({"kind": kind, "name": target.name, "target": target, "changes": changes,
+                                      "reason": reason})
+        else:
+            self.plan.unchanged += 1
+
+    def schedule(self, executor: "BlueprintExecutor", blueprint: Dict[str, Any]):
+        """Diff `blueprint` and hand what is missing to `executor`"""
+        started = time.perf_counter()
+        for role_data in blueprint.get('roles', []):
+            delta = self.diff_role(role_data)
+            if delta:
+                executor.add_role(delta)
+        for cat_data in blueprint.get('categories', []):
+            delta, existing = self.diff_category(cat_data)
+            if delta:
+                executor.add_category(delta, existing=existing)
+        self.diff_deletes()
+        self.plan.duration = time.perf_counter() - started
+
+    async def apply(self, executor: "BlueprintExecutor") -> BuildResult:
+        """Run planned updates alongside the executor's creates, then deletes if pruning"""
+        result = executor.result
+        result.unchanged = self.plan.unchanged
+        slots = asyncio.Semaphore(BUILD_CONCURRENCY)
+        
+        async def change(item: Dict[str, Any], call: str, request: Callable[[], Any], done: List[Dict[str, Any]]):
+            async with slots:
+                result.api_calls[call] += 1
+                entry = {"kind": item["kind"], "name": item["name"]}
+                try:
+                    await request()
+                    done.append(entry)
+                except Exception as e:
+                    self.logger.warning(f"⚠️ {call} {item['name']!r} failed: {e}")
+                    result.failed.append({**entry, "attempts": 1, "error": str(e) or type(e).__name__,
+                                          "status": getattr(e, "status", None)})
+        
+        def edit(item: Dict[str, Any]) -> Callable[[], Any]:
+            return lambda: item["target"].edit(reason=item.get("reason") or executor.reason, **item["changes"])
+        
+        def delete(item: Dict[str, Any]) -> Callable[[], Any]:
+            return lambda: item["target"].delete(reason=executor.reason)
+        
+        await asyncio.gather(*[
+            change(item, f"edit_{'role' if item['kind'] == 'role' else 'channel'}", edit(item), result.updated)
+            for item in self.plan.updates
+        ])
+        await executor.wait()
+        if self.plan.prune:
+            # Channels and roles before categories, so a category is empty when it goes
+            channels = [item for item in self.plan.deletes if item["kind"] != "category"]
+            categories = [item for item in self.plan.deletes if item["kind"] == "category"]
+            for batch in (channels, categories):
+                await asyncio.gather(*[
+                    change(item, f"delete_{'role' if item['kind'] == 'role' else 'channel'}", delete(item), result.deleted)
+                    for item in batch
+                ])
+        result.duration = time.perf_counter() - executor._started
+        return result
+
+async def reconcile_blueprint(guild: discord.Guild, blueprint: Dict[str, Any], prune: bool = False,
+                              palette: Optional[List[int]] = None, job: Optional[Job] = None,
+                              **executor_options) -> BuildResult:
+    """Create, update (and with `prune` delete) only what differs between `blueprint` and the guild"""
+    reconciler = BlueprintReconciler(guild, palette=palette, prune=prune, known=job.discord_ids() if job else None)
+    executor = BlueprintExecutor(guild, palette=palette, job=job, **executor_options)
+    reconciler.schedule(executor, blueprint)
+    return await reconciler.apply(executor)
+
+_rest_lane: contextvars.ContextVar[str] = contextvars.ContextVar("rest_lane", default="interactive")
+_rest_guild: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("rest_guild", default=None)
+
+@contextlib.contextmanager
+def rest_lane(lane: str, guild_id: Optional[int] = None):
+    """Send the Discord REST mutations made inside this block through `lane` on behalf of `guild_id`"""
+    lane_token = _rest_lane.set(lane)
+    guild_token = _rest_guild.set(guild_id)
+    try:
+        yield
+    finally:
+        _rest_guild.reset(guild_token)
+        _rest_lane.reset(lane_token)
+
+class RestBucket:
+    """What the last response headers said about one Discord rate-limit bucket"""
+    
+    def __init__(self):
+        self.remaining: Optional[int] = None
+        self.reset_at = 0.0
+        self.inflight = 0
+        self.changed = asyncio.Event()
+
+    def idle(self, now: float) -> bool:
+        return not self.inflight and self.reset_at <= now
+
+    async def acquire(self, reserve: int):
+        """Wait until the bucket has a request to spare beyond `reserve`"""
+        while True:
+            now = time.monotonic()
+            if self.reset_at <= now:
+                self.remaining = None
+            if self.remaining is None or self.remaining - self.inflight > reserve:
+                self.inflight += 1
+                return
+            self.changed.clear()
+            # Woken by a response (new headers) or the window resetting, whichever comes first
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.changed.wait(), max(0.01, self.reset_at - now))
+
+    def release(self):
+        self.inflight -= 1
+        self.changed.set()
+
+    def observe(self, headers: Any):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is None or reset_after is None:
+            return
+        self.remaining = int(remaining)
+        self.reset_at = time.monotonic() + float(reset_after)
+        self.changed.set()
+
+class RestScheduler:
+    """Admission control in front of discord.py's REST mutations
+    
+    Requests wait per rate-limit bucket first: bulk work stops `bucket_reserve` requests
+    short of a bucket's limit (as reported by the response headers) so interactive
+    mutations never queue behind it. They then take one of `max_concurrency` slots, handed
+    out to interactive requests before bulk ones and round-robin across guilds within a
+    lane, so one guild's /nuke cannot starve another guild's /setup. Bulk concurrency
+    halves on every 429 and creeps back up as requests succeed. GETs are not scheduled.
+    
+    Only HTTPClient.request is scheduled. Interaction responses and followups go through
+    discord.py's webhook adapter and never pass through here (they have their own
+    per-interaction buckets), so the interactive lane separates a command's own few
+    mutations from bulk builds; it does not prioritise the replies themselves.
+    """
+    
+    LANES = ("interactive", "bulk")
+    MAX_BUCKETS = 4096
+    
+    def __init__(self, max_concurrency: int = REST_MAX_CONCURRENCY, bulk_concurrency: int = REST_BULK_CONCURRENCY,
+                 bucket_reserve: int = REST_BUCKET_RESERVE):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_bulk = max(1, min(bulk_concurrency, self.max_concurrency))
+        self.bulk_limit = float(self.max_bulk)
+        self.bucket_reserve = bucket_reserve
+        self.logger = logging.getLogger("RestScheduler")
+        self._buckets: Dict[str, RestBucket] = {}
+        self._waiting: Dict[str, "OrderedDict[int, deque]"] = {lane: OrderedDict() for lane in self.LANES}
+        self._active: Counter = Counter()
+        self.rate_limited: Counter = Counter()
+
+    def install(self, http: Any):
+        """Route `http.request` (a discord.py HTTPClient) through the scheduler"""
+        original = http.request
+        
+        async def request(route: Any, **kwargs):
+            return await self.request(original, route, **kwargs)
+        
+        http.request = request
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """aiohttp tracing that feeds response rate-limit headers back into the buckets"""
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(self._on_request_end)
+        return trace
+
+    async def request(self, send: Callable[..., Any], route: Any, **kwargs) -> Any:
+        if route.method == "GET":
+            return await send(route, **kwargs)
+        
+        lane = _rest_lane.get()
+        guild_id = _rest_guild.get() or int(route.guild_id or 0)
+        bucket = self._bucket(f"{route.key}:{route.major_parameters}")
+        queued = time.perf_counter()
+        await bucket.acquire(0 if lane == "interactive" else self.bucket_reserve)
+        try:
+            await self._acquire_slot(lane, guild_id)
+        except BaseException:
+            bucket.release()
+            raise
+        metrics.observe(f"discord.rest.{lane}.queue_wait", time.perf_counter() - queued)
+        try:
+            # Handed to the aiohttp trace hooks of this request (and of discord.py's retries of it)
+            result = await send(route, trace_request_ctx=(bucket, lane), **kwargs)
+            if lane == "bulk":
+                # Additive increase: one more bulk slot per window of successful requests
+                self.bulk_limit = min(float(self.max_bulk), self.bulk_limit + 1 / self.bulk_limit)
+            return result
+        finally:
+            bucket.release()
+            self._release_slot(lane)
+
+    def _bucket(self, key: str) -> RestBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                now = time.monotonic()
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.idle(now)}
+            bucket = self._buckets[key] = RestBucket()
+        return bucket
+
+    def _capacity(self, lane: str) -> bool:
+        if sum(self._active.values()) >= self.max_concurrency:
+            return False
+        return lane != "bulk" or self._active["bulk"] < int(self.bulk_limit)
+
+    async def _acquire_slot(self, lane: str, guild_id: int):
+        ahead = any(self._waiting[other] for other in self.LANES[:self.LANES.index(lane) + 1])
+        if not ahead and self._capacity(lane):
+            self._active[lane] += 1
+            return
+        
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting[lane].setdefault(guild_id, deque()).append(waiter)
+        self._publish()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot(lane)
+            raise
+
+    def _release_slot(self, lane: str):
+        self._active[lane] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hand free slots to waiters: higher lanes first, guilds in turn within a lane"""
+        for lane in self.LANES:
+            guilds = self._waiting[lane]
+            while guilds and self._capacity(lane):
+                guild_id, waiters = next(iter(guilds.items()))
+                waiter = waiters.popleft()
+                if waiters:
+                    guilds.move_to_end(guild_id)
+                else:
+                    del guilds[guild_id]
+                if not waiter.done():
+                    self._active[lane] += 1
+                    waiter.set_result(None)
+            if guilds:
+                break
+        self._publish()
+
+    def _publish(self):
+        for lane in self.LANES:
+            metrics.set_gauge(f"discord.rest.{lane}.queued", sum(len(w) for w in self._waiting[lane].values()))
+            metrics.set_gauge(f"discord.rest.{lane}.inflight", self._active[lane])
+        metrics.set_gauge("discord.rest.bulk_limit", self.bulk_limit)
+
+    async def _on_request_end(self, session: Any, context: Any, params: Any):
+        entry = context.trace_request_ctx if isinstance(context.trace_request_ctx, tuple) else None
+        if entry:
+            entry[0].observe(params.response.headers)
+        if params.response.status != 429:
+            return
         
-        self.logger.error("❌ All AI request attempts failed")
-        return None
+        lane = entry[1] if entry else "interactive"
+        scope = params.response.headers.get("X-RateLimit-Scope", "user")
+        self.rate_limited[lane] += 1
+        metrics.increment(f"discord.rest.{lane}.rate_limited")
+        metrics.increment(f"discord.rest.rate_limited.{scope}")
+        # Multiplicative decrease: back bulk work off before Discord escalates to a global limit
+        self.bulk_limit = max(1.0, self.bulk_limit / 2)
+        self._publish()
+        self.logger.warning(f"⚠️ Discord 429 ({scope}) on {params.method} {params.url.path} in the {lane} lane, "
+                            f"bulk concurrency now {int(self.bulk_limit)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "queued": {lane: sum(len(w) for w in self._waiting[lane].values()) for lane in self.LANES},
+            "inflight": {lane: self._active[lane] for lane in self.LANES},
+            "bulk_limit": int(self.bulk_limit),
+            "rate_limited": dict(self.rate_limited),
+            "buckets": len(self._buckets)
+        }
+
+rest_scheduler = RestScheduler()
 
 class CoreHelper:
     ADMIN_CHANNEL_NAME = "command-hub"
@@ -561,6 +4243,41 @@ class CleanupView(discord.ui.View):
         except Exception:
             pass
 
+class SetupPlanView(discord.ui.View):
+    """Buttons under a /setup dry-run plan: apply exactly the previewed blueprint, or discard it"""
+    
+    def __init__(self, cog, user: Union[discord.User, discord.Member], blueprint: Dict[str, Any],
+                 palette: Optional[List[int]], embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool):
+        super().__init__(timeout=300)
+        self.cog = cog
+        self.user = user
+        self.blueprint = blueprint
+        self.palette = palette
+        self.options = (embeds, ai_embeds, moderation_logs, prune)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user == self.user
+
+    @discord.ui.button(label="Apply Plan", style=discord.ButtonStyle.success, emoji="✅")
+    async def apply_plan(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.edit_message(content="🏗️ Applying the previewed plan...", view=None)
+        self.stop()
+        assert interaction.guild is not None
+        embeds, ai_embeds, moderation_logs, prune = self.options
+        job = await self.cog._start_setup_job(interaction, self.blueprint, self.palette, embeds, ai_embeds, moderation_logs, prune)
+        result = await self.cog._build_blueprint(interaction.guild, self.blueprint, self.palette, embeds, ai_embeds,
+                                                 moderation_logs, prune, job)
+        await interaction.followup.send(self.cog._build_report("Server build", result), ephemeral=True)
+
+    @discord.ui.button(label="Discard", style=discord.ButtonStyle.secondary, emoji="🗑️")
+    async def discard_plan(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await interaction.response.edit_message(content="🗑️ Plan discarded, nothing was changed", embed=None, view=None)
+        self.stop()
+
+    async def on_timeout(self):
+        for item in self.children:
+            item.disabled = True  # type: ignore
+
 class IssueFixView(discord.ui.View):
     def __init__(self, cog, user: Union[discord.User, discord.Member], issue: Dict[str, Any], issue_num: int, total_issues: int):
         super().__init__(timeout=120)
@@ -644,14 +4361,41 @@ class ProfessionalBuilderBot(commands.Bot):
             command_prefix='!',
             intents=intents,
             help_command=None,
-            case_insensitive=True
+            case_insensitive=True,
+            http_trace=rest_scheduler.trace_config()
         )
+        rest_scheduler.install(self.http)
         
-        self.ai_service = AIService(OPENAI_API_KEY) if OPENAI_API_KEY else None
+        self.ai_service = AIService(OPENAI_API_KEY) if OPENAI_API_KEY or AI_BACKEND_MODE == "replay" else None
         self.startup_time = None
+        self.subscription_refresh_task: Optional[asyncio.Task] = None
+        self.job_resume_task: Optional[asyncio.Task] = None
+
+    async def _refresh_subscriptions(self):
+        """Keep the subscription cache warm so AI command checks stay O(1) lookups"""
+        # Refresh before entries expire so warmed guilds never fall back to per-guild queries
+        while not self.is_closed():
+            try:
+                await subscription_resolver.warm_up(list(self.guilds))
+            except Exception as e:
+                logging.error(f"❌ Subscription cache refresh failed: {e}")
+            await asyncio.sleep(subscription_resolver.refresh_interval)
 
     async def setup_hook(self):
         """Setup hook for bot initialization"""
+        loop_lag_monitor.start()
+        activity_log_batcher.start()
+        guild_syncer.start()
+        ai_usage.start()
+        try:
+            await write_spool.start()
+        except Exception as e:
+            logging.error(f"❌ Failed to open local write spool: {e}")
+        try:
+            await metrics_server.start()
+        except Exception as e:
+            logging.error(f"❌ Failed to start metrics endpoint: {e}")
+        
         try:
             await self.add_cog(MainCog(self))
             logging.info("✅ Main cog loaded successfully")
@@ -668,16 +4412,23 @@ class ProfessionalBuilderBot(commands.Bot):
         logging.info(f"📊 Connected to {len(self.guilds)} guilds")
         logging.info(f"🌐 Bot ID: {self.user.id}")
         
-        # Sync all existing guilds to database on startup
-        logging.info("🔄 Syncing existing guilds to database...")
-        for guild in self.guilds:
-            try:
-                await sync_guild_to_database(guild, "join")
-                logging.info(f"✅ Synced guild: {guild.name}")
-            except Exception as e:
-                logging.error(f"❌ Failed to sync guild {guild.name}: {e}")
+        # Warm the subscription cache (on_ready also fires on reconnect, keep one refresher)
+        if not self.subscription_refresh_task or self.subscription_refresh_task.done():
+            self.subscription_refresh_task = asyncio.create_task(self._refresh_subscriptions())
+        
+        # Finish structure jobs a previous run left half done (once per process, not on reconnect)
+        cog = self.get_cog("MainCog")
+        if self.job_resume_task is None and isinstance(cog, MainCog):
+            self.job_resume_task = asyncio.create_task(cog.resume_jobs())
         
-        logging.info(f"✅ Finished syncing {len(self.guilds)} guilds to database")
+        # Sync existing guilds to database on startup (and reconnect); only changed guilds are written
+        # and no invite logs are recorded since these are not new joins
+        logging.info("🔄 Syncing existing guilds to database...")
+        try:
+            changed = await guild_syncer.sync_guilds(list(self.guilds))
+            logging.info(f"✅ Finished syncing guilds to database ({changed}/{len(self.guilds)} changed)")
+        except Exception as e:
+            logging.error(f"❌ Failed to sync guilds to database: {e}")
         
         # Set bot status
         try:
@@ -706,13 +4457,34 @@ class ProfessionalBuilderBot(commands.Bot):
     async def on_guild_remove(self, guild: discord.Guild):
         """Called when bot leaves a guild"""
         logging.info(f"👋 Left guild: {guild.name} (ID: {guild.id})")
+        subscription_resolver.invalidate(guild.id)
         
         # Sync guild removal to database
         await sync_guild_to_database(guild, "leave")
 
+    async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
+        """Called when guild name, icon, features etc. change"""
+        guild_syncer.mark_dirty(after)
+        if before.owner_id != after.owner_id:
+            subscription_resolver.invalidate(after.id)
+
+    async def on_member_join(self, member: discord.Member):
+        guild_syncer.mark_dirty(member.guild)
+
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        guild = self.get_guild(payload.guild_id)
+        if guild:
+            guild_syncer.mark_dirty(guild)
+
     async def on_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
         """Global error handler for app commands"""
         error_msg = str(error)
+        user_msg = f"❌ **Error:** {error_msg}"
+        
+        # A dependency's circuit breaker is open: the message already says when to retry
+        original = getattr(error, "original", None)
+        if isinstance(original, CircuitOpenError):
+            user_msg = str(original)
         
         # Log the error
         logging.error(f"Command error in {interaction.guild.name if interaction.guild else 'DM'}: {error_msg}")
@@ -721,12 +4493,12 @@ class ProfessionalBuilderBot(commands.Bot):
         try:
             if not interaction.response.is_done():
                 await interaction.response.send_message(
-                    f"❌ **Error:** {error_msg}",
+                    user_msg,
                     ephemeral=True
                 )
             else:
                 await interaction.followup.send(
-                    f"❌ **Error:** {error_msg}",
+                    user_msg,
                     ephemeral=True
                 )
         except Exception as e:
@@ -735,6 +4507,23 @@ class ProfessionalBuilderBot(commands.Bot):
     async def close(self):
         """Graceful shutdown"""
         logging.info("🔄 Initiating bot shutdown...")
+        if self.subscription_refresh_task:
+            self.subscription_refresh_task.cancel()
+        if self.job_resume_task:
+            self.job_resume_task.cancel()
+        loop_lag_monitor.stop()
+        try:
+            await metrics_server.close()
+            await activity_log_batcher.close()
+            await guild_syncer.close()
+            await ai_usage.close()
+            if self.ai_service:
+                await self.ai_service.close()
+            await write_spool.close()
+            await local_store.close()
+            repository.close()
+        except Exception as e:
+            logging.error(f"❌ Error flushing pending writes: {e}")
         try:
             await super().close()
             logging.info("✅ Bot shutdown complete")
@@ -899,71 +4688,37 @@ class MainCog(commands.Cog):
         
         try:
             guild = interaction.guild
-            created_items = []
-            
-            if create_admin:
-                # Create admin category
-                admin_overwrites = {
-                    guild.default_role: discord.PermissionOverwrite(read_messages=False),
-                    guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True)
-                }
-                
-                # Add admin roles
-                for role in guild.roles:
-                    if role.permissions.administrator and not role.is_bot_managed():
-                        admin_overwrites[role] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
-                
-                admin_category = await guild.create_category(
-                    "🔒 ADMINISTRATION",
-                    overwrites=admin_overwrites,
-                    reason="Admin setup by BuildForMe Bot"
-                )
-                created_items.append(f"Category: {admin_category.name}")
-                
-                # Create admin channels
-                admin_channels = ["admin-chat", "bot-commands", "server-logs"]
-                for channel_name in admin_channels:
-                    channel = await guild.create_text_channel(
-                        channel_name,
-                        category=admin_category,
-                        reason="Admin setup by BuildForMe Bot"
-                    )
-                    created_items.append(f"Channel: #{channel.name}")
-            
-            if create_mod:
-                # Create moderation category
-                mod_overwrites = {
-                    guild.default_role: discord.PermissionOverwrite(read_messages=False),
-                    guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True)
-                }
-                
-                mod_category = await guild.create_category(
-                    "⚖️ MODERATION",
-                    overwrites=mod_overwrites,
-                    reason="Mod setup by BuildForMe Bot"
+            job = await job_store.create("admin-setup", guild.id, interaction.channel_id,
+                                         {"create_admin": create_admin, "create_mod": create_mod})
+            result = await self._run_admin_setup(guild, job)
+            if result.failed and not result.created and any(entry.get("status") == 403 for entry in result.failed):
+                await interaction.followup.send(
+                    "❌ I don't have permission to create channels/categories. Please check my role permissions.",
+                    ephemeral=True
                 )
-                created_items.append(f"Category: {mod_category.name}")
-                
-                # Create mod channels
-                mod_channels = ["mod-chat", "mod-logs", "reports"]
-                for channel_name in mod_channels:
-                    channel = await guild.create_text_channel(
-                        channel_name,
-                        category=mod_category,
-                        reason="Mod setup by BuildForMe Bot"
-                    )
-                    created_items.append(f"Channel: #{channel.name}")
+                return
             
+            created_items = [
+                f"Category: {entry['name']}" if entry["kind"] == "category" else f"Channel: #{entry['name']}"
+                for entry in result.created
+            ]
             embed = discord.Embed(
-                title="✅ Admin Setup Complete",
-                description="Successfully created admin infrastructure",
-                color=0x00FF00
+                title="✅ Admin Setup Complete" if result.ok else "⚠️ Admin Setup Incomplete",
+                description="Successfully created admin infrastructure" if result.ok else result.summary(),
+                color=0x00FF00 if result.ok else 0xFFA500
             )
             embed.add_field(
                 name="Created Items",
                 value="\n".join(created_items) if created_items else "None",
                 inline=False
             )
+            if result.failed:
+                embed.add_field(
+                    name="Failed Items",
+                    value="\n".join(f"{entry['name']}: {entry['error']}" for entry in result.failed[:10]),
+                    inline=False
+                )
+            embed.set_footer(text=f"{sum(result.api_calls.values())} Discord API calls")
             
             await interaction.followup.send(embed=embed)
             
@@ -979,6 +4734,49 @@ class MainCog(commands.Cog):
                 ephemeral=True
             )
 
+    async def _run_admin_setup(self, guild: discord.Guild, job: Job) -> BuildResult:
+        """Create (or complete) the admin/mod categories described by an admin-setup job"""
+        try:
+            blueprint: Dict[str, Any] = {"categories": []}
+            
+            if job.params.get("create_admin", True):
+                # Admin category, visible to admin roles only; channels inherit its overwrites
+                admin_overwrites = {
+                    guild.default_role: discord.PermissionOverwrite(read_messages=False),
+                    guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True)
+                }
+                
+                # Add admin roles
+                for role in guild.roles:
+                    if role.permissions.administrator and not role.is_bot_managed():
+                        admin_overwrites[role] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
+                
+                blueprint["categories"].append({
+                    "name": "🔒 ADMINISTRATION",
+                    "overwrites": admin_overwrites,
+                    "channels": [{"name": name} for name in ["admin-chat", "bot-commands", "server-logs"]]
+                })
+            
+            if job.params.get("create_mod", True):
+                mod_overwrites = {
+                    guild.default_role: discord.PermissionOverwrite(read_messages=False),
+                    guild.me: discord.PermissionOverwrite(read_messages=True, send_messages=True)
+                }
+                
+                blueprint["categories"].append({
+                    "name": "⚖️ MODERATION",
+                    "reason": "Mod setup by BuildForMe Bot",
+                    "overwrites": mod_overwrites,
+                    "channels": [{"name": name} for name in ["mod-chat", "mod-logs", "reports"]]
+                })
+            
+            result = await reconcile_blueprint(guild, blueprint, job=job, reason="Admin setup by BuildForMe Bot")
+        except BaseException as e:
+            await job.finish("failed", str(e))
+            raise
+        await job.finish()
+        return result
+
     @app_commands.command(name="setup", description="🤖 AI-powered comprehensive server setup")
     @app_commands.describe(
         theme="Server theme (Gaming, Study, Tech, Art, etc.)",
@@ -991,7 +4789,9 @@ class MainCog(commands.Cog):
         role_colors="Role color scheme",
         embeds="Add informational embeds?",
         ai_embeds="Use AI for custom embed content?",
-        moderation_logs="Create moderation log channels?"
+        moderation_logs="Create moderation log channels?",
+        dry_run="Only show what would be created, updated or deleted?",
+        prune="Delete channels, categories and roles that are not in the new layout?"
     )
     @ai_subscription_required()
     @is_admin()
@@ -1006,7 +4806,9 @@ class MainCog(commands.Cog):
                    role_colors: str = 'theme-based',
                    embeds: bool = True,
                    ai_embeds: bool = False,
-                   moderation_logs: bool = True):
+                   moderation_logs: bool = True,
+                   dry_run: bool = False,
+                   prune: bool = False):
         
         await interaction.response.defer(thinking=True, ephemeral=True)
         assert interaction.guild is not None
@@ -1028,119 +4830,217 @@ Role Theme: {role_theme}
 Role Colors: {role_colors}
 Embeds: {embeds}"""
 
-            response = await self.bot.ai_service.generate_response(system_prompt, user_prompt)
-            
-            if response:
+            if AI_STREAMING_SETUP and not dry_run:
+                job = await self._start_setup_job(interaction, None, self._role_palette(role_colors), embeds, ai_embeds, moderation_logs, prune)
+                stream = self.bot.ai_service.stream_response(system_prompt, user_prompt, guild_id=interaction.guild.id, command="setup")
                 try:
-                    blueprint = json.loads(response)
-                    success = await self._build_server_ai(interaction, blueprint, role_colors, embeds, ai_embeds, moderation_logs)
-                    if success:
-                        await interaction.followup.send("✅ AI server build completed successfully!", ephemeral=True)
-                    else:
-                        await interaction.followup.send("❌ AI server build failed", ephemeral=True)
-                except json.JSONDecodeError:
-                    await interaction.followup.send("❌ AI response was invalid", ephemeral=True)
+                    with rest_lane("bulk", interaction.guild.id):
+                        result = await self._build_server_ai_streaming(interaction, stream, role_colors, embeds, ai_embeds, moderation_logs, prune, job)
+                except Exception as e:
+                    # The user is told this /setup failed, so a restart must not quietly resume it
+                    await job.finish("failed", str(e) or type(e).__name__)
+                    raise
+                if result is None:
+                    await interaction.followup.send("❌ AI service unavailable or response was invalid", ephemeral=True)
+                else:
+                    await interaction.followup.send(self._build_report("AI server build", result), ephemeral=True)
+                return
+            
+            try:
+                blueprint = await self.bot.ai_service.generate_json(system_prompt, user_prompt, BLUEPRINT_SCHEMA, guild_id=interaction.guild.id, command="setup")
+            except AIOutputError:
+                await interaction.followup.send("❌ AI response was invalid", ephemeral=True)
+                return
+            
+            if blueprint and dry_run:
+                await self._send_plan(interaction, blueprint, self._role_palette(role_colors), embeds, ai_embeds, moderation_logs, prune)
+            elif blueprint:
+                job = await self._start_setup_job(interaction, blueprint, self._role_palette(role_colors), embeds, ai_embeds, moderation_logs, prune)
+                result = await self._build_server_ai(interaction, blueprint, role_colors, embeds, ai_embeds, moderation_logs, prune, job)
+                await interaction.followup.send(self._build_report("AI server build", result), ephemeral=True)
             else:
                 await interaction.followup.send("❌ AI service unavailable", ephemeral=True)
+        elif dry_run:
+            blueprint = self._manual_blueprint(theme, channels, categories, custom_roles, role_count, role_theme)
+            await self._send_plan(interaction, blueprint, self._manual_palette(role_colors), embeds, ai_embeds, moderation_logs, prune)
         else:
-            success = await self._build_server_manual(interaction, theme, channels, categories, custom_roles, role_count, role_theme, role_colors, embeds, ai_embeds, moderation_logs)
-            if success:
-                await interaction.followup.send("✅ Manual server build completed successfully!", ephemeral=True)
-            else:
-                await interaction.followup.send("❌ Manual server build failed", ephemeral=True)
+            blueprint = self._manual_blueprint(theme, channels, categories, custom_roles, role_count, role_theme)
+            job = await self._start_setup_job(interaction, blueprint, self._manual_palette(role_colors), embeds, ai_embeds, moderation_logs, prune)
+            result = await self._build_server_manual(interaction, theme, channels, categories, custom_roles, role_count, role_theme, role_colors, embeds, ai_embeds, moderation_logs, prune, job)
+            await interaction.followup.send(self._build_report("Manual server build", result), ephemeral=True)
 
-    async def _build_server_ai(self, interaction: discord.Interaction, blueprint: dict, role_colors: str, embeds: bool, ai_embeds: bool, moderation_logs: bool) -> bool:
+    @staticmethod
+    async def _start_setup_job(interaction: discord.Interaction, blueprint: Optional[Dict[str, Any]], palette: Optional[List[int]],
+                               embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool) -> Job:
+        """Persist everything a restarted bot needs to finish this /setup"""
         assert interaction.guild is not None
-        guild = interaction.guild
-        
+        return await job_store.create("setup", interaction.guild.id, interaction.channel_id, {
+            "blueprint": blueprint, "complete": blueprint is not None, "palette": palette, "embeds": embeds,
+            "ai_embeds": ai_embeds, "moderation_logs": moderation_logs, "prune": prune
+        })
+
+    async def _build_blueprint(self, guild: discord.Guild, blueprint: Dict[str, Any], palette: Optional[List[int]], embeds: bool,
+                               ai_embeds: bool, moderation_logs: bool, prune: bool = False, job: Optional[Job] = None) -> Optional[BuildResult]:
+        """Reconcile the guild with a blueprint, then add moderation channels and embeds"""
         try:
-            color_palette = CoreHelper.get_color_palette(role_colors if role_colors != 'theme-based' else 'gamer')
-            
-            if 'roles' in blueprint:
-                for i, role_data in enumerate(blueprint['roles']):
-                    try:
-                        if role_colors == 'theme-based':
-                            color = discord.Color(int(role_data.get('color', '#99aab5').replace('#', ''), 16))
-                        else:
-                            color = discord.Color(color_palette[i % len(color_palette)])
-                        await guild.create_role(name=role_data['name'], color=color)
-                    except Exception:
-                        pass
+            with rest_lane("bulk", guild.id):
+                result = await reconcile_blueprint(guild, blueprint, prune=prune, palette=palette, job=job)
+                await self._finish_setup(guild, blueprint, embeds, ai_embeds, moderation_logs, job)
+        except Exception as e:
+            logging.error(f"❌ Server build failed: {e}")
+            result = None
+        if job:
+            await job.finish("done" if result is not None else "failed")
+        return result
 
-            if 'categories' in blueprint:
-                for cat_data in blueprint['categories']:
-                    try:
-                        category = await guild.create_category(cat_data['name'])
-                        for channel_data in cat_data.get('channels', []):
-                            if channel_data.get('type') == 'voice':
-                                await guild.create_voice_channel(channel_data['name'], category=category)
-                            else:
-                                await guild.create_text_channel(channel_data['name'], category=category)
-                    except Exception:
-                        pass
-            
-            if moderation_logs:
-                await self._create_moderation_system(guild)
-            
-            if embeds:
-                await self._create_embeds(guild, blueprint, ai_embeds)
-            
-            return True
-        except Exception:
-            return False
+    async def _finish_setup(self, guild: discord.Guild, blueprint: Dict[str, Any], embeds: bool, ai_embeds: bool,
+                            moderation_logs: bool, job: Optional[Job] = None):
+        """Post-structure /setup steps, each checkpointed so a resumed job does not repeat them"""
+        if moderation_logs and not (job and job.done("moderation")):
+            await self._create_moderation_system(guild)
+            if job:
+                await job.checkpoint("moderation")
+        if embeds and not (job and job.done("embeds")):
+            await self._create_embeds(guild, blueprint, ai_embeds)
+            if job:
+                await job.checkpoint("embeds")
+
+    async def _send_plan(self, interaction: discord.Interaction, blueprint: Dict[str, Any], palette: Optional[List[int]],
+                         embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool):
+        """Reply with what /setup would change, without changing anything
+        
+        The blueprint is kept by the reply's Apply button: a new AI /setup would generate a
+        different layout, so applying the button is the only way to get exactly this plan.
+        """
+        assert interaction.guild is not None
+        plan = BlueprintReconciler(interaction.guild, palette=palette, prune=prune).diff(blueprint)
+        embed = discord.Embed(
+            title="📋 Setup Plan",
+            description=f"```diff\n{plan.render()}\n```",
+            color=discord.Color.blue()
+        )
+        footer = f"{plan.summary()} · diffed in {plan.duration * 1000:.1f} ms"
+        if plan.deletes and not prune:
+            footer += " · run with prune to delete extras"
+        embed.set_footer(text=footer + " · Apply within 5 minutes to build exactly this plan; running /setup again generates a new one")
+        view = SetupPlanView(self, interaction.user, blueprint, palette, embeds, ai_embeds, moderation_logs, prune)
+        await interaction.followup.send(embed=embed, view=view, ephemeral=True)
+
+    @staticmethod
+    def _build_report(label: str, result: Optional[BuildResult]) -> str:
+        if result is None:
+            return f"❌ {label} failed"
+        if result.ok:
+            return f"✅ {label} completed successfully! ({result.summary()})"
+        return f"⚠️ {label} finished with errors: {result.summary()}"
+
+    @staticmethod
+    def _role_palette(role_colors: str) -> Optional[List[int]]:
+        """Palette for blueprint roles; None keeps each role's own color"""
+        return None if role_colors == 'theme-based' else CoreHelper.get_color_palette(role_colors)
+
+    async def _build_server_ai(self, interaction: discord.Interaction, blueprint: dict, role_colors: str, embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool = False, job: Optional[Job] = None) -> Optional[BuildResult]:
+        assert interaction.guild is not None
+        return await self._build_blueprint(interaction.guild, blueprint, self._role_palette(role_colors), embeds, ai_embeds, moderation_logs, prune, job)
 
-    async def _build_server_manual(self, interaction: discord.Interaction, theme: str, channels: int, categories: int, custom_roles: bool, role_count: int, role_theme: bool, role_colors: str, embeds: bool, ai_embeds: bool, moderation_logs: bool) -> bool:
+    async def _build_server_ai_streaming(self, interaction: discord.Interaction, stream: AsyncGenerator[str, None], role_colors: str,
+                                         embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool = False,
+                                         job: Optional[Job] = None) -> Optional[BuildResult]:
+        """Build roles and categories while the blueprint is still being generated
+        
+        Each role/category is diffed against the guild as soon as the parser sees it close,
+        and whatever is missing goes to the BlueprintExecutor, so Discord creation overlaps
+        with generation. Returns None if nothing usable was generated. With a `job`, the
+        blueprint so far is saved as elements arrive, so a restart can finish the build.
+        """
         assert interaction.guild is not None
         guild = interaction.guild
+        parser = IncrementalBlueprintParser()
+        started = time.perf_counter()
+        first_channel: List[float] = []
+        
+        def channel_created():
+            if not first_channel:
+                first_channel.append(time.perf_counter() - started)
+                metrics.observe("setup.time_to_first_channel", first_channel[0])
+        
+        palette = self._role_palette(role_colors)
+        reconciler = BlueprintReconciler(guild, palette=palette, prune=prune)
+        executor = BlueprintExecutor(guild, palette=palette, on_channel_created=channel_created, job=job)
+        try:
+            async for delta in stream:
+                events = parser.feed(delta)
+                for kind, data in events:
+                    if kind == "role":
+                        role_data = reconciler.diff_role(data)
+                        if role_data:
+                            executor.add_role(role_data)
+                    else:
+                        cat_data, existing = reconciler.diff_category(data)
+                        if cat_data:
+                            executor.add_category(cat_data, existing=existing)
+                if events and job:
+                    await job.update_params(blueprint={"roles": parser.emitted["role"], "categories": parser.emitted["category"]})
+        finally:
+            # Give back the AI concurrency slot now if building failed mid-stream
+            await stream.aclose()
+            # Prune only against a complete blueprint
+            if parser.result() is not None:
+                reconciler.diff_deletes()
+            result = await reconciler.apply(executor)
+        
+        blueprint = parser.result()
+        if blueprint is None:
+            if not parser.emitted["role"] and not parser.emitted["category"]:
+                if job:
+                    await job.finish("failed", "no usable blueprint")
+                return None
+            # Truncated output: keep what was built, use defaults for the rest
+            blueprint = {"roles": parser.emitted["role"], "categories": parser.emitted["category"]}
+        elif job:
+            await job.update_params(blueprint=blueprint, complete=True)
         
         try:
-            color_palette = CoreHelper.get_color_palette(role_colors if role_colors != 'theme-based' else 'gamer')
-            
-            if custom_roles:
-                for i in range(role_count):
-                    try:
-                        if role_theme:
-                            role_name = f"{theme.title()} Member {i+1}"
-                        else:
-                            role_name = f"Role {i+1}"
-                        
-                        color = discord.Color(color_palette[i % len(color_palette)])
-                        await guild.create_role(name=role_name, color=color)
-                    except Exception:
-                        pass
+            await self._finish_setup(guild, blueprint, embeds, ai_embeds, moderation_logs, job)
+        except Exception as e:
+            logging.error(f"❌ AI server build failed after creating structure: {e}")
+        if job:
+            await job.finish()
+        
+        metrics.observe("setup.build_total", time.perf_counter() - started)
+        return result
 
-            for i in range(categories):
-                try:
-                    if role_theme:
-                        cat_name = f"{theme.title()} Category {i+1}"
-                    else:
-                        cat_name = f"Category {i+1}"
-                    
-                    category = await guild.create_category(cat_name)
-                    
-                    channels_per_cat = max(1, channels // categories)
-                    for j in range(channels_per_cat):
-                        try:
-                            if role_theme:
-                                channel_name = f"{theme.lower()}-channel-{j+1}"
-                            else:
-                                channel_name = f"channel-{j+1}"
-                            await guild.create_text_channel(channel_name, category=category)
-                        except Exception:
-                            pass
-                except Exception:
-                    pass
-            
-            if moderation_logs:
-                await self._create_moderation_system(guild)
-            
-            if embeds:
-                blueprint = {"welcome_message": f"Welcome to {guild.name}!", "rules": ["Be respectful", "No spam", "Follow Discord ToS"]}
-                await self._create_embeds(guild, blueprint, ai_embeds)
-            
-            return True
-        except Exception:
-            return False
+    @staticmethod
+    def _manual_palette(role_colors: str) -> List[int]:
+        return CoreHelper.get_color_palette(role_colors if role_colors != 'theme-based' else 'gamer')
+
+    @staticmethod
+    def _manual_blueprint(theme: str, channels: int, categories: int, custom_roles: bool, role_count: int, role_theme: bool) -> Dict[str, Any]:
+        blueprint: Dict[str, Any] = {"roles": [], "categories": []}
+        
+        if custom_roles:
+            for i in range(role_count):
+                role_name = f"{theme.title()} Member {i+1}" if role_theme else f"Role {i+1}"
+                blueprint["roles"].append({"name": role_name})
+
+        channels_per_cat = max(1, channels // max(1, categories))
+        for i in range(categories):
+            cat_name = f"{theme.title()} Category {i+1}" if role_theme else f"Category {i+1}"
+            blueprint["categories"].append({
+                "name": cat_name,
+                "channels": [
+                    {"name": f"{theme.lower()}-channel-{j+1}" if role_theme else f"channel-{j+1}", "type": "text"}
+                    for j in range(channels_per_cat)
+                ]
+            })
+        return blueprint
+
+    async def _build_server_manual(self, interaction: discord.Interaction, theme: str, channels: int, categories: int, custom_roles: bool, role_count: int, role_theme: bool, role_colors: str, embeds: bool, ai_embeds: bool, moderation_logs: bool, prune: bool = False, job: Optional[Job] = None) -> Optional[BuildResult]:
+        assert interaction.guild is not None
+        guild = interaction.guild
+        blueprint = self._manual_blueprint(theme, channels, categories, custom_roles, role_count, role_theme)
+        blueprint.update({"welcome_message": f"Welcome to {guild.name}!", "rules": ["Be respectful", "No spam", "Follow Discord ToS"]})
+        return await self._build_blueprint(guild, blueprint, self._manual_palette(role_colors), embeds, ai_embeds, moderation_logs, prune, job)
 
     async def _create_moderation_system(self, guild: discord.Guild):
         try:
@@ -1156,10 +5056,17 @@ Embeds: {embeds}"""
                 if role.permissions.administrator:
                     admin_overwrites[role] = discord.PermissionOverwrite(read_messages=True, send_messages=True)
             
-            mod_category = await guild.create_category("🛡️ Moderation", overwrites=admin_overwrites)
-            await guild.create_text_channel("mod-logs", category=mod_category, topic="Moderation action logs")
-            await guild.create_text_channel("admin-chat", category=mod_category, topic="Private admin discussion")
-            await guild.create_text_channel("reports", category=mod_category, topic="User reports and issues")
+            result = await reconcile_blueprint(guild, {"categories": [{
+                "name": "🛡️ Moderation",
+                "overwrites": admin_overwrites,
+                "channels": [
+                    {"name": "mod-logs", "topic": "Moderation action logs"},
+                    {"name": "admin-chat", "topic": "Private admin discussion"},
+                    {"name": "reports", "topic": "User reports and issues"}
+                ]
+            }]})
+            if not result.ok:
+                logging.error(f"Failed to create moderation system: {result.summary()}")
             
         except Exception as e:
             logging.error(f"Failed to create moderation system: {e}")
@@ -1176,25 +5083,17 @@ Embeds: {embeds}"""
                 general_channel = guild.text_channels[0] if guild.text_channels else None
             
             if general_channel:
+                ai_content: Dict[str, Any] = {}
                 if ai_embeds and hasattr(self.bot, 'ai_service'):
                     system_prompt = "Create Discord server welcome and rules embeds. Return JSON with embed content."
                     user_prompt = f"Server: {guild.name}, Theme: server theme, Create welcome message and rules"
-                    response = await self.bot.ai_service.generate_response(system_prompt, user_prompt)
-                    
-                    if response:
-                        try:
-                            ai_content = json.loads(response)
-                            welcome_msg = ai_content.get('welcome_message', blueprint.get('welcome_message', f'Welcome to {guild.name}!'))
-                            rules = ai_content.get('rules', blueprint.get('rules', ['Be respectful', 'No spam', 'Follow Discord ToS']))
-                        except:
-                            welcome_msg = blueprint.get('welcome_message', f'Welcome to {guild.name}!')
-                            rules = blueprint.get('rules', ['Be respectful', 'No spam', 'Follow Discord ToS'])
-                    else:
-                        welcome_msg = blueprint.get('welcome_message', f'Welcome to {guild.name}!')
-                        rules = blueprint.get('rules', ['Be respectful', 'No spam', 'Follow Discord ToS'])
-                else:
-                    welcome_msg = blueprint.get('welcome_message', f'Welcome to {guild.name}!')
-                    rules = blueprint.get('rules', ['Be respectful', 'No spam', 'Follow Discord ToS'])
+                    try:
+                        ai_content = await self.bot.ai_service.generate_json(system_prompt, user_prompt, EMBED_CONTENT_SCHEMA, guild_id=guild.id, command="setup-embeds") or {}
+                    except (AIOutputError, CircuitOpenError):
+                        pass
+                
+                welcome_msg = ai_content.get('welcome_message', blueprint.get('welcome_message', f'Welcome to {guild.name}!'))
+                rules = ai_content.get('rules', blueprint.get('rules', ['Be respectful', 'No spam', 'Follow Discord ToS']))
                 
                 welcome_embed = discord.Embed(
                     title=f"Welcome to {guild.name}!",
@@ -1230,14 +5129,12 @@ Embeds: {embeds}"""
         if use_ai and names:
             system_prompt = "Generate themed Discord channel names. Return JSON array of channel names."
             user_prompt = f"Base names: {names}, Count: {count}, Theme: server appropriate"
-            response = await self.bot.ai_service.generate_response(system_prompt, user_prompt)
-            
-            if response:
-                try:
-                    ai_names = json.loads(response)
+            try:
+                ai_names = await self.bot.ai_service.generate_json(system_prompt, user_prompt, CHANNEL_NAMES_SCHEMA, guild_id=interaction.guild.id, command="add-channels")
+                if ai_names:
                     names = ",".join(ai_names[:count])
-                except:
-                    pass
+            except (AIOutputError, CircuitOpenError):
+                pass
         
         if names:
             channel_names = [name.strip() for name in names.split(',')][:count]
@@ -1307,23 +5204,24 @@ Embeds: {embeds}"""
         admin_channel = await CoreHelper.ensure_admin_channel(interaction.guild)
         deleted = 0
         
-        if all_channels:
-            for channel in list(interaction.guild.channels):
-                if channel != admin_channel and channel.name != CoreHelper.ADMIN_CHANNEL_NAME:
-                    try:
-                        await channel.delete()
-                        deleted += 1
-                    except Exception:
-                        pass
-        elif names:
-            target_names = [name.strip().lower() for name in names.split(',')]
-            for channel in list(interaction.guild.channels):
-                if channel.name.lower() in target_names and channel != admin_channel:
-                    try:
-                        await channel.delete()
-                        deleted += 1
-                    except Exception:
-                        pass
+        with rest_lane("bulk", interaction.guild.id):
+            if all_channels:
+                for channel in list(interaction.guild.channels):
+                    if channel != admin_channel and channel.name != CoreHelper.ADMIN_CHANNEL_NAME:
+                        try:
+                            await channel.delete()
+                            deleted += 1
+                        except Exception:
+                            pass
+            elif names:
+                target_names = [name.strip().lower() for name in names.split(',')]
+                for channel in list(interaction.guild.channels):
+                    if channel.name.lower() in target_names and channel != admin_channel:
+                        try:
+                            await channel.delete()
+                            deleted += 1
+                        except Exception:
+                            pass
         
         await interaction.followup.send(f"✅ Deleted {deleted} channels")
 
@@ -1521,7 +5419,7 @@ Embeds: {embeds}"""
         if use_ai and rename_only:
             system_prompt = "Generate new channel and role names based on theme. Return JSON with name mappings."
             user_prompt = f"Theme: {new_theme}, Current channels: {[ch.name for ch in interaction.guild.channels[:10]]}"
-            response = await self.bot.ai_service.generate_response(system_prompt, user_prompt)
+            response = await self.bot.ai_service.generate_response(system_prompt, user_prompt, guild_id=interaction.guild.id, command="theme")
             
             if response:
                 await interaction.followup.send(f"✅ Theme '{new_theme}' applied with AI renaming")
@@ -1552,12 +5450,13 @@ Embeds: {embeds}"""
             target_channels = [ch for ch in interaction.guild.text_channels 
                              if ch.name.lower() in target_names and ch.name != CoreHelper.ADMIN_CHANNEL_NAME]
         
-        for channel in target_channels:
-            try:
-                deleted = await channel.purge(limit=min(limit, 100))
-                cleaned += len(deleted)
-            except Exception:
-                pass
+        with rest_lane("bulk", interaction.guild.id):
+            for channel in target_channels:
+                try:
+                    deleted = await channel.purge(limit=min(limit, 100))
+                    cleaned += len(deleted)
+                except Exception:
+                    pass
         
         await interaction.followup.send(f"✅ Cleaned {cleaned} messages from {len(target_channels)} channels")
 
@@ -1604,27 +5503,11 @@ Embeds: {embeds}"""
         
         await interaction.response.defer(thinking=True, ephemeral=True)
         
-        admin_channel = await CoreHelper.ensure_admin_channel(interaction.guild)
-        deleted = {"channels": 0, "roles": 0, "categories": 0}
-        
-        for channel in list(interaction.guild.channels):
-            if channel != admin_channel and channel.name != CoreHelper.ADMIN_CHANNEL_NAME:
-                try:
-                    if isinstance(channel, discord.CategoryChannel):
-                        deleted["categories"] += 1
-                    else:
-                        deleted["channels"] += 1
-                    await channel.delete()
-                except Exception:
-                    pass
-        
-        for role in list(interaction.guild.roles):
-            if not role.is_default() and not role.managed and role < interaction.guild.me.top_role:
-                try:
-                    await role.delete()
-                    deleted["roles"] += 1
-                except Exception:
-                    pass
+        guild = interaction.guild
+        admin_channel = await CoreHelper.ensure_admin_channel(guild)
+        job = await job_store.create("nuke", guild.id, admin_channel.id if admin_channel else None, {})
+        await job.add_steps(self._plan_nuke(guild, admin_channel))
+        deleted = await self._run_nuke(guild, job)
         
         try:
             await interaction.followup.send(f"💥 Nuke complete: {deleted['channels']} channels, {deleted['categories']} categories, {deleted['roles']} roles deleted")
@@ -1632,6 +5515,88 @@ Embeds: {embeds}"""
             if admin_channel:
                 await admin_channel.send(f"💥 Nuke complete: {deleted['channels']} channels, {deleted['categories']} categories, {deleted['roles']} roles deleted")
 
+    @staticmethod
+    def _plan_nuke(guild: discord.Guild, admin_channel: Optional[discord.TextChannel]) -> List[Tuple[str, Optional[int]]]:
+        """Job steps for every channel and role a nuke deletes
+        
+        The targets are fixed up front, so a resumed nuke never deletes anything created
+        after the confirmation.
+        """
+        steps: List[Tuple[str, Optional[int]]] = []
+        for channel in list(guild.channels):
+            if channel != admin_channel and channel.name != CoreHelper.ADMIN_CHANNEL_NAME:
+                kind = "category" if channel.type == discord.ChannelType.category else "channel"
+                steps.append((f"{kind}:{channel.id}", channel.id))
+        for role in list(guild.roles):
+            if not role.is_default() and not role.managed and role < guild.me.top_role:
+                steps.append((f"role:{role.id}", role.id))
+        return steps
+
+    async def _run_nuke(self, guild: discord.Guild, job: Job) -> Dict[str, int]:
+        """Delete every pending target of a nuke job, checkpointing each deletion"""
+        for key, discord_id in job.pending():
+            kind = key.split(":", 1)[0]
+            target = guild.get_role(discord_id or 0) if kind == "role" else guild.get_channel(discord_id or 0)
+            if target is not None:
+                try:
+                    with rest_lane("bulk", guild.id):
+                        await target.delete()
+                except Exception as e:
+                    logging.warning(f"⚠️ Nuke could not delete {kind} {discord_id}: {e}")
+                    await job.checkpoint(key, discord_id, "failed")
+                    continue
+            await job.checkpoint(key, discord_id)
+        await job.finish()
+        done = Counter(key.split(":", 1)[0] for key, (status, _) in job.steps.items() if status == "done")
+        return {"channels": done["channel"], "categories": done["category"], "roles": done["role"]}
+
+    async def resume_jobs(self):
+        """Finish /setup, /admin-setup and /nuke jobs that a restart interrupted"""
+        try:
+            jobs = await job_store.unfinished()
+        except Exception as e:
+            logging.error(f"❌ Could not load interrupted jobs: {e}")
+            return
+        
+        for job in jobs:
+            guild = self.bot.get_guild(job.guild_id)
+            if guild is None:
+                await job.finish("failed", "guild unavailable")
+                continue
+            logging.info(f"🔁 Resuming {job.kind} job {job.id} in {guild.name} ({len(job.steps)} steps recorded)")
+            try:
+                summary = await self._resume_job(guild, job)
+            except Exception as e:
+                logging.error(f"❌ Resuming {job.kind} job {job.id} failed: {e}")
+                await job.finish("failed", str(e))
+                continue
+            
+            channel = guild.get_channel(job.channel_id or 0)
+            if isinstance(channel, discord.TextChannel):
+                try:
+                    await channel.send(f"🔁 Resumed an interrupted /{job.kind} after a restart: {summary}")
+                except Exception as e:
+                    logging.warning(f"⚠️ Could not report resumed {job.kind} job: {e}")
+
+    async def _resume_job(self, guild: discord.Guild, job: Job) -> str:
+        if job.kind == "nuke":
+            deleted = await self._run_nuke(guild, job)
+            return f"{deleted['channels']} channels, {deleted['categories']} categories, {deleted['roles']} roles deleted"
+        if job.kind == "admin-setup":
+            return (await self._run_admin_setup(guild, job)).summary()
+        if job.kind == "setup":
+            blueprint = job.params.get("blueprint")
+            if not blueprint:
+                await job.finish("failed", "interrupted before any layout was generated")
+                return "the layout had not been generated yet, please run /setup again"
+            result = await self._build_blueprint(
+                guild, blueprint, job.params.get("palette"), job.params.get("embeds", False), job.params.get("ai_embeds", False),
+                job.params.get("moderation_logs", False), job.params.get("prune", False) and job.params.get("complete", False), job
+            )
+            return result.summary() if result else "the build failed"
+        await job.finish("failed", f"unknown job kind {job.kind}")
+        return "unknown job"
+
     @app_commands.command(name="ai-cleanup", description="🤖 Interactive AI-powered server structure optimization")
     @app_commands.describe(
         analysis_depth="How deep should the AI analyze?",
@@ -1685,35 +5650,157 @@ RULES:
 - NEVER suggest role deletions or major permission changes
 - Be extremely conservative - when in doubt, don't suggest the fix"""
 
-        user_prompt = f"""Server: {guild.name}
+        def build_user_prompt(data: Dict[str, Any]) -> str:
+            return f"""Server: {guild.name}
 Analysis Depth: {analysis_depth}
 Focus Area: {focus_area}
-Data: {json.dumps(analysis_data, indent=2)}
+Data: {prompt_encoder.encode(data)}
 
 Identify specific issues and provide actionable recommendations."""
 
+        # Every chunk reserves its prompt plus the route's max_tokens from the guild's token bucket up
+        # front; only as many chunks as the bucket holds can run without waiting past the timeout
+        route = self.bot.ai_service.router.select("ai-cleanup", AI_PROMPT_TOKEN_BUDGET)
+        max_chunks = max(1, min(AI_CLEANUP_MAX_CHUNKS, int(AI_GUILD_TPM // (AI_PROMPT_TOKEN_BUDGET + route.max_tokens))))
+        user_prompts, skipped = self._chunk_cleanup_prompts(analysis_data, build_user_prompt,
+                                                            AI_PROMPT_TOKEN_BUDGET - prompt_encoder.count_tokens(system_prompt),
+                                                            max_chunks)
+        if skipped:
+            await interaction.followup.send(
+                f"⚠️ This server is too large to analyze in one run: {skipped} were not analyzed. "
+                "Use a narrower focus area to cover the rest.",
+                ephemeral=True
+            )
+
         try:
-            response = await asyncio.wait_for(
-                self.bot.ai_service.generate_response(system_prompt, user_prompt), 
+            cleanup_plan = await asyncio.wait_for(
+                self._generate_cleanup_plan(guild, system_prompt, user_prompts), 
                 timeout=30.0
             )
             
-            if response:
-                try:
-                    cleanup_plan = json.loads(response)
-                    logging.info(f"AI cleanup plan generated: {len(cleanup_plan.get('issues', []))} issues found")
-                    await self._start_interactive_cleanup(interaction, cleanup_plan)
-                except json.JSONDecodeError as e:
-                    logging.error(f"Failed to parse AI response: {e}")
-                    await interaction.followup.send("❌ AI analysis failed to parse response", ephemeral=True)
+            if cleanup_plan is not None:
+                logging.info(f"AI cleanup plan generated: {len(cleanup_plan.get('issues', []))} issues found")
+                await self._start_interactive_cleanup(interaction, cleanup_plan)
             else:
                 await interaction.followup.send("❌ AI analysis service returned empty response", ephemeral=True)
+        except AIOutputError as e:
+            logging.error(f"Failed to parse AI response: {e}")
+            await interaction.followup.send("❌ AI analysis failed to parse response", ephemeral=True)
+        except CircuitOpenError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
         except asyncio.TimeoutError:
             await interaction.followup.send("❌ AI analysis timed out (30s limit)", ephemeral=True)
         except Exception as e:
             logging.error(f"AI cleanup failed: {e}")
             await interaction.followup.send(f"❌ AI cleanup failed: {str(e)}", ephemeral=True)
 
+    def _chunk_cleanup_prompts(self, analysis: Dict[str, Any], build_prompt, budget: int,
+                               max_chunks: int = AI_CLEANUP_MAX_CHUNKS) -> Tuple[List[str], str]:
+        """Split an over-budget analysis into per-category prompts that each fit `budget` tokens
+        
+        Roles, uncategorized channels and the remaining analysis sections are packed into the
+        same chunks after the categories; a category that alone exceeds the budget is split
+        by channel. At most `max_chunks` prompts are returned, with a description of what the
+        dropped chunks held ("" if nothing was dropped).
+        """
+        prompt = build_prompt(analysis)
+        tokens = prompt_encoder.count_tokens(prompt)
+        metrics.set_gauge("ai_cleanup.prompt_tokens", tokens)
+        if tokens <= budget:
+            return [prompt], ""
+        
+        base = {key: analysis[key] for key in ("server_name", "member_count") if key in analysis}
+        overhead = prompt_encoder.count_tokens(build_prompt(base))
+        
+        def cost(key: str, item: Any) -> int:
+            return prompt_encoder.count_tokens(prompt_encoder.encode({key: [item]}))
+        
+        units: List[Tuple[str, Any, int]] = []
+        for category in analysis.get("categories", []):
+            category_cost = cost("categories", category)
+            if overhead + category_cost <= budget or not category.get("channels"):
+                units.append(("categories", category, category_cost))
+                continue
+            # Split an oversized category into parts that keep its name
+            part: List[Any] = []
+            part_cost = cost("categories", {**category, "channels": []})
+            for channel in category["channels"]:
+                channel_cost = cost("channels", channel)
+                if part and overhead + part_cost + channel_cost > budget:
+                    units.append(("categories", {**category, "channels": part}, part_cost))
+                    part, part_cost = [], cost("categories", {**category, "channels": []})
+                part.append(channel)
+                part_cost += channel_cost
+            units.append(("categories", {**category, "channels": part}, part_cost))
+        for key in ("roles", "channels"):
+            units.extend((key, item, cost(key, item)) for item in analysis.get(key, []))
+        for key, value in analysis.items():
+            if key not in base and key not in ("categories", "roles", "channels") and value:
+                units.append((key, value, prompt_encoder.count_tokens(prompt_encoder.encode({key: value}))))
+        
+        chunks: List[Dict[str, Any]] = []
+        chunk: Dict[str, Any] = dict(base)
+        chunk_cost = overhead
+        for key, item, item_cost in units:
+            if len(chunk) > len(base) and chunk_cost + item_cost > budget:
+                chunks.append(chunk)
+                chunk, chunk_cost = dict(base), overhead
+            if key in ("categories", "roles", "channels"):
+                chunk.setdefault(key, []).append(item)
+            else:
+                chunk[key] = item
+            chunk_cost += item_cost
+        if len(chunk) > len(base):
+            chunks.append(chunk)
+        
+        skipped = ""
+        if len(chunks) > max_chunks:
+            metrics.increment("ai_cleanup.chunks_dropped", len(chunks) - max_chunks)
+            logging.warning(f"Server analysis needs {len(chunks)} chunks; analyzing the first {max_chunks}")
+            dropped = Counter()
+            for chunk in chunks[max_chunks:]:
+                for key in ("categories", "roles", "channels"):
+                    dropped[key] += len(chunk.get(key, []))
+            skipped = ", ".join(f"{count} {key}" for key, count in dropped.items() if count) or "some analysis sections"
+            chunks = chunks[:max_chunks]
+        metrics.increment("ai_cleanup.chunked")
+        return [build_prompt(chunk) for chunk in chunks], skipped
+
+    async def _generate_cleanup_plan(self, guild: discord.Guild, system_prompt: str, user_prompts: List[str]) -> Optional[Dict[str, Any]]:
+        """Analyze each chunk concurrently and merge the partial plans"""
+        results = await asyncio.gather(*[
+            self.bot.ai_service.generate_json(system_prompt, user_prompt, CLEANUP_PLAN_SCHEMA, guild_id=guild.id, command="ai-cleanup")
+            for user_prompt in user_prompts
+        ], return_exceptions=True)
+        
+        plans = [result for result in results if isinstance(result, dict)]
+        if not plans:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            return None
+        if len(plans) < len(results):
+            logging.warning(f"AI cleanup: {len(results) - len(plans)}/{len(results)} analysis chunks failed")
+        return self._merge_cleanup_plans(plans)
+
+    @staticmethod
+    def _merge_cleanup_plans(plans: List[Dict[str, Any]]) -> Dict[str, Any]:
+        merged: Dict[str, Any] = {"issues": [], "optimization_suggestions": []}
+        seen_issues = set()
+        seen_suggestions = set()
+        for plan in plans:
+            for issue in plan.get("issues", []):
+                key = (issue["type"], issue["description"].lower(), tuple(sorted(issue.get("affected_items", []))))
+                if key not in seen_issues:
+                    seen_issues.add(key)
+                    merged["issues"].append(issue)
+            for suggestion in plan.get("optimization_suggestions", []):
+                key = suggestion["suggestion"].lower()
+                if key not in seen_suggestions:
+                    seen_suggestions.add(key)
+                    merged["optimization_suggestions"].append(suggestion)
+        return merged
+
     async def _analyze_server_structure(self, guild: discord.Guild, depth: str, focus: str) -> Dict[str, Any]:
         try:
             analysis = {
@@ -2327,10 +6414,12 @@ async def main():
         bot_instance = bot
         
         # Check if we have required connections
-        if not supabase:
+        if not repository.available:
             logging.warning("⚠️ No Supabase connection - subscription features will be disabled")
         
-        if not OPENAI_API_KEY:
+        if AI_BACKEND_MODE == "replay":
+            logging.warning(f"⚠️ AI responses are replayed from fixtures in {AI_FIXTURES_DIR}")
+        elif not OPENAI_API_KEY:
             logging.warning("⚠️ No OpenAI API key - AI features will be disabled")
         
         logging.info("🚀 Starting BuildForMe Bot...")
@@ -2354,6 +6443,7 @@ async def main():
         logging.info("✅ Bot shutdown complete")
 
 if __name__ == "__main__":
+    validate_environment()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Keep the bot's log file and local state out of the working tree while tests import it
+_scratch = tempfile.mkdtemp(prefix="buildforme-tests-")
+os.environ.setdefault("LOG_FILE", os.path.join(_scratch, "bot.log"))
+os.environ.setdefault("BOT_STATE_DB", os.path.join(_scratch, "bot_state.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,57 @@
+import asyncio
+
+import professional_builder_bot as bot
+
+
+class FlakySpool:
+    """write_spool stand-in that fails, hangs or accepts batches as scripted"""
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.written = []
+
+    async def submit_many(self, table, op, rows):
+        action = self.script.pop(0) if self.script else "ok"
+        if action == "fail":
+            raise ConnectionError("spool unavailable")
+        if action == "hang":
+            await asyncio.sleep(3600)
+        self.written.extend(rows)
+
+
+def rows(count):
+    return [{"command_name": f"command-{i}"} for i in range(count)]
+
+
+def test_failed_batch_is_kept_for_the_next_flush(monkeypatch):
+    spool = FlakySpool(["fail"])
+    monkeypatch.setattr(bot, "write_spool", spool)
+    batcher = bot.ActivityLogBatcher(batch_size=2)
+    for row in rows(3):
+        batcher.enqueue(row)
+
+    asyncio.run(batcher.flush())
+    assert len(batcher._buffer) == 3
+    asyncio.run(batcher.flush())
+    assert spool.written == rows(3)
+
+
+def test_cancelled_flush_keeps_its_batch(monkeypatch):
+    spool = FlakySpool(["hang"])
+    monkeypatch.setattr(bot, "write_spool", spool)
+    batcher = bot.ActivityLogBatcher(batch_size=2)
+    for row in rows(3):
+        batcher.enqueue(row)
+
+    async def run():
+        flush = asyncio.create_task(batcher.flush())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        try:
+            await flush
+        except asyncio.CancelledError:
+            pass
+        await batcher.flush()
+
+    asyncio.run(run())
+    assert spool.written == rows(3)
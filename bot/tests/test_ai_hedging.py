@@ -0,0 +1,108 @@
+import asyncio
+
+import professional_builder_bot as bot
+
+
+class ScriptedModel:
+    """Completion stand-in whose successive calls take the given latencies"""
+
+    def __init__(self, latencies):
+        self.latencies = list(latencies)
+        self.calls = 0
+
+    async def completion(self, system_prompt, user_prompt, partial=None, route=None):
+        latency = self.latencies[min(self.calls, len(self.latencies) - 1)]
+        self.calls += 1
+        await asyncio.sleep(latency)
+        return {"content": "ok", "finish_reason": "stop", "prompt_tokens": 10, "completion_tokens": 5, "model": "fake"}
+
+
+def run_hedged(monkeypatch, latencies, max_concurrency=4):
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(bot, "AI_HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(bot, "AI_HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(bot, "AI_HEDGE_MAX_RATE", 1.0)
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+
+    async def run():
+        service = bot.AIService(None)
+        service._semaphore = asyncio.Semaphore(max_concurrency)
+        service._latencies["default"] = bot.deque([0.01] * 20)
+        model = ScriptedModel(latencies)
+        service._request_completion = model.completion
+        tokens_before = service._global_tokens.tokens
+        route = service.router.default
+        async with service._semaphore:
+            result = await service._attempt_completion("system", "user", 1000, route, guild_id=1, command="test")
+        await asyncio.sleep(0.05)
+        service._global_tokens._refill()
+        return result, model, service, tokens_before
+
+    return asyncio.run(run())
+
+
+def hedge_rows():
+    return [row for row in bot.ai_usage.snapshot()["totals"] if row["command"] == "test"]
+
+
+def test_cancelled_hedge_refunds_its_budget_and_slot(monkeypatch):
+    # The primary finishes just after the hedge fires, so the hedge is cancelled
+    result, model, service, tokens_before = run_hedged(monkeypatch, [0.08, 1.0])
+    assert result["content"] == "ok"
+    assert model.calls == 2
+    assert service._semaphore._value == 4
+    assert service._global_tokens.tokens >= tokens_before - 1
+    assert hedge_rows()[0]["calls"] == 1
+
+
+def test_winning_hedge_is_accounted(monkeypatch):
+    result, model, service, tokens_before = run_hedged(monkeypatch, [1.0, 0.01])
+    assert result["content"] == "ok"
+    assert service._semaphore._value == 4
+    rows = hedge_rows()
+    assert rows[0]["prompt_tokens"] == 10 and rows[0]["completion_tokens"] == 5
+
+
+def test_no_hedge_without_a_free_slot(monkeypatch):
+    result, model, service, tokens_before = run_hedged(monkeypatch, [0.1, 0.01], max_concurrency=1)
+    assert model.calls == 1
+    assert service._semaphore._value == 1
+    assert not hedge_rows()
+
+
+def generate_hedged(monkeypatch, latencies):
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(bot, "AI_HEDGE_MIN_SAMPLES", 1)
+    monkeypatch.setattr(bot, "AI_HEDGE_MIN_DELAY", 0.05)
+    monkeypatch.setattr(bot, "AI_HEDGE_MAX_RATE", 1.0)
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+
+    async def run():
+        service = bot.AIService(None)
+        service.backend.mode = "replay"
+        service.breaker = bot.CircuitBreaker("test_hedge_tokens", "The AI service", min_calls=100)
+        service._latencies["default"] = bot.deque([0.01] * 20)
+        model = ScriptedModel(latencies)
+        service._request_completion = model.completion
+        content = await service.generate_response("system", "user", guild_id=1, command="test", use_cache=False)
+        await asyncio.sleep(0.05)
+        return content, model
+
+    return asyncio.run(run())
+
+
+def token_totals():
+    rows = hedge_rows()
+    return sum(row["prompt_tokens"] for row in rows), sum(row["completion_tokens"] for row in rows)
+
+
+def test_hedge_won_tokens_are_counted_once(monkeypatch):
+    content, model = generate_hedged(monkeypatch, [1.0, 0.01])
+    assert content == "ok" and model.calls == 2
+    assert token_totals() == (10, 5)
+
+
+def test_primary_won_tokens_are_counted_once(monkeypatch):
+    content, model = generate_hedged(monkeypatch, [0.08, 1.0])
+    assert content == "ok" and model.calls == 2
+    assert token_totals() == (10, 5)
@@ -0,0 +1,83 @@
+import pytest
+
+import professional_builder_bot as bot
+
+# Recorded malformed model outputs: (case, schema, raw output, expected value or None if unparseable)
+AI_OUTPUT_CORPUS = [
+    (
+        "markdown fence",
+        bot.CHANNEL_NAMES_SCHEMA,
+        '```json\n["general-chat", "memes"]\n```',
+        ["general-chat", "memes"]
+    ),
+    (
+        "prose around the document",
+        bot.EMBED_CONTENT_SCHEMA,
+        'Sure! Here is your content:\n{"welcome_message": "Hi there"}\nLet me know if you need more.',
+        {"welcome_message": "Hi there"}
+    ),
+    (
+        "trailing commas",
+        bot.BLUEPRINT_SCHEMA,
+        '{"categories": [{"name": "Chat", "channels": [{"name": "general", "type": "text"},],},], "rules": ["Be nice",],}',
+        {"categories": [{"name": "Chat", "channels": [{"name": "general", "type": "text"}]}], "rules": ["Be nice"]}
+    ),
+    (
+        "truncated inside a channel list",
+        bot.BLUEPRINT_SCHEMA,
+        '{"categories": [{"name": "Chat", "channels": [{"name": "general", "type": "text"}, {"name": "vo',
+        {"categories": [{"name": "Chat", "channels": [{"name": "general", "type": "text"}]}]}
+    ),
+    (
+        "truncated inside a rules string",
+        bot.BLUEPRINT_SCHEMA,
+        '{"categories": [], "rules": ["Be respectful", "No spam", "Follow the Discord Te',
+        {"categories": [], "rules": ["Be respectful", "No spam"]}
+    ),
+    (
+        "python literals",
+        bot.CLEANUP_PLAN_SCHEMA,
+        '{"issues": [{"type": "naming_inconsistency", "severity": "Low", "description": "Spaces in names", '
+        '"current_state": "general chat", "proposed_solution": "general-chat", "auto_fixable": True}], '
+        '"optimization_suggestions": None}',
+        {"issues": [{"type": "naming_inconsistency", "severity": "low", "description": "Spaces in names",
+                     "current_state": "general chat", "proposed_solution": "general-chat", "auto_fixable": True}]}
+    ),
+    (
+        "invalid items and enum values",
+        bot.BLUEPRINT_SCHEMA,
+        '{"categories": [{"name": "Voice", "channels": [{"type": "voice"}, {"name": "Lounge", "type": "stage"}]}, '
+        '{"channels": []}], "roles": [{"name": "Member"}, "Admin"]}',
+        {"categories": [{"name": "Voice", "channels": [{"name": "Lounge", "type": "text"}]}],
+         "roles": [{"name": "Member", "color": "#99aab5"}]}
+    ),
+    (
+        "cleanup issue missing required fields",
+        bot.CLEANUP_PLAN_SCHEMA,
+        '{"issues": [{"type": "permission_redundancy", "description": "Redundant overwrite"}], "optimization_suggestions": []}',
+        {"issues": [], "optimization_suggestions": []}
+    ),
+    (
+        "missing required top-level key",
+        bot.BLUEPRINT_SCHEMA,
+        '{"roles": [{"name": "Member"}]}',
+        None
+    ),
+    (
+        "no JSON at all",
+        bot.CHANNEL_NAMES_SCHEMA,
+        "I'm sorry, I can't help with that.",
+        None
+    ),
+]
+
+
+@pytest.mark.parametrize("schema, raw, expected", [case[1:] for case in AI_OUTPUT_CORPUS],
+                         ids=[case[0] for case in AI_OUTPUT_CORPUS])
+def test_recorded_output(schema, raw, expected):
+    if expected is None:
+        with pytest.raises(bot.AIOutputError):
+            bot.AIOutputParser.parse(raw, schema)
+    else:
+        value, _ = bot.AIOutputParser.parse(raw, schema)
+        assert value == expected
@@ -0,0 +1,82 @@
+import asyncio
+import tempfile
+from types import SimpleNamespace
+
+import professional_builder_bot as bot
+
+REPLY = '{"categories": [{"name": "Lobby", "channels": [{"name": "general", "type": "text"}]}]}'
+
+
+class FakeOpenAI:
+    """Just enough of AsyncOpenAI for chat completions, streamed or not"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, temperature, max_tokens, stream=False):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if stream:
+            return self.stream(model)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(message=SimpleNamespace(content=REPLY), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=12, completion_tokens=34)
+        )
+
+    async def stream(self, model):
+        for i in range(0, len(REPLY), 10):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=REPLY[i:i + 10]), finish_reason=None)])
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None), finish_reason="stop")])
+
+    async def close(self):
+        pass
+
+
+def make_service(mode, directory, client=None):
+    service = bot.AIService(None)
+    service.client = client
+    service.backend = bot.RecordReplayBackend(mode=mode, directory=directory, latency="none")
+    service.breaker = bot.CircuitBreaker(f"test_{mode}", "The AI service", min_calls=100)
+    return service
+
+
+async def session(service):
+    """One blocking and one streamed request, as a command would make them"""
+    blocking = await service.generate_response("system", "build a lobby", command="setup", use_cache=False)
+    streamed = "".join([delta async for delta in service.stream_response("system", "stream a lobby", use_cache=False)])
+    return blocking, streamed
+
+
+def test_recorded_session_replays_offline(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", False)
+    directory = tempfile.mkdtemp(prefix="ai-fixtures-")
+    client = FakeOpenAI()
+
+    recorded = asyncio.run(session(make_service("record", directory, client)))
+    replayed = [asyncio.run(session(make_service("replay", directory))) for _ in range(2)]
+
+    assert recorded == (REPLY, REPLY)
+    assert replayed == [recorded, recorded]
+    # Replay never reached the client
+    assert client.calls == 2
+
+
+def test_replay_of_an_unrecorded_request_fails_instead_of_going_live(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", False)
+    client = FakeOpenAI()
+    service = make_service("replay", tempfile.mkdtemp(prefix="ai-fixtures-"), client)
+
+    result = asyncio.run(service.generate_response("system", "never recorded", max_retries=1, use_cache=False))
+
+    assert result is None
+    assert client.calls == 0
+
+
+def test_sampled_replay_latency_is_reproducible_with_a_seed():
+    first = bot.RecordReplayBackend(mode="replay", latency="lognormal:0.5,0.3", seed="7")
+    second = bot.RecordReplayBackend(mode="replay", latency="lognormal:0.5,0.3", seed="7")
+    assert [first.sample_latency(1.0) for _ in range(5)] == [second.sample_latency(1.0) for _ in range(5)]
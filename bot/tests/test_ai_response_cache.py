@@ -0,0 +1,106 @@
+import asyncio
+import os
+import tempfile
+
+import pytest
+
+import professional_builder_bot as bot
+
+
+class Clock:
+    """Settable stand-in for time.time"""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(bot.time, "time", clock)
+    return clock
+
+
+def make_store():
+    return bot.LocalStateStore(os.path.join(tempfile.mkdtemp(prefix="ai-cache-test-"), "state.db"))
+
+
+def test_key_covers_model_prompts_and_temperature():
+    key = bot.AIResponseCache.make_key("gpt", "system", "user", 0.7)
+    assert key == bot.AIResponseCache.make_key("gpt", "system", "user", 0.7)
+    variants = [("gpt-mini", "system", "user", 0.7), ("gpt", "system ", "user", 0.7),
+                ("gpt", "system", "User", 0.7), ("gpt", "system", "user", 0.2),
+                # Field boundaries are part of the key, not just the concatenated text
+                ("gpt", "systemuser", "", 0.7)]
+    assert len({key} | {bot.AIResponseCache.make_key(*variant) for variant in variants}) == len(variants) + 1
+
+
+def test_entries_expire_after_the_ttl_in_both_tiers(clock):
+    store = make_store()
+
+    async def run():
+        cache = bot.AIResponseCache(store, ttl=60)
+        await cache.put("k", "blueprint", 100)
+        assert await cache.get("k") == "blueprint"
+        # A fresh instance has an empty memory tier, so this is served from disk
+        assert await bot.AIResponseCache(store, ttl=60).get("k") == "blueprint"
+        clock.now += 61
+        return await cache.get("k"), await bot.AIResponseCache(store, ttl=60).get("k")
+
+    assert asyncio.run(run()) == (None, None)
+
+
+def fill_and_touch(cache, clock):
+    """Store a and b, read a, then store c, so b is the least recently used"""
+    async def run():
+        for key in ("a", "b"):
+            await cache.put(key, key, 1)
+            clock.now += 1
+        await cache.get("a")
+        clock.now += 1
+        await cache.put("c", "c", 1)
+    asyncio.run(run())
+
+
+def test_memory_tier_evicts_the_least_recently_used(clock):
+    cache = bot.AIResponseCache(make_store(), memory_entries=2)
+    fill_and_touch(cache, clock)
+    assert list(cache._memory) == ["a", "c"]
+
+
+def test_disk_tier_evicts_the_least_recently_used(clock):
+    store = make_store()
+    # Without a memory tier every read goes to disk and refreshes the entry there
+    fill_and_touch(bot.AIResponseCache(store, memory_entries=0, disk_entries=2), clock)
+
+    async def run():
+        cache = bot.AIResponseCache(store, memory_entries=0)
+        return [await cache.get(key) for key in ("a", "b", "c")]
+
+    assert asyncio.run(run()) == ["a", None, "c"]
+
+
+def test_excluded_commands_bypass_the_cache(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", False)
+    monkeypatch.setattr(bot, "AI_CACHE_EXCLUDED_COMMANDS", {"ai-cleanup"})
+    calls = []
+
+    async def completion(system_prompt, user_prompt, partial=None, route=None):
+        calls.append(user_prompt)
+        return {"content": "ok", "finish_reason": "stop", "prompt_tokens": 1, "completion_tokens": 1, "model": "fake"}
+
+    async def run():
+        service = bot.AIService(None)
+        service.cache = bot.AIResponseCache(make_store())
+        service.backend.mode = "replay"
+        service.breaker = bot.CircuitBreaker("test_cache_bypass", "The AI service", min_calls=100)
+        service._request_completion = completion
+        for command in ("setup", "setup", "ai-cleanup", "ai-cleanup"):
+            await service.generate_response("system", command, command=command)
+
+    asyncio.run(run())
+    assert calls == ["setup", "ai-cleanup", "ai-cleanup"]
@@ -0,0 +1,52 @@
+import asyncio
+
+import professional_builder_bot as bot
+
+
+def test_backoff_between_retries_frees_the_slot(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", False)
+    finished = {}
+
+    async def completion(system_prompt, user_prompt, partial=None, route=None):
+        if user_prompt == "flaky" and "flaky" not in finished:
+            finished["flaky"] = None
+            raise ConnectionError("upstream reset")
+        finished[user_prompt] = asyncio.get_running_loop().time()
+        return {"content": "ok", "finish_reason": "stop", "prompt_tokens": 1, "completion_tokens": 1, "model": "fake"}
+
+    async def run():
+        service = bot.AIService(None)
+        service.backend.mode = "replay"
+        service.breaker = bot.CircuitBreaker("test_backoff", "The AI service", min_calls=100)
+        service._semaphore = asyncio.Semaphore(1)
+        service._request_completion = completion
+        flaky = asyncio.create_task(service.generate_response("system", "flaky", max_retries=2, use_cache=False))
+        await asyncio.sleep(0.05)
+        started = asyncio.get_running_loop().time()
+        await service.generate_response("system", "steady", use_cache=False)
+        await flaky
+        return started
+
+    started = asyncio.run(run())
+    # The steady request ran during the flaky one's 1s backoff, not after it
+    assert finished["steady"] - started < 0.5
+    assert finished["flaky"] > finished["steady"]
+
+
+def test_cancelled_budget_wait_returns_the_guild_budget():
+    async def run():
+        service = bot.AIService(None)
+        # The global budget is exhausted, so the request waits there after charging the guild
+        service._global_tokens = bot.TokenBucket(100, 60)
+        service._global_tokens.tokens = 0
+        guild_requests, guild_tokens = service._buckets_for(1)
+        before = (guild_requests.tokens, guild_tokens.tokens)
+        try:
+            await asyncio.wait_for(service._acquire_budget(1, 500), timeout=0.05)
+        except asyncio.TimeoutError:
+            pass
+        return before, (guild_requests.tokens, guild_tokens.tokens)
+
+    before, after = asyncio.run(run())
+    assert after[0] >= before[0] - 0.01 and after[1] >= before[1] - 0.01
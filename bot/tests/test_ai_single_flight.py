@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import professional_builder_bot as bot
+
+
+class SlowModel:
+    """Completion stand-in that takes `latency` seconds and records cancellation"""
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.calls = 0
+        self.cancelled = False
+
+    async def completion(self, system_prompt, user_prompt, partial=None, route=None):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        return {"content": "ok", "finish_reason": "stop", "prompt_tokens": 1, "completion_tokens": 1, "model": "fake"}
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    monkeypatch.setattr(bot, "AI_HEDGE_ENABLED", False)
+
+    def make(model):
+        service = bot.AIService(None)
+        service.backend.mode = "replay"
+        service.breaker = bot.CircuitBreaker("test_single_flight", "The AI service", min_calls=100)
+        service._request_completion = model.completion
+        return service
+
+    return make
+
+
+def ask(service):
+    return asyncio.ensure_future(service.generate_response("system", "user", command="test", use_cache=False))
+
+
+def test_cancelled_leader_leaves_the_call_to_its_followers(service):
+    model = SlowModel()
+
+    async def run():
+        ai = service(model)
+        leader = ask(ai)
+        await asyncio.sleep(0.01)
+        follower = ask(ai)
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        result = await follower
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return ai, result
+
+    ai, result = asyncio.run(run())
+    assert result == "ok"
+    assert model.calls == 1 and not model.cancelled
+    assert not ai._inflight and not ai._inflight_waiters
+
+
+def test_cancelled_follower_does_not_abort_the_leader(service):
+    model = SlowModel()
+
+    async def run():
+        ai = service(model)
+        leader = ask(ai)
+        await asyncio.sleep(0.01)
+        follower = ask(ai)
+        await asyncio.sleep(0.01)
+        follower.cancel()
+        result = await leader
+        assert follower.cancelled()
+        return ai, result
+
+    ai, result = asyncio.run(run())
+    assert result == "ok"
+    assert model.calls == 1 and not model.cancelled
+    assert not ai._inflight and not ai._inflight_waiters
+
+
+def test_last_waiter_leaving_cancels_the_shared_call(service):
+    model = SlowModel(latency=1.0)
+
+    async def run():
+        ai = service(model)
+        waiters = [ask(ai), ask(ai)]
+        await asyncio.sleep(0.01)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0.01)
+        # A fresh request after the abandoned one starts its own call
+        model.latency = 0.01
+        return ai, await ask(ai)
+
+    ai, result = asyncio.run(run())
+    assert model.cancelled
+    assert result == "ok" and model.calls == 2
+    assert not ai._inflight and not ai._inflight_waiters
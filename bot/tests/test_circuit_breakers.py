@@ -0,0 +1,126 @@
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+
+import professional_builder_bot as bot
+
+COOLDOWN = 0.2
+
+
+class FaultInjector:
+    """Local stand-in for a dependency that can be switched between healthy and failing"""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.failing = False
+        self.calls = 0
+
+    def hit(self):
+        self.calls += 1
+        if self.failing:
+            raise ConnectionError("injected fault")
+
+    async def completion(self, system_prompt, user_prompt, partial=None, route=None):
+        await asyncio.sleep(self.latency)
+        self.hit()
+        return {"content": "ok", "finish_reason": "stop", "prompt_tokens": 1, "completion_tokens": 1, "model": "fake"}
+
+    def execute(self):
+        time.sleep(self.latency)
+        self.hit()
+        return "ok"
+
+
+async def exercise(call, fault, breaker):
+    """Drive a breaker through closed, open, a failed half-open probe and a successful one"""
+    await call()
+    assert breaker.state == bot.CircuitBreaker.CLOSED
+
+    fault.failing = True
+    for _ in range(breaker.min_calls):
+        try:
+            await call()
+        except bot.CircuitOpenError:
+            break
+        except Exception:
+            pass
+    assert breaker.state == bot.CircuitBreaker.OPEN
+
+    calls_before = fault.calls
+    started = time.perf_counter()
+    try:
+        await call()
+        raise AssertionError("open breaker let a call through")
+    except bot.CircuitOpenError:
+        pass
+    assert fault.calls == calls_before, "open breaker reached the dependency"
+    assert time.perf_counter() - started < 0.05, "open breaker did not fail fast"
+
+    await asyncio.sleep(COOLDOWN)
+    try:
+        await call()
+    except Exception:
+        pass
+    assert breaker.state == bot.CircuitBreaker.OPEN, "failed half-open probe did not re-open the breaker"
+
+    fault.failing = False
+    await asyncio.sleep(COOLDOWN)
+    await call()
+    assert breaker.state == bot.CircuitBreaker.CLOSED, "successful probe did not close the breaker"
+
+
+def test_openai_breaker():
+    async def run():
+        fault = FaultInjector()
+        ai_service = bot.AIService("check")
+        ai_service.breaker = bot.CircuitBreaker("check_openai", "The AI service", min_calls=3, cooldown=COOLDOWN)
+        ai_service._request_completion = fault.completion
+
+        async def call():
+            result = await ai_service.generate_response("system", f"user {random.random()}", max_retries=1, use_cache=False)
+            if result is None:
+                raise ConnectionError("AI request failed")
+
+        try:
+            await exercise(call, fault, ai_service.breaker)
+        finally:
+            await ai_service.close()
+
+    asyncio.run(run())
+
+
+def test_supabase_breaker():
+    async def run():
+        fault = FaultInjector()
+        breaker = bot.CircuitBreaker("check_supabase", "The subscription database", min_calls=3, cooldown=COOLDOWN)
+        db = bot.SupabaseRepository(SimpleNamespace(), breaker=breaker)
+
+        async def call():
+            await db._execute("check", lambda client: fault)
+
+        try:
+            await exercise(call, fault, breaker)
+        finally:
+            db.close()
+
+    asyncio.run(run())
+
+
+def test_open_breaker_refunds_a_continuation_budget():
+    async def run():
+        ai_service = bot.AIService("check")
+        ai_service.breaker = bot.CircuitBreaker("check_continuation", "The AI service", cooldown=60)
+        ai_service.breaker._trip()
+        route = ai_service.router.default
+        guild_tokens = ai_service._buckets_for(1)[1]
+        before = (ai_service._global_tokens.tokens, guild_tokens.tokens)
+        try:
+            tail = await ai_service._continue_response("system", "user", "partial", route, guild_id=1)
+        finally:
+            await ai_service.close()
+        return tail, before, (ai_service._global_tokens.tokens, guild_tokens.tokens)
+
+    tail, before, after = asyncio.run(run())
+    assert tail is None
+    assert after[0] >= before[0] - 1 and after[1] >= before[1] - 1
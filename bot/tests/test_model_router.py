@@ -0,0 +1,27 @@
+import asyncio
+
+import professional_builder_bot as bot
+
+
+def test_continued_request_is_routed_once(monkeypatch):
+    monkeypatch.setattr(bot, "metrics", bot.MetricsRegistry())
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    replies = ['["general", "me', 'mes"]']
+    routes = []
+
+    async def completion(system_prompt, user_prompt, partial=None, route=None):
+        routes.append(route.name)
+        content = replies[len(routes) - 1]
+        return {"content": content, "finish_reason": "length" if len(routes) == 1 else "stop",
+                "prompt_tokens": 10, "completion_tokens": 5, "model": route.model}
+
+    async def run():
+        service = bot.AIService(None)
+        service.backend.mode = "replay"
+        service._request_completion = completion
+        return await service.generate_json("system", "user", bot.CHANNEL_NAMES_SCHEMA, command="test", use_cache=False)
+
+    assert asyncio.run(run()) == ["general", "memes"]
+    assert len(routes) == 2 and routes[0] == routes[1]
+    selected = {name: count for name, count in bot.metrics.counters.items() if name.endswith(".selected")}
+    assert selected == {f"ai.route.{routes[0]}.selected": 1}
@@ -0,0 +1,79 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import professional_builder_bot as bot
+from benchmarks.fakes import FakeDiscordREST, SyntheticGuild
+
+BLUEPRINT = {
+    "categories": [
+        {"name": "Info {start}", "channels": [{"name": "rules", "type": "text"}]},
+        {"name": "The \"Lounge\" \\ [chill]", "channels": [{"name": "general", "type": "text"},
+                                                        {"name": "voice", "type": "voice"}]},
+    ],
+    "roles": [{"name": "Mod \"}\"", "color": "#ff0000"}, {"name": "Member", "color": "#00ff00"}],
+    "welcome_message": "Hi",
+    "rules": ["Be kind"],
+}
+DOCUMENT = "```json\n" + json.dumps(BLUEPRINT, indent=2) + "\n```"
+
+
+def feed_in_chunks(text, size):
+    parser = bot.IncrementalBlueprintParser()
+    events = []
+    for i in range(0, len(text), size):
+        events.extend(parser.feed(text[i:i + size]))
+    return parser, events
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(DOCUMENT)])
+def test_elements_survive_any_chunk_split(size):
+    # Splits land inside keys, escapes and the brackets/quotes embedded in names
+    parser, events = feed_in_chunks(DOCUMENT, size)
+    assert [data for kind, data in events if kind == "category"] == BLUEPRINT["categories"]
+    assert [data for kind, data in events if kind == "role"] == BLUEPRINT["roles"]
+    assert parser.result()["roles"] == BLUEPRINT["roles"]
+
+
+def test_truncated_output_keeps_the_elements_that_closed():
+    cut = DOCUMENT.index("Member") - 5
+    parser, events = feed_in_chunks(DOCUMENT[:cut], 5)
+    assert [kind for kind, _ in events] == ["category", "category", "role"]
+    assert parser.emitted["role"] == BLUEPRINT["roles"][:1]
+
+
+def test_a_failing_build_releases_the_ai_slot(monkeypatch):
+    monkeypatch.setattr(bot, "ai_usage", bot.AIUsageTracker())
+    chunks = [DOCUMENT[i:i + 8] for i in range(0, len(DOCUMENT), 8)]
+
+    async def stream_completion(system_prompt, user_prompt, route):
+        for chunk in chunks:
+            await asyncio.sleep(0)
+            yield chunk, None
+        yield "", "stop"
+
+    class FailingJob:
+        async def update_params(self, **params):
+            raise RuntimeError("job store unavailable")
+
+        async def checkpoint(self, key, created_id):
+            pass
+
+    async def run():
+        service = bot.AIService(None)
+        service.backend.mode = "replay"
+        service.breaker = bot.CircuitBreaker("test_stream_slot", "The AI service", min_calls=100)
+        service._stream_completion = stream_completion
+        slots = service._semaphore._value
+        cog = bot.MainCog(SimpleNamespace(ai_service=service))
+        guild = SyntheticGuild(FakeDiscordREST(latency=0.0))
+        stream = service.stream_response("system", "user", guild_id=guild.id, command="setup", use_cache=False)
+        with pytest.raises(RuntimeError):
+            await cog._build_server_ai_streaming(SimpleNamespace(guild=guild), stream, "gamer", False, False, False,
+                                                 job=FailingJob())
+        return slots, service._semaphore._value
+
+    slots, after = asyncio.run(run())
+    assert after == slots
@@ -0,0 +1,130 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import professional_builder_bot as bot
+
+
+class OwnerLookupRepository:
+    """Repository stand-in without the bulk RPC, so warm-up takes the owner-lookup fallback"""
+
+    available = True
+
+    def __init__(self, owners, statuses):
+        self.owners = owners
+        self.statuses = statuses
+
+    async def get_guild_subscription_statuses(self, guild_ids):
+        raise ConnectionError("function get_guild_subscription_statuses does not exist")
+
+    async def get_guild_owners(self, guild_ids):
+        return {guild_id: self.owners[guild_id] for guild_id in guild_ids if guild_id in self.owners}
+
+    async def get_subscription_statuses_by_owner(self, owner_ids):
+        return {owner_id: self.statuses[owner_id] for owner_id in owner_ids if owner_id in self.statuses}
+
+    async def get_guild_owner(self, guild_id):
+        return self.owners.get(guild_id)
+
+    async def get_subscription_status(self, owner_id):
+        return self.statuses.get(owner_id)
+
+
+def test_warm_up_fallback_uses_the_stored_owner(monkeypatch):
+    # The gateway says guild 1 belongs to user 10, but the guilds table (used by
+    # single-guild checks) says user 20; warm-up must agree with the single lookup
+    repository = OwnerLookupRepository(owners={"1": "20", "2": "30"}, statuses={"10": "active", "20": "canceled", "30": "active"})
+    monkeypatch.setattr(bot, "repository", repository)
+    guilds = [SimpleNamespace(id=1, owner_id=10), SimpleNamespace(id=2, owner_id=30)]
+
+    async def run():
+        warmed = bot.SubscriptionResolver()
+        await warmed.warm_up(guilds)
+        single = bot.SubscriptionResolver()
+        return ([await warmed.is_paying_user(guild.id) for guild in guilds],
+                [await single.is_paying_user(guild.id) for guild in guilds])
+
+    warmed, single = asyncio.run(run())
+    assert warmed == single == [False, True]
+
+
+def test_refresh_runs_before_negative_entries_expire():
+    resolver = bot.SubscriptionResolver(ttl=300, negative_ttl=60)
+    assert resolver.refresh_interval < 60
+    assert bot.SubscriptionResolver(ttl=30, negative_ttl=120).refresh_interval < 30
+
+
+class CountingRepository:
+    """Single-guild lookups only, counting owner queries and optionally slow"""
+
+    available = True
+
+    def __init__(self, owners, statuses, latency=0.0):
+        self.owners = owners
+        self.statuses = statuses
+        self.latency = latency
+        self.lookups = 0
+
+    async def get_guild_owner(self, guild_id):
+        self.lookups += 1
+        await asyncio.sleep(self.latency)
+        return self.owners.get(guild_id)
+
+    async def get_subscription_status(self, owner_id):
+        return self.statuses.get(owner_id)
+
+
+def test_least_recently_used_guild_is_evicted(monkeypatch):
+    repository = CountingRepository(owners={"1": "10", "2": "10", "3": "10"}, statuses={"10": "active"})
+    monkeypatch.setattr(bot, "repository", repository)
+
+    async def run():
+        resolver = bot.SubscriptionResolver(max_entries=2)
+        await resolver.is_paying_user(1)
+        await resolver.is_paying_user(2)
+        await resolver.is_paying_user(1)  # 2 is now the least recently used
+        await resolver.is_paying_user(3)
+        return resolver
+
+    resolver = asyncio.run(run())
+    assert list(resolver._cache) == ["1", "3"]
+    assert repository.lookups == 3
+
+
+def test_negative_results_expire_sooner(monkeypatch):
+    repository = CountingRepository(owners={"1": "10", "2": "20"}, statuses={"10": "active", "20": "canceled"})
+    monkeypatch.setattr(bot, "repository", repository)
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: now[0])
+
+    async def run():
+        resolver = bot.SubscriptionResolver(ttl=300, negative_ttl=60)
+        assert [await resolver.is_paying_user(1), await resolver.is_paying_user(2)] == [True, False]
+        now[0] += 61
+        assert [await resolver.is_paying_user(1), await resolver.is_paying_user(2)] == [True, False]
+
+    asyncio.run(run())
+    # Only the negative entry was looked up again
+    assert repository.lookups == 3
+
+
+def test_concurrent_checks_share_one_lookup(monkeypatch):
+    repository = CountingRepository(owners={"1": "10"}, statuses={"10": "active"}, latency=0.05)
+    monkeypatch.setattr(bot, "repository", repository)
+
+    async def run():
+        resolver = bot.SubscriptionResolver()
+        checks = [asyncio.ensure_future(resolver.is_paying_user(1)) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        # A cancelled caller does not abort the lookup the others share
+        checks[0].cancel()
+        results = await asyncio.gather(*checks[1:])
+        with pytest.raises(asyncio.CancelledError):
+            await checks[0]
+        return resolver, results
+
+    resolver, results = asyncio.run(run())
+    assert results == [True] * 4
+    assert repository.lookups == 1
+    assert not resolver._inflight
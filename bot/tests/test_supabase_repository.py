@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import professional_builder_bot as bot
+
+
+class SlowQuery:
+    """Chainable stand-in for a supabase-py query whose execute() blocks like a slow HTTP call"""
+
+    def __init__(self, delay, rows):
+        self.delay = delay
+        self.rows = rows
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(self.delay)
+        return type("Response", (), {"data": self.rows})()
+
+
+class SlowClient:
+    def __init__(self, delay):
+        self.delay = delay
+
+    def table(self, name):
+        return SlowQuery(self.delay, [{"owner_id": "42"}])
+
+
+def test_slow_client_does_not_block_the_event_loop():
+    async def run():
+        breaker = bot.CircuitBreaker("test_supabase", "The subscription database")
+        repository = bot.SupabaseRepository(SlowClient(0.2), max_concurrency=4, breaker=breaker)
+        lags = []
+
+        async def probe():
+            while True:
+                started = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - started - 0.01)
+
+        probe_task = asyncio.create_task(probe())
+        try:
+            owners = await asyncio.gather(*[repository.get_guild_owner(str(guild_id)) for guild_id in range(8)])
+        finally:
+            probe_task.cancel()
+            repository.close()
+        return owners, lags
+
+    owners, lags = asyncio.run(run())
+    assert owners == ["42"] * 8
+    # Eight 200 ms queries through four workers take ~400 ms; the loop keeps ticking throughout
+    assert len(lags) > 20
+    assert max(lags) < 0.05
+
+
+def test_slow_client_times_out():
+    async def run():
+        breaker = bot.CircuitBreaker("test_supabase_timeout", "The subscription database")
+        repository = bot.SupabaseRepository(SlowClient(0.3), timeout=0.05, breaker=breaker)
+        started = time.perf_counter()
+        try:
+            await repository.get_guild_owner("1")
+        except asyncio.TimeoutError:
+            return time.perf_counter() - started
+        finally:
+            repository.close()
+
+    elapsed = asyncio.run(run())
+    assert elapsed is not None and elapsed < 0.2
@@ -0,0 +1,105 @@
+import asyncio
+import os
+import tempfile
+from types import SimpleNamespace
+
+import professional_builder_bot as bot
+
+
+class APIError(Exception):
+    """Named like postgrest's APIError, which the spool treats as a rejected payload"""
+
+
+class FakePostgREST:
+    """Stand-in for a local PostgREST behind the repository's `write`
+    
+    While `down`, every request fails like a dropped connection. Rows whose `name`
+    is in `rejected` make the whole request fail the way PostgREST rejects bad data.
+    """
+
+    def __init__(self):
+        self.down = False
+        self.rejected = set()
+        self.requests = []
+        self.tables = {}
+
+    async def write(self, table, op, rows, on_conflict=None, filters=None):
+        if self.down:
+            raise ConnectionError("connection refused")
+        self.requests.append((table, op, len(rows)))
+        if any(row.get("name") in self.rejected for row in rows):
+            raise APIError("invalid input syntax")
+        stored = self.tables.setdefault(table, {})
+        for row in rows:
+            stored[row.get("id", len(stored))] = row
+
+
+def make_spool(backend):
+    store = bot.LocalStateStore(os.path.join(tempfile.mkdtemp(prefix="spool-test-"), "state.db"))
+    return bot.WriteSpool(store, sink=backend.write, replay_interval=0.01)
+
+
+def dead_letters(spool):
+    def load(conn):
+        return [row["payload"] for row in conn.execute("SELECT payload FROM write_spool_dead")]
+    return spool.store.run(load)
+
+
+def test_spool_keeps_writes_through_an_outage_and_drains_once_back():
+    backend = FakePostgREST()
+
+    async def run():
+        spool = make_spool(backend)
+        backend.down = True
+        await spool.submit_many("guilds", "upsert", [{"id": "1", "name": "a"}, {"id": "2", "name": "b"}],
+                                on_conflict="id", dedupe_keys=["guilds:1", "guilds:2"])
+        # Re-submitting the same row replaces the pending write instead of adding one
+        await spool.submit("guilds", "upsert", {"id": "1", "name": "a2"}, on_conflict="id", dedupe_key="guilds:1")
+        assert await spool.replay() == 0
+        assert not spool.healthy and await spool.pending_count() == 2
+        
+        backend.down = False
+        assert await spool.replay() == 2
+        return spool, await spool.pending_count()
+
+    spool, pending = asyncio.run(run())
+    assert pending == 0 and spool.healthy
+    assert backend.tables["guilds"] == {"1": {"id": "1", "name": "a2"}, "2": {"id": "2", "name": "b"}}
+    # Both rows went out as one multi-row request
+    assert backend.requests == [("guilds", "upsert", 2)]
+
+
+def test_rejected_rows_are_dead_lettered_without_blocking_the_rest():
+    backend = FakePostgREST()
+    backend.rejected.add("bad")
+
+    async def run():
+        spool = make_spool(backend)
+        await spool.submit_many("activity_logs", "insert", [{"name": "ok1"}, {"name": "bad"}, {"name": "ok2"}])
+        await spool.replay()
+        return await spool.pending_count(), await dead_letters(spool)
+
+    pending, dead = asyncio.run(run())
+    assert pending == 0
+    assert len(dead) == 1 and '"bad"' in dead[0]
+    assert sorted(row["name"] for row in backend.tables["activity_logs"].values()) == ["ok1", "ok2"]
+
+
+def test_nothing_is_spooled_without_supabase(monkeypatch):
+    backend = FakePostgREST()
+    spool = make_spool(backend)
+    monkeypatch.setattr(bot, "write_spool", spool)
+    monkeypatch.setattr(bot, "repository", SimpleNamespace(available=False))
+    syncer = bot.GuildSyncer(spool.store)
+    tracker = bot.AIUsageTracker()
+    guild = SimpleNamespace(id=1, name="a", icon=None, owner_id=10, member_count=5, features=[])
+
+    async def run():
+        assert await syncer.sync_guilds([guild], force=True) == 0
+        tracker.record(1, "test", "fake", "hash", prompt_tokens=10, completion_tokens=5)
+        await tracker.flush()
+        await spool._ensure_ready()
+        return await spool.pending_count()
+
+    assert asyncio.run(run()) == 0
+    assert tracker.totals
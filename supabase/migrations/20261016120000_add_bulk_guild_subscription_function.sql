@@ -0,0 +1,30 @@
+-- Bulk subscription lookup used by the bot to warm its subscription cache at startup
+-- Resolves guild -> owner -> subscriber in one round trip for a batch of guild IDs
+CREATE OR REPLACE FUNCTION get_guild_subscription_statuses(guild_ids TEXT[])
+RETURNS TABLE (
+  guild_id TEXT,
+  owner_id TEXT,
+  subscription_status TEXT
+) AS $$
+BEGIN
+  RETURN QUERY
+  SELECT
+    g.id AS guild_id,
+    g.owner_id,
+    sub.subscription_status
+  FROM guilds g
+  LEFT JOIN LATERAL (
+    SELECT s.subscription_status
+    FROM subscribers s
+    WHERE s.discord_user_id = g.owner_id
+    ORDER BY s.updated_at DESC NULLS LAST
+    LIMIT 1
+  ) sub ON TRUE
+  WHERE g.id = ANY(guild_ids);
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER
+SET search_path = public;
+
+-- Only the bot (service role) needs bulk access
+REVOKE EXECUTE ON FUNCTION get_guild_subscription_statuses(TEXT[]) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION get_guild_subscription_statuses(TEXT[]) TO service_role;
@@ -0,0 +1,38 @@
+-- Create ai_usage table for per-guild/command/model AI cost and latency accounting
+-- The bot aggregates calls in memory and inserts one row per key per flush window
+CREATE TABLE IF NOT EXISTS ai_usage (
+  id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+  guild_id TEXT,
+  command_name TEXT NOT NULL,
+  model TEXT NOT NULL,
+  window_start TIMESTAMP WITH TIME ZONE NOT NULL,
+  window_end TIMESTAMP WITH TIME ZONE NOT NULL,
+  calls INTEGER NOT NULL DEFAULT 0,
+  failures INTEGER NOT NULL DEFAULT 0,
+  retries INTEGER NOT NULL DEFAULT 0,
+  cache_hits INTEGER NOT NULL DEFAULT 0,
+  coalesced INTEGER NOT NULL DEFAULT 0,
+  prompt_tokens BIGINT NOT NULL DEFAULT 0,
+  completion_tokens BIGINT NOT NULL DEFAULT 0,
+  estimated_cost_usd NUMERIC(12, 6) NOT NULL DEFAULT 0,
+  queue_time_ms_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+  upstream_ms_total DOUBLE PRECISION NOT NULL DEFAULT 0,
+  upstream_ms_max DOUBLE PRECISION NOT NULL DEFAULT 0,
+  top_prompt_hash TEXT,
+  top_prompt_tokens INTEGER,
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Add indexes for the usual "what is expensive" queries
+CREATE INDEX IF NOT EXISTS idx_ai_usage_guild_id ON ai_usage(guild_id);
+CREATE INDEX IF NOT EXISTS idx_ai_usage_command_name ON ai_usage(command_name);
+CREATE INDEX IF NOT EXISTS idx_ai_usage_window_start ON ai_usage(window_start);
+
+-- Enable RLS (Row Level Security)
+ALTER TABLE ai_usage ENABLE ROW LEVEL SECURITY;
+
+-- Only the bot (service role) writes usage rows
+DROP POLICY IF EXISTS "Service role can insert ai usage" ON ai_usage;
+CREATE POLICY "Service role can insert ai usage" ON ai_usage
+  FOR INSERT TO service_role
+  WITH CHECK (true);